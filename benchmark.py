@@ -0,0 +1,197 @@
+"""
+Repeatable benchmarks of the conversion and rendering hot paths on synthetic
+diaries (see synthetic_diary.py) at several scales. Results are written as JSON
+so that runs can be compared; --compare reports every change against an earlier
+results file and exits with status 1 when a benchmark got slower than --threshold.
+
+    python benchmark.py --scales 20 100 --output before.json
+    python benchmark.py --scales 20 100 --output after.json --compare before.json
+"""
+import argparse
+import datetime
+import gc
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+BENCHMARKS = ("is_date_line", "extract_date_lines", "write_diary_json", "decode_base64_image", "create_pdf_from_json")
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def timed(func, repeat):
+    """Seconds of each of repeat calls of func; logging below WARNING is off meanwhile."""
+    seconds = []
+    logging.disable(logging.INFO)
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+    finally:
+        logging.disable(logging.NOTSET)
+    return seconds
+
+def synthetic_markdown(work_dir, entries, diary_options):
+    """Path of the synthetic diary for these settings, generated unless an earlier run left it in work_dir."""
+    from synthetic_diary import write_diary
+    key = hashlib.sha256(json.dumps(diary_options, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    path = os.path.join(work_dir, f"synthetic_{entries}_{key}.md")
+    if not os.path.exists(path):
+        logging.info(f"Generating {path}")
+        write_diary(path, entries=entries, **diary_options)
+    return path
+
+def benchmark_scale(md_path, benchmarks, repeat):
+    """
+    Runs the benchmarks on one synthetic diary. Inputs are prepared untimed: the
+    entries for write_diary_json, decode_base64_image and create_pdf_from_json
+    come from one extract_date_lines run, and spaCy is loaded before timing.
+    Yields (benchmark, items, seconds per run).
+    """
+    from detect_dates import is_date_line, load_spacy_model
+    from diary_json2pdf import create_pdf_from_json, decode_base64_image
+    from diary_markdown2json import extract_date_lines, write_diary_json
+    base = os.path.splitext(md_path)[0]
+    json_path = base + ".json"
+    logging.disable(logging.INFO)
+    try:
+        entries = extract_date_lines(md_path)
+        write_diary_json(entries, json_path)
+    finally:
+        logging.disable(logging.NOTSET)
+    if "is_date_line" in benchmarks:
+        nlp = load_spacy_model()
+        # The lines the classifier sees outside image blocks: datelines and text
+        lines = [line for entry in entries for line in [entry["dateline"]] + [t["text"] for t in entry["text"]]]
+        yield "is_date_line", len(lines), timed(lambda: [is_date_line(line, nlp) for line in lines], repeat)
+    if "extract_date_lines" in benchmarks:
+        with open(md_path, "r", encoding="utf-8") as f:
+            num_lines = sum(1 for _ in f)
+        # No verdict cache: every run classifies from scratch
+        yield "extract_date_lines", num_lines, timed(lambda: extract_date_lines(md_path), repeat)
+    if "write_diary_json" in benchmarks:
+        output_json = base + ".bench.json"
+        yield "write_diary_json", len(entries), timed(lambda: write_diary_json(entries, output_json), repeat)
+    if "decode_base64_image" in benchmarks:
+        images = [img for entry in entries for img in entry["images"]]
+        yield "decode_base64_image", len(images), timed(lambda: [decode_base64_image(img["image_data"], img["type"]) for img in images], repeat)
+    if "create_pdf_from_json" in benchmarks:
+        output_pdf = base + "_POCKET_9pt.pdf"
+        # Serial and uncached, so runs measure the same work
+        render = lambda: create_pdf_from_json(json_path, output_pdf, page_size="POCKET", text_font_size=9, image_workers=0)
+        yield "create_pdf_from_json", len(entries), timed(render, repeat)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=CODE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def package_versions():
+    from importlib import metadata
+    versions = {}
+    for package in ("fpdf2", "Pillow", "fonttools", "spacy", "python-dateutil", "ijson"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+def run_benchmarks(scales, work_dir, benchmarks=BENCHMARKS, repeat=3, diary_options=None):
+    """Runs the benchmarks at every scale (number of diary entries); returns the results document."""
+    diary_options = diary_options or {}
+    results = []
+    for scale in scales:
+        md_path = synthetic_markdown(work_dir, scale, diary_options)
+        for name, items, seconds in benchmark_scale(md_path, benchmarks, repeat):
+            best = min(seconds)
+            results.append({
+                "benchmark": name,
+                "scale": scale,
+                "items": items,
+                "seconds": [round(s, 6) for s in seconds],
+                "min_s": round(best, 6),
+                "median_s": round(statistics.median(seconds), 6),
+                "us_per_item": round(best / items * 1e6, 3) if items else None,
+            })
+            logging.info(f"{name} @ {scale} entries: {best:.3f} s best of {repeat} ({items} items)")
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "versions": package_versions(),
+        "settings": {"scales": list(scales), "repeat": repeat, "benchmarks": list(benchmarks), "diary": diary_options},
+        "results": results,
+    }
+
+def compare_results(baseline, current, threshold=0.2):
+    """
+    Logs the change of every benchmark and scale present in both documents (best
+    times compared); returns the number slower than baseline by more than threshold.
+    """
+    previous = {(r["benchmark"], r["scale"]): r for r in baseline["results"]}
+    regressions = 0
+    logging.info(f"Compared with {baseline.get('commit') or 'unknown commit'} ({baseline.get('created')})")
+    for result in current["results"]:
+        before = previous.get((result["benchmark"], result["scale"]))
+        if before is None or not before["min_s"]:
+            continue
+        ratio = result["min_s"] / before["min_s"]
+        slower = ratio > 1 + threshold
+        regressions += slower
+        log = logging.warning if slower else logging.info
+        log(f"{result['benchmark']} @ {result['scale']} entries: {before['min_s']:.3f} s -> {result['min_s']:.3f} s ({(ratio - 1) * 100:+.1f}%)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the diary converter and renderer on synthetic diaries.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[20, 100], help="Diary sizes to benchmark, in entries (default: 20 100)")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark; the best is compared (default: 3)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the results (default: benchmark_results.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="With --compare, slowdown counted as a regression (default: 0.2, i.e. 20%%)")
+    parser.add_argument("--work_dir", default=None, help="Directory for the synthetic diaries and outputs, kept for later runs (default: a temporary directory)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic diaries (default: 0)")
+    parser.add_argument("--images_per_entry", type=float, default=0.3, help="Mean number of images per synthetic entry (default: 0.3)")
+    parser.add_argument("--image_size", type=int, nargs=2, default=[800, 600], metavar=("W", "H"), help="Largest synthetic image size in pixels (default: 800 600)")
+    parser.add_argument("--image_format", nargs="+", default=["JPEG", "PNG"], help="Synthetic image formats, as PIL names (default: JPEG PNG)")
+    parser.add_argument("--log", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=getattr(logging, args.log.upper(), None),
+        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s'
+    )
+    logging.getLogger("fpdf").setLevel(logging.WARNING)
+    logging.getLogger("fontTools").setLevel(logging.WARNING)
+    logging.getLogger("PIL").setLevel(logging.WARNING)
+    diary_options = {
+        "seed": args.seed,
+        "images_per_entry": args.images_per_entry,
+        "image_size": args.image_size,
+        "image_formats": args.image_format,
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        document = run_benchmarks(args.scales, work_dir, args.benchmarks, args.repeat, diary_options)
+    with open(args.output + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2)
+    os.replace(args.output + ".tmp", args.output)
+    logging.info(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, document, args.threshold)
+        if regressions:
+            logging.warning(f"{regressions} benchmarks slower than {args.compare} by more than {args.threshold:.0%}")
+            raise SystemExit(1)
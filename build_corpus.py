@@ -0,0 +1,280 @@
+"""
+Builds the PDFs of a whole corpus of Bear markdown exports from a JSON manifest:
+
+    {
+      "inputs": ["DiaryEntriesFromBear/*.md"],
+      "convert": {"dateline_max_length": 80, "image_store": null, "compact": false},
+      "variants": [
+        {"page_size": "POCKET", "text_font_size": 9, "date_font_size": 9.5,
+         "rect_fill_color": [40, 40, 60], "text_font": "nyt-cheltenham-normal",
+         "date_font": "imperial-italic-600"}
+      ],
+      "render": {"image_cache": true, "image_cache_size_mb": 2048, "image_passthrough": "cmyk"},
+      "metrics": false
+    }
+
+Input globs are relative to the manifest. Each markdown file is converted to
+<input>.json, and the JSON is rendered to one PDF and metadata.txt per variant
+(variant keys as in create_pdf_from_json; outputs named as by diary_json2pdf.py).
+"render" also takes max_image_pixels, image_passthrough and text_layout, which
+apply to every variant.
+Diaries are built in parallel worker processes. A target is skipped when the
+hash of its input, its settings and the code and fonts that produce it all
+match the last successful build, recorded in <manifest>.buildstate.json.
+With "metrics", every conversion and render writes its stage timings and
+counters next to its outputs (<input>.convert.metrics.json and
+<input>.render.metrics.json, see run_metrics.py).
+"""
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import logging
+import os
+
+# Source files whose content is part of every target fingerprint
+CONVERTER_SOURCES = ("diary_markdown2json.py", "detect_dates.py", "image_store.py", "entry_index.py")
+# Everything the render path imports that can change a PDF or its metadata.txt
+RENDERER_SOURCES = (
+    "diary_json2pdf.py", "PDFRounded.py", "font_registry.py", "text_layout.py", "pdf_shards.py",
+    "image_cache.py", "image_store.py", "diary_store.py", "entry_index.py", "detect_dates.py",
+)
+
+# "render" settings that change the PDFs, passed to create_pdfs_from_json and part
+# of every render fingerprint (defaults as in diary_json2pdf.py)
+RENDER_OUTPUT_OPTIONS = ("max_image_pixels", "image_passthrough", "text_layout")
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_manifest(manifest_path):
+    """Reads the manifest and expands its input globs (relative to the manifest) into sorted paths."""
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    inputs = []
+    for pattern in manifest.get("inputs", []):
+        matches = sorted(glob.glob(os.path.join(base_dir, pattern)))
+        if not matches:
+            logging.warning(f"Manifest input {pattern!r} matches no files")
+        # Relative to the working directory, as the entries' "filename" when run by hand
+        inputs.extend(os.path.relpath(path) for path in matches if os.path.relpath(path) not in inputs)
+    manifest["inputs"] = inputs
+    manifest.setdefault("convert", {})
+    manifest.setdefault("variants", [{}])
+    manifest.setdefault("render", {})
+    return manifest
+
+def fingerprint(*parts):
+    """Stable hash of JSON-serializable build inputs."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+class FileHashes:
+    """
+    SHA-256 of files, remembered across builds by (size, mtime) so unchanged files
+    are not read again.
+    """
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+
+    def sha256(self, path):
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        known = self.known.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        self.known[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return self.known[path][2]
+
+class BuildState:
+    """Fingerprints of the last successful build of each target, plus the file hash memo."""
+
+    def __init__(self, path):
+        self.path = path
+        state = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable build state {path}: {e}")
+        self.targets = state.get("targets", {})
+        self.hashes = FileHashes(state.get("files"))
+
+    def is_current(self, outputs, target_fingerprint):
+        return self.targets.get(outputs[0]) == target_fingerprint and all(os.path.exists(p) for p in outputs)
+
+    def record(self, output, target_fingerprint):
+        self.targets[output] = target_fingerprint
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"targets": self.targets, "files": self.hashes.known}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+def json_fingerprint(markdown_sha256, convert_options, code):
+    return fingerprint("json", markdown_sha256, convert_options, code)
+
+def pdf_fingerprint(json_sha256, variant, render_settings, code):
+    return fingerprint("pdf", json_sha256, variant, render_settings, code)
+
+def render_settings(render):
+    """The RENDER_OUTPUT_OPTIONS of a manifest's "render" block, defaults filled in."""
+    from diary_json2pdf import MAX_IMAGE_PIXELS
+    defaults = {"max_image_pixels": MAX_IMAGE_PIXELS, "image_passthrough": "cmyk", "text_layout": True}
+    return {key: render.get(key, defaults[key]) for key in RENDER_OUTPUT_OPTIONS}
+
+def pdf_outputs(output_pdf):
+    return [output_pdf, os.path.splitext(output_pdf)[0] + ".metadata.txt"]
+
+def plan_build(manifest, state, force=False):
+    """
+    Walks the md -> json -> pdf + metadata.txt graph and returns one job per diary
+    with anything out of date: whether its JSON must be converted, and the
+    render targets as (variant, output_pdf, recorded fingerprint).
+    """
+    from diary_json2pdf import VARIANT_DEFAULTS, variant_output_paths
+    from font_registry import FontRegistry, default_font_dirs
+    hashes = state.hashes
+    variants = [{**VARIANT_DEFAULTS, **variant, "output_pdf": None} for variant in manifest["variants"]]
+    settings = render_settings(manifest["render"])
+    converter_code = [hashes.sha256(os.path.join(CODE_DIR, name)) for name in CONVERTER_SOURCES]
+    renderer_code = [hashes.sha256(os.path.join(CODE_DIR, name)) for name in RENDERER_SOURCES]
+    fonts = FontRegistry(default_font_dirs(manifest["render"].get("font_dirs", [])))
+    for font in sorted({variant[key] for variant in variants for key in ("date_font", "text_font")}):
+        try:
+            renderer_code.append(hashes.sha256(fonts.resolve(font)))
+        except FileNotFoundError:
+            renderer_code.append(None)  # core font, or the render reports it missing
+
+    jobs = []
+    up_to_date = 0
+    for markdown_path in manifest["inputs"]:
+        json_path = os.path.splitext(markdown_path)[0] + ".json"
+        json_fp = json_fingerprint(hashes.sha256(markdown_path), manifest["convert"], converter_code)
+        convert = force or not state.is_current([json_path], json_fp)
+        json_sha256 = None
+        if not convert:
+            json_sha256 = hashes.sha256(json_path)
+            up_to_date += 1
+        renders = []
+        for variant, output_pdf in zip(variants, variant_output_paths(json_path, variants)):
+            recorded = None if force else state.targets.get(output_pdf)
+            outputs = pdf_outputs(output_pdf)
+            if json_sha256 and state.is_current(outputs, pdf_fingerprint(json_sha256, variant, settings, renderer_code)):
+                up_to_date += 1
+                continue
+            renders.append((variant, output_pdf, recorded if all(os.path.exists(p) for p in outputs) else None))
+        if convert or renders:
+            jobs.append({
+                "markdown": markdown_path,
+                "json": json_path,
+                "convert": json_fp if convert else None,
+                "renders": renders,
+                "render_settings": settings,
+                "renderer_code": renderer_code,
+            })
+    return jobs, up_to_date
+
+def build_diary(job, convert_options, render_options, metrics=False):
+    """
+    Worker: converts the diary if its JSON is stale, then renders the variants whose
+    fingerprint no longer matches (a re-converted JSON that came out byte-identical
+    leaves the PDFs alone). Returns (fingerprints by output, json sha256, render count).
+    """
+    from diary_json2pdf import create_pdfs_from_json
+    metrics_path = "" if metrics else None
+    built = {}
+    if job["convert"]:
+        from diary_markdown2json import convert_markdown_file
+        options = dict(convert_options)
+        verdict_cache = options.pop("verdict_cache", True)
+        if verdict_cache:
+            options["verdict_cache_path"] = verdict_cache if isinstance(verdict_cache, str) else os.path.splitext(job["markdown"])[0] + ".datecache.sqlite"
+        convert_markdown_file(job["markdown"], job["json"], metrics=metrics_path, **options)
+        built[job["json"]] = job["convert"]
+    json_sha256 = FileHashes().sha256(job["json"])
+    targets = [
+        (variant, output_pdf, recorded, pdf_fingerprint(json_sha256, variant, job["render_settings"], job["renderer_code"]))
+        for variant, output_pdf, recorded in job["renders"]
+    ]
+    stale = [target for target in targets if target[2] != target[3]]
+    if stale:
+        variants = [dict(variant, output_pdf=output_pdf) for variant, output_pdf, _, _ in stale]
+        create_pdfs_from_json(job["json"], variants, metrics=metrics_path, **render_options, **job["render_settings"])
+    for _, output_pdf, _, target_fp in targets:
+        built[output_pdf] = target_fp
+    return built, json_sha256, len(stale)
+
+def build_corpus(manifest_path, workers=None, force=False, dry_run=False):
+    """Brings every target of the manifest up to date; returns the number of failed diaries."""
+    manifest = load_manifest(manifest_path)
+    state = BuildState(os.path.splitext(manifest_path)[0] + ".buildstate.json")
+    jobs, up_to_date = plan_build(manifest, state, force)
+    logging.info(f"{len(manifest['inputs'])} diaries: {len(jobs)} to build, {up_to_date} targets up to date")
+    if dry_run:
+        for job in jobs:
+            steps = (["convert"] if job["convert"] else []) + [os.path.basename(output_pdf) for _, output_pdf, _ in job["renders"]]
+            logging.info(f"{job['markdown']}: {', '.join(steps)}")
+        return 0
+    if not jobs:
+        state.save()
+        return 0
+
+    render = manifest["render"]
+    from font_registry import default_font_cache_path
+    image_cache = render.get("image_cache", True)
+    if image_cache is True:
+        from image_cache import default_image_cache_path
+        image_cache = default_image_cache_path()
+    # Workers share the image cache file, which commits every image as it is added
+    render_options = {
+        "image_cache_path": image_cache or None,
+        "image_cache_size_mb": render.get("image_cache_size_mb", 2048),
+        # Diaries already run in parallel; images are prepared inside each worker
+        "image_workers": render.get("image_workers", 0),
+        "font_dirs": render.get("font_dirs"),
+        "font_cache_path": default_font_cache_path() if render.get("font_cache", True) else None,
+    }
+    workers = workers or min(len(jobs), os.cpu_count() or 1)
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(build_diary, job, manifest["convert"], render_options, manifest.get("metrics", False)): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                built, json_sha256, rendered = future.result()
+            except Exception as e:
+                failures += 1
+                logging.error(f"Building {job['markdown']} failed: {e!r}")
+                continue
+            for output, target_fp in built.items():
+                state.record(output, target_fp)
+            state.save()
+            logging.info(f"Built {job['markdown']}: {'converted, ' if job['convert'] else ''}{rendered} PDFs rendered")
+    state.save()
+    logging.info(f"Build finished: {len(jobs) - failures} diaries built, {failures} failed")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert and render every diary of a manifest, skipping up-to-date targets.")
+    parser.add_argument("manifest", help="JSON manifest of markdown inputs and render variants")
+    parser.add_argument("--workers", type=int, default=None, help="Diaries built in parallel (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Rebuild every target even if it is up to date")
+    parser.add_argument("--dry_run", action="store_true", help="Only log what would be built")
+    parser.add_argument("--log", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=getattr(logging, args.log.upper(), None),
+        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s'
+    )
+    raise SystemExit(1 if build_corpus(args.manifest, args.workers, args.force, args.dry_run) else 0)
@@ -1,291 +1,433 @@
+import functools
 import logging
-import spacy
+import re
+import sqlite3
+import dateutil
+from datetime import datetime
 from dateutil import parser
 
-# Load spaCy English model
+# Bump whenever a tier below changes the verdict it can give for a line.
+CLASSIFIER_VERSION = 1
+
+MONTH_NAME_RE = re.compile(r"\b(January|February|March|April|May|June|July|August|September|October|November|December|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\b", re.IGNORECASE)
+BASE64_LINE_RE = re.compile(r"[A-Za-z0-9+/=]+")
+
+# Tokens as dateutil's lexer sees them: digit runs, letter runs, whitespace, single symbols
+TOKEN_RE = re.compile(r"\d+|[^\W\d_]+|\s+|.", re.UNICODE)
+ALPHA_TOKEN_RE = re.compile(r"[^\W\d_]+", re.UNICODE)
+# Sentence punctuation that neither dateutil (fuzzy=False) nor a whole-line DATE entity accepts
+SENTENCE_PUNCT_RE = re.compile(r"[?!\"“”]")
+# "Week 182" counters in datelines; dateutil would read the number as a year
+WEEK_NUMBER_RE = re.compile(r"\bweek\s*#?\d+\b", re.IGNORECASE)
+
+_DATEUTIL_INFO = parser.parserinfo()
+# Words dateutil accepts that are neither digits nor month/weekday names
+_DATEUTIL_WORDS = set(_DATEUTIL_INFO.JUMP) | set(_DATEUTIL_INFO.PERTAIN) | set(_DATEUTIL_INFO.UTCZONE)
+for _names in _DATEUTIL_INFO.AMPM + _DATEUTIL_INFO.HMS:
+    _DATEUTIL_WORDS.update(_names)
+# float() accepts these, so dateutil hands them to its numeric parser
+_DATEUTIL_WORDS.update(("nan", "inf", "infinity"))
+_DATEUTIL_WORDS = {w.lower() for w in _DATEUTIL_WORDS}
+
+SPACY_MODEL = "en_core_web_sm"
+
+# Load spaCy English model; dateline detection only reads doc.ents, so only NER runs.
+# Loaded once per process, since build_corpus.py converts several files per worker.
+@functools.lru_cache(maxsize=None)
 def load_spacy_model():
+    import spacy
     try:
-        return spacy.load("en_core_web_sm")
+        return spacy.load(SPACY_MODEL, enable=["ner"])
     except OSError:
-        logging.error("spaCy model not found. Please run: python -m spacy download en_core_web_sm")
+        logging.error(f"spaCy model not found. Please run: python -m spacy download {SPACY_MODEL}")
         exit(1)
 
-def is_date_line(line, nlp):
+class LazySpacyModel:
     """
-    Returns True if the line is likely to be a date line.
-    Uses spaCy NER and dateutil.parser for robustness.
+    Stands in for the spaCy pipeline until a line actually reaches the NER tier, so
+    runs the cheaper tiers and the verdict cache fully decide never import spaCy.
+    meta comes from the installed model package's meta.json without loading it.
+    """
+
+    def __init__(self):
+        self._nlp = None
+        self._meta = None
+
+    @property
+    def loaded(self):
+        return self._nlp is not None
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            import run_metrics
+            logging.info(f"Loading spaCy model {SPACY_MODEL} for the NER fallback")
+            with run_metrics.stage("spacy_load"):
+                self._nlp = load_spacy_model()
+        return self._nlp
+
+    @property
+    def meta(self):
+        if self._nlp is not None:
+            return self._nlp.meta
+        if self._meta is None:
+            self._meta = _installed_model_meta(SPACY_MODEL)
+        return self._meta if self._meta is not None else self.nlp.meta
+
+    def __call__(self, text):
+        return self.nlp(text)
+
+    def pipe(self, texts, **kwargs):
+        return self.nlp.pipe(texts, **kwargs)
+
+def _installed_model_meta(name):
+    import importlib.util
+    import json
+    import os
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    meta_path = os.path.join(list(spec.submodule_search_locations)[0], "meta.json")
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=None)
+def lazy_spacy_model():
+    """The process-wide LazySpacyModel (see load_spacy_model)."""
+    return LazySpacyModel()
+
+def verdict_cache_namespace(nlp):
+    """
+    Cached verdicts are only valid for the classifier, dateutil and model that produced them.
+    """
+    meta = getattr(nlp, "meta", {})
+    model = f"{meta.get('lang', '?')}_{meta.get('name', '?')}-{meta.get('version', '?')}"
+    return f"classifier-{CLASSIFIER_VERSION}/dateutil-{dateutil.__version__}/{model}"
+
+class VerdictCache:
+    """
+    Persistent dateline verdicts for lines that needed dateutil or spaCy, stored in
+    SQLite and keyed by (namespace, stripped line). The current namespace is read
+    into memory on open; close() writes new verdicts, bumps the last-used run of
+    every hit and evicts the least recently used rows above max_entries.
+    """
+
+    def __init__(self, path, namespace, max_entries=200000):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "namespace TEXT NOT NULL, line TEXT NOT NULL, verdict INTEGER NOT NULL, last_used INTEGER NOT NULL, "
+            "PRIMARY KEY (namespace, line))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)")
+        self.run = (self.conn.execute("SELECT MAX(last_used) FROM verdicts").fetchone()[0] or 0) + 1
+        self.verdicts = dict(self.conn.execute("SELECT line, verdict FROM verdicts WHERE namespace = ?", (namespace,)))
+        self._used = set()
+        self._new = {}
+        logging.info(f"Verdict cache {path}: {len(self.verdicts)} verdicts for {namespace}")
+
+    def get(self, stripped):
+        verdict = self.verdicts.get(stripped)
+        if verdict is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(stripped)
+        return bool(verdict)
+
+    def put(self, stripped, verdict):
+        self.verdicts[stripped] = int(verdict)
+        self._new[stripped] = int(verdict)
+
+    def close(self):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO verdicts (namespace, line, verdict, last_used) VALUES (?, ?, ?, ?)",
+                ((self.namespace, line, verdict, self.run) for line, verdict in self._new.items()),
+            )
+            self.conn.executemany(
+                "UPDATE verdicts SET last_used = ? WHERE namespace = ? AND line = ?",
+                ((self.run, self.namespace, line) for line in self._used),
+            )
+            count = self.conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                logging.info(f"Verdict cache: evicted {count - self.max_entries} least recently used verdicts")
+        self.conn.close()
+
+    def report(self):
+        return f"Verdict cache: {self.hits} hits, {self.misses} misses, {len(self._new)} new verdicts"
+
+def _is_calendar_word(word):
+    return _DATEUTIL_INFO.month(word) is not None or _DATEUTIL_INFO.weekday(word) is not None
+
+def _dateutil_parse(stripped):
+    try:
+        return parser.parse(stripped, fuzzy=False, default=None)
+    except Exception:
+        return None
+
+def parse_dateline(dateline, default=None):
+    """
+    The date and time a dateline stands for, or None when it has none dateutil can
+    read. Fields the line leaves out (usually the year) are taken from default,
+    e.g. the date of the previous entry. "Week N" counters are ignored, and
+    results outside 1900-2100 are rejected.
+    """
+    cleaned = WEEK_NUMBER_RE.sub(" ", dateline).strip(" \t:,-–—|")
+    if not cleaned:
+        return None
+    if default is None:
+        default = datetime(datetime.now().year, 1, 1)
+    default = default.replace(hour=0, minute=0, second=0, microsecond=0)
+    for fuzzy in (False, True):
+        try:
+            parsed = parser.parse(cleaned, fuzzy=fuzzy, default=default)
+        except (ValueError, OverflowError):
+            continue
+        return parsed if 1900 <= parsed.year <= 2100 else None
+    return None
+
+def _spacy_accepts(stripped, doc):
+    for ent in doc.ents:
+        if ent.label_ == "DATE" and ent.text == stripped:
+            # Additional check: require at least one digit or month name in the string
+            if re.search(r"\d", stripped) or MONTH_NAME_RE.search(stripped):
+                return True
+    return False
+
+def _heuristic_reject(stripped):
+    """
+    Cheap rejections shared by every classifier path.
     """
-    import re
-    stripped = line.strip()
     if not stripped:
-        return False
+        return True
     # Heuristic: skip lines that are only digits or too short to be a date
     if stripped.isdigit() or len(stripped) < 5:
-        return False
+        return True
     # Heuristic: require at least one alphabetic character (for month names, etc.)
     if not any(c.isalpha() for c in stripped):
-        return False
+        return True
     # Reject likely base64 (long, no spaces, mostly alphanum + /+=)
     if len(stripped) > 30 and " " not in stripped:
-        if re.fullmatch(r"[A-Za-z0-9+/=]+", stripped):
-            return False
+        if BASE64_LINE_RE.fullmatch(stripped):
+            return True
+    return False
+
+def is_date_line(line, nlp):
+    """
+    Returns True if the line is likely to be a date line.
+    Uses spaCy NER and dateutil.parser for robustness.
+    This is the reference verdict; DateLineClassifier must agree with it.
+    """
+    stripped = line.strip()
+    if _heuristic_reject(stripped):
+        return False
     # Try parsing with dateutil
-    try:
-        dt = parser.parse(stripped, fuzzy=False, default=None)
+    if _dateutil_parse(stripped) is not None:
         return True
-    except Exception:
-        pass
     # Use spaCy NER
-    doc = nlp(stripped)
-    for ent in doc.ents:
-        if ent.label_ == "DATE" and ent.text == stripped:
-            # Additional check: require at least one digit or month name in the string
-            if re.search(r"\d", stripped) or re.search(r"\b(January|February|March|April|May|June|July|August|September|October|November|December|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\b", stripped, re.IGNORECASE):
-                return True
-    return False
+    return _spacy_accepts(stripped, nlp(stripped))
 
-def extract_date_lines(filepath):
-    nlp = load_spacy_model()
-    with open(filepath, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    import json
-    diary_entries = []
-    total = len(lines)
-    logging.info(f"Processing {total} lines...")
-    # First, collect all date line indices, log progress every 10,000 lines
-    date_indices = []
-    import re
-    i = 0
-    inside_image_block = False
-    image_start = None
-    image_type = None
-    base64_data = ''
-    image_end = None
-    while i < total:
-        line = lines[i]
-        stripped = line.strip()
-        if (i+1) % 10000 == 0:
-            logging.info(f"Progress: processed {i+1}/{total} lines...")
-        # Detect start of image block
-        if not inside_image_block and stripped.startswith("![](data:image/"):
-            logging.info(f"Semantic element detected: IMAGE at line {i+1}")
-            image_type = None
-            base64_start = line.find('base64,')
-            try:
-                image_type = line.split('![](data:image/')[1].split(';')[0]
-            except Exception:
-                image_type = 'unknown'
-                logging.warning(f"Failed to parse image type at line {i+1}: {line.strip()}")
-            image_start = i
-            image_end = i
-            base64_data = ''
-            # Check if image ends on this line
-            if ')' in line:
-                base64_data = line[base64_start+7:line.find(')')].strip() if base64_start != -1 else ''
-                image_end = i
-                size_bytes = int(len(base64_data) * 3 / 4) if base64_data else 0
-                image_snippet = base64_data[:40] + ('...' if len(base64_data) > 40 else '')
-                logging.info(f"Image detected at lines {image_start+1}-{image_end+1}: type={image_type}, size~{size_bytes} bytes, snippet='{image_snippet}'")
-                i += 1
+class DateLineClassifier:
+    """
+    Tiered version of is_date_line. Each line is decided by the first tier that can:
+
+      heuristic  the cheap checks from is_date_line (blank, short, no letters, base64)
+      prefilter  lines that cannot be dates: longer than max_length, sentence
+                 punctuation, or no digit / month / weekday token at all
+      cache      verdict stored by an earlier run (optional VerdictCache)
+      template   same token shape as a line dateutil already confirmed, with
+                 in-range numbers for the date fields they stood for
+      dateutil   dateutil.parser, skipped when a word is one dateutil cannot accept
+      spacy      whole-line DATE entity from spaCy NER
+
+    Only the last two tiers cost real time, and their verdicts are what the cache
+    stores. `stats` counts lines per tier.
+    """
+
+    TIERS = ("heuristic", "prefilter", "cache", "template", "dateutil", "spacy")
+
+    def __init__(self, nlp, max_length=80, max_templates=32, cache=None):
+        self.nlp = nlp
+        self.cache = cache
+        self.max_length = max_length
+        self.max_templates = max_templates
+        self.templates = {}
+        # dateutil fills missing fields from today's date (default=None)
+        self._default_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.stats = dict.fromkeys(self.TIERS, 0)
+        self.positives = dict.fromkeys(self.TIERS, 0)
+
+    def _record(self, tier, verdict):
+        self.stats[tier] += 1
+        if verdict:
+            self.positives[tier] += 1
+        return verdict
+
+    def _prefilter_reject(self, stripped):
+        if len(stripped) > self.max_length:
+            return True
+        if SENTENCE_PUNCT_RE.search(stripped):
+            return True
+        # Both dateutil and the spaCy check need a digit or a month/weekday word
+        if any(c.isdigit() for c in stripped):
+            return False
+        return not any(_is_calendar_word(w) for w in ALPHA_TOKEN_RE.findall(stripped))
+
+    def _dateutil_possible(self, stripped):
+        # With fuzzy=False dateutil raises on any word it does not know; uppercase
+        # words of up to five letters may still be read as a timezone name, and
+        # "<month> of <x>" hands <x> to the year parser whatever it is.
+        tokens = TOKEN_RE.findall(stripped)
+        skip = set()
+        for idx, token in enumerate(tokens):
+            if idx in skip or not ALPHA_TOKEN_RE.fullmatch(token):
                 continue
-            else:
-                # Start accumulating image block
-                if base64_start != -1:
-                    base64_data = line[base64_start+7:].strip()
-                inside_image_block = True
-                image_end = i
-                i += 1
+            if _DATEUTIL_INFO.month(token) is not None:
+                if idx + 4 < len(tokens) and tokens[idx + 1].isspace() and tokens[idx + 3].isspace() and _DATEUTIL_INFO.pertain(tokens[idx + 2]):
+                    skip.add(idx + 4)
                 continue
-        elif inside_image_block:
-            # Accumulate base64 lines until closing parenthesis
-            base64_data += stripped
-            if ')' in line:
-                image_end = i
-                size_bytes = int(len(base64_data) * 3 / 4) if base64_data else 0
-                image_snippet = base64_data[:40] + ('...' if len(base64_data) > 40 else '')
-                logging.info(f"Image detected at lines {image_start+1}-{image_end+1}: type={image_type}, size~{size_bytes} bytes, snippet='{image_snippet}'")
-                inside_image_block = False
-                image_start = None
-                image_type = None
-                base64_data = ''
-                image_end = None
-                i += 1
+            if _is_calendar_word(token) or token.lower() in _DATEUTIL_WORDS:
                 continue
-            else:
-                i += 1
+            if len(token) <= 5 and token.isascii() and token.isupper():
                 continue
-        # Only run date detection on non-image lines
-        if is_date_line(line, nlp):
-            logging.info(f"Semantic element detected: DATELINE at line {i+1}")
-            logging.info(f"Date detected at line {i+1}: {line.strip()}")
-            # Log the next line for debugging/robustness
-            if i+1 < total:
-                next_line = lines[i+1].strip()
-                logging.info(f"  Next line after dateline: {next_line}")
+            return False
+        return True
+
+    def _learn(self, stripped, parsed):
+        """
+        Turns a line dateutil accepted into a template. Every number must map to
+        exactly one date field of the parse result, so a later match can be
+        re-checked with datetime instead of the parser; otherwise nothing is learned.
+        Only shapes where dateutil cannot swap fields are learned: a month name,
+        years of three or more digits, and at most one short number outside hh:mm:ss.
+        """
+        if len(self.templates) >= self.max_templates:
+            return
+        tokens = TOKEN_RE.findall(stripped)
+        if not any(_DATEUTIL_INFO.month(t) is not None for t in tokens):
+            return
+        short_numbers = 0
+        for idx, token in enumerate(tokens):
+            if token.isdecimal() and len(token) <= 2:
+                in_time = (idx > 0 and tokens[idx - 1] == ":") or (idx + 1 < len(tokens) and tokens[idx + 1] == ":")
+                short_numbers += not in_time
+        if short_numbers > 1:
+            return
+        values = {"year": parsed.year, "day": parsed.day,
+                  "hour": parsed.hour, "minute": parsed.minute, "second": parsed.second}
+        parts = []
+        roles = []
+        for token in tokens:
+            if token.isdecimal():
+                number = int(token)
+                fields = [f for f, v in values.items() if v == number]
+                if len(fields) != 1 or fields[0] in roles or (fields[0] == "year") != (len(token) >= 3):
+                    return
+                parts.append(r"(\d{%d})" % len(token))
+                roles.append(fields[0])
+            elif _DATEUTIL_INFO.month(token) is not None:
+                parts.append("(" + "|".join(n for names in _DATEUTIL_INFO.MONTHS for n in names) + ")")
+                roles.append("month_name")
+            elif _DATEUTIL_INFO.weekday(token) is not None:
+                parts.append("(?:" + "|".join(n for names in _DATEUTIL_INFO.WEEKDAYS for n in names) + ")")
             else:
-                logging.info(f"  No next line after dateline (end of file)")
-            date_indices.append(i)
-        i += 1
-
-    logging.info(f"Starting second pass: processing {len(date_indices)} diary entries...")
-    total_image_count = 0
-    total_image_bytes = 0
-    total_word_count = 0
-    for i, date_idx in enumerate(date_indices):
-        date_line = lines[date_idx].strip()
-        next_date_idx = date_indices[i + 1] if i + 1 < len(date_indices) else len(lines)
-        entry_text_lines = []
-        images = []
-        image_count = 0
-        image_total_size = 0
-        word_count = 0
-        # Log every diary entry (dateline) as it is processed
-        logging.info(f"Processing DIARY ENTRY {i+1}/{len(date_indices)}: dateline at line {date_idx+1}: {date_line}")
-        j = date_idx + 1
-        while j < next_date_idx:
-            content = lines[j].rstrip('\n')
-            if content.strip() == "":
-                j += 1
-                continue
-            # Handle inline images: split line at ![](data:image/
-            img_marker = "![](data:image/"
-            if img_marker in content:
-                img_start_idx = content.find(img_marker)
-                text_part = content[:img_start_idx].strip()
-                image_part = content[img_start_idx:]
-                # Add text before image (if any)
-                if text_part:
-                    entry_text_lines.append({
-                        "text": text_part,
-                        "line": j + 1,
-                        "filename": filepath
-                    })
-                    word_count += len(text_part.split())
-                # Now process image block
-                image_type = None
-                base64_start = image_part.find('base64,')
-                try:
-                    image_type = image_part.split('![](data:image/')[1].split(';')[0]
-                except Exception:
-                    image_type = 'unknown'
-                image_start = j
-                image_end = j
-                image_data = image_part
-                # If image is multi-line, accumulate until closing parenthesis
-                if ')' not in image_part:
-                    k = j + 1
-                    while k < next_date_idx:
-                        next_line = lines[k].rstrip('\n')
-                        image_data += '\n' + next_line
-                        if ')' in next_line:
-                            image_end = k
-                            break
-                        k += 1
-                    j = image_end
-                size_bytes = int(len(image_data) * 3 / 4) if base64_start != -1 else 0
-                images.append({
-                    "type": image_type,
-                    "image_data": image_data,
-                    "line_start": image_start + 1,
-                    "line_end": image_end + 1,
-                    "size_bytes": size_bytes,
-                    "filename": filepath
-                })
-                image_count += 1
-                image_total_size += size_bytes
-                j += 1
+                parts.append(re.escape(token))
+        shape = "".join(parts)
+        if shape not in self.templates:
+            self.templates[shape] = (re.compile(shape, re.IGNORECASE), tuple(roles))
+            logging.debug(f"Learned dateline template #{len(self.templates)}: {shape}")
+
+    def _template_accepts(self, stripped):
+        for pattern, roles in self.templates.values():
+            match = pattern.fullmatch(stripped)
+            if not match:
                 continue
-            # Otherwise, treat as text (skip image blocks)
-            entry_text_lines.append({
-                "text": content.strip(),
-                "line": j + 1,
-                "filename": filepath
-            })
-            word_count += len(content.strip().split())
-            j += 1
-        diary_entries.append({
-            "dateline": date_line,
-            "dateline_line": date_idx + 1,
-            "filename": filepath,
-            "text": entry_text_lines,
-            "images": images
-        })
-        total_image_count += image_count
-        total_image_bytes += image_total_size
-        total_word_count += word_count
-    logging.info(f"Finished second pass: processed {len(date_indices)} diary entries.")
-    logging.info(f"Finished processing {total} lines. {len(date_indices)} date-like lines found.")
-    logging.info(f"SUMMARY: {len(date_indices)} diary entries, {total_image_count} images, {total_word_count} words, {total_image_bytes} image bytes.")
-    return diary_entries
-
-def main():
-    import argparse
-    parser_ = argparse.ArgumentParser(description="Detect date-like lines in a markdown file using spaCy.")
-    parser_.add_argument("markdown_file", help="Path to the markdown file to process.")
-    parser_.add_argument("--log", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
-    args = parser_.parse_args()
-
-    logging.basicConfig(
-        level=getattr(logging, args.log.upper(), None),
-        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s'
-    )
+            fields = {}
+            for role, value in zip(roles, match.groups()):
+                if role == "month_name":
+                    fields["month"] = _DATEUTIL_INFO.month(value)
+                else:
+                    fields[role] = int(value)
+            try:
+                self._default_date.replace(**fields)
+                return True
+            except ValueError:
+                # Out-of-range numbers (March 32): let dateutil decide
+                return False
+        return False
 
-    import os
-    filepath = args.markdown_file
-    output_json = os.path.splitext(filepath)[0] + '.json'
-    diary_entries = extract_date_lines(filepath)
-    # Compute metadata
-    total_entries = len(diary_entries)
-    total_lines = 0
-    total_images = 0
-    total_words = 0
-    total_image_bytes = 0
-    line_min = None
-    line_max = None
-    for entry in diary_entries:
-        if entry["text"]:
-            for t in entry["text"]:
-                line_num = t["line"]
-                if line_min is None or line_num < line_min:
-                    line_min = line_num
-                if line_max is None or line_num > line_max:
-                    line_max = line_num
-                total_lines += 1
-                total_words += len(t["text"].split())
-        if entry["images"]:
-            for img in entry["images"]:
-                total_images += 1
-                total_image_bytes += img.get("size_bytes", 0)
-                if line_min is None or img["line_start"] < line_min:
-                    line_min = img["line_start"]
-                if line_max is None or img["line_end"] > line_max:
-                    line_max = img["line_end"]
-    first_entry = diary_entries[0]["dateline"] if diary_entries else None
-    last_entry = diary_entries[-1]["dateline"] if diary_entries else None
-    metadata = {
-        "num_entries": total_entries,
-        "line_range": [line_min, line_max],
-        "total_images": total_images,
-        "total_words": total_words,
-        "total_image_bytes": total_image_bytes,
-        "first_entry": first_entry,
-        "last_entry": last_entry
-    }
-    output = {
-        "metadata": metadata,
-        "entries": diary_entries
-    }
-    logging.info(f"Metadata: {metadata}")
-    # Write to JSON file
-    logging.info(f"Writing structured diary entries to {output_json}")
-    import json
-    with open(output_json, 'w', encoding='utf-8') as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
-    logging.info(f"Wrote structured diary entries to {output_json}")
+    def classify_fast(self, line):
+        """
+        Returns (stripped, verdict, tier) using every tier except spaCy.
+        verdict is None when only spaCy NER can decide the line.
+        """
+        stripped = line.strip()
+        if _heuristic_reject(stripped):
+            return stripped, self._record("heuristic", False), "heuristic"
+        if self._prefilter_reject(stripped):
+            return stripped, self._record("prefilter", False), "prefilter"
+        if self.cache is not None:
+            verdict = self.cache.get(stripped)
+            if verdict is not None:
+                return stripped, self._record("cache", verdict), "cache"
+        if self._template_accepts(stripped):
+            return stripped, self._record("template", True), "template"
+        parsed = _dateutil_parse(stripped) if self._dateutil_possible(stripped) else None
+        if parsed is not None:
+            self._learn(stripped, parsed)
+            if self.cache is not None:
+                self.cache.put(stripped, True)
+            return stripped, self._record("dateutil", True), "dateutil"
+        return stripped, None, "spacy"
+
+    def classify_ner(self, stripped, doc=None):
+        """
+        Final tier: spaCy NER on a line classify_fast could not decide.
+        """
+        if doc is None:
+            doc = self.nlp(stripped)
+        verdict = _spacy_accepts(stripped, doc)
+        if self.cache is not None:
+            self.cache.put(stripped, verdict)
+        return self._record("spacy", verdict)
+
+    def classify_ner_batch(self, texts, batch_size=256, n_process=1):
+        """
+        Final tier for many lines at once through nlp.pipe; yields verdicts in order.
+        n_process=-1 uses every CPU core.
+        """
+        docs = self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+        for stripped, doc in zip(texts, docs):
+            yield self.classify_ner(stripped, doc)
+
+    def __call__(self, line):
+        stripped, verdict, _ = self.classify_fast(line)
+        if verdict is None:
+            verdict = self.classify_ner(stripped)
+        return verdict
+
+    def report(self):
+        total = sum(self.stats.values())
+        parts = [f"{tier}={self.stats[tier]} ({self.positives[tier]} dates)" for tier in self.TIERS]
+        return f"Dateline classifier: {total} lines decided: " + ", ".join(parts) + f"; {len(self.templates)} templates learned"
 
 if __name__ == "__main__":
+    # detect_dates.py used to carry its own copy of the converter
+    from diary_markdown2json import main
     main()
-import logging
-import spacy
-from dateutil import parser
-
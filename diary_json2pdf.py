@@ -1,27 +1,19 @@
-import fpdf
-from fpdf import FPDF
-from PDFRounded import PDFRounded as FPDF
-
-print(fpdf.__file__)
-print(fpdf.__version__)
-
-from PIL import Image
 import json
 import io
 import os
 import base64
+import hashlib
 import logging 
 import argparse
 import re
+import collections
+import concurrent.futures
+import itertools
+import run_metrics
+from image_store import decoded_size
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s [%(name)s][Line %(lineno)d]: %(message)s'
-)
-
-logging.getLogger("fpdf").setLevel(logging.WARNING)
-logging.getLogger("fontTools").setLevel(logging.WARNING)
-logging.getLogger("PIL").setLevel(logging.WARNING)
+# fpdf (which imports PIL and fontTools) and PIL are imported where first used, so
+# planning a build or printing --help does not pay for them
 
 GAP_BETWEEN_ENTRIES_MM = 12  # or any value in millimeters you prefer
 
@@ -44,23 +36,331 @@ def mm_to_px(mm):
 def px_to_mm(px):
     return px * 25.4 / DPI
 
+# Part of every processed-image cache key; bump when resizing or encoding changes
+IMAGE_PIPELINE_VERSION = 2
+JPEG_SAVE_OPTIONS = {}  # PIL defaults (quality 75)
+# Largest image (in decoded pixels) prepared for the PDF, larger ones being left out;
+# 0: no cap of our own, only PIL's decompression bomb check
+MAX_IMAGE_PIXELS = 0
+# Reductions libjpeg can apply while decoding (see PIL's Image.draft)
+JPEG_DRAFT_SCALES = (1, 2, 4, 8)
+# resize() first reduces by a whole factor (a box filter) down to this many times
+# the target size, then resamples with LANCZOS
+REDUCING_GAP = 3.0
+BASE64_PAYLOAD_RE = re.compile(r'[A-Za-z0-9+/=\n\r]+')
+
+def decode_scale(image_format, size, max_w_px=None, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Factor an image is reduced by while it is decoded: for JPEG the largest DCT
+    scale that keeps it at least max_w_px wide, raised when needed to stay within
+    max_pixels; 1 for other formats, which are always decoded whole. None when the
+    image cannot be decoded within max_pixels (0 or None: no limit).
+    """
+    w, h = size
+    scales = JPEG_DRAFT_SCALES if image_format == "JPEG" else (1,)
+    within = [s for s in scales if not max_pixels or ((w + s - 1) // s) * ((h + s - 1) // s) <= max_pixels]
+    if not within:
+        return None
+    scale = within[0]
+    if max_w_px:
+        scale = max(scale, max((s for s in scales if w // s >= max_w_px and h // s > 0), default=1))
+    return scale
+
+def decode_image_bytes(img_bytes, source, max_w_px=None, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Decodes an image for resizing to max_w_px wide (None: full size). JPEGs are
+    reduced while decoding (see decode_scale), palette and alpha images become RGB,
+    and the color mode is otherwise kept: CMYK conversion is left for after the
+    resize. Returns (image, full-size (w, h)), or None when the image cannot be
+    decoded or is larger than max_pixels.
+    """
+    from PIL import Image
+    try:
+        with run_metrics.stage("image_decode"):
+            img = Image.open(io.BytesIO(img_bytes))
+            size = img.size
+            scale = decode_scale(img.format, size, max_w_px, max_pixels)
+            if scale is None:
+                run_metrics.count("images_over_pixel_cap")
+                logging.error(f"decode_image_bytes: {size[0]}x{size[1]} {img.format} image exceeds {max_pixels} pixels; leaving it out\nImage source: {source}")
+                return None
+            if scale > 1:
+                run_metrics.count("images_reduced_on_decode")
+                img.draft(None, (size[0] // scale, size[1] // scale))
+            img.load()
+        if img.mode not in ("RGB", "L", "CMYK"):
+            with run_metrics.stage("image_convert"):
+                img = img.convert("RGB")
+        return img, size
+    except Exception as e:
+        logging.error(f"decode_image_bytes error: {e}\nImage source: {source}")
+        return None
+
 def decode_base64_image(image_data, image_type):
     # Extract base64 from markdown-style ![](data:image/TYPE;base64,....)
-    import re
+    img_bytes = base64_image_bytes(image_data)
+    if img_bytes is None:
+        return None
+    decoded = decode_image_bytes(img_bytes, f"{image_data[:100]}...")
+    if decoded is None:
+        return None
+    # Convert to CMYK for print
+    img, _ = decoded
+    return img if img.mode == "CMYK" else img.convert("CMYK")
+
+def base64_image_bytes(image_data):
+    # The payload runs from "base64," to the closing parenthesis; it is sliced out
+    # once rather than copied by a regex group
+    start = image_data.find('base64,') + 7
+    end = image_data.find(')', start) if start >= 7 else -1
+    if end == -1 or not BASE64_PAYLOAD_RE.fullmatch(image_data, start, end):
+        return _base64_image_bytes_search(image_data)
+    try:
+        return base64.b64decode(image_data[start:end])
+    except Exception as e:
+        logging.error(f"base64_image_bytes error: {e}\nImage data: {image_data[:100]}...")
+        return None
+
+def _base64_image_bytes_search(image_data):
+    # Data URIs with other characters in the payload: the first well-formed one, if any
     match = re.search(r'base64,([A-Za-z0-9+/=\n\r]+)\)', image_data)
     if not match:
         return None
-    b64 = match.group(1)
     try:
-        img_bytes = base64.b64decode(b64)
-        img = Image.open(io.BytesIO(img_bytes))
-        # Convert to CMYK for print
-        if img.mode != "CMYK":
-            img = img.convert("CMYK")
-        return img
+        return base64.b64decode(match.group(1))
     except Exception as e:
-        logging.error(f"decode_base64_image error: {e}\nImage data: {image_data[:100]}...")
+        logging.error(f"base64_image_bytes error: {e}\nImage data: {image_data[:100]}...")
+        return None
+
+def image_source_bytes(img, json_dir):
+    """Raw bytes of a diary image: inline base64 image_data, a stored image_path or a diary store blob."""
+    if img.get("store"):
+        # Image blob of an SQLite diary store (diary_markdown2json.py --sqlite)
+        from diary_store import store_image_bytes
+        img_bytes = store_image_bytes(img["store"], img["sha256"])
+        if img_bytes is None:
+            logging.error(f"image_source_bytes error: {img['sha256']} missing from {img['store']}")
+        return img_bytes
+    if img.get("image_path"):
+        # Image written to the content-addressed store by diary_markdown2json.py --image_store
+        try:
+            with open(os.path.join(json_dir, img["image_path"]), "rb") as f:
+                return f.read()
+        except OSError as e:
+            logging.error(f"image_source_bytes error: {e}")
+            return None
+    return base64_image_bytes(img.get("image_data", ""))
+
+def process_image(img_bytes, max_w_px, source="", max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Decodes the image (reduced while decoding where the format allows), resizes it
+    to max_w_px wide, converts it to CMYK and encodes it as JPEG. Returns
+    (jpeg_bytes, new_w_px, new_h_px), or None when the image cannot be decoded
+    or exceeds max_pixels.
+    """
+    run_metrics.count("images_processed")
+    run_metrics.count("image_source_bytes", len(img_bytes))
+    decoded = decode_image_bytes(img_bytes, source, max_w_px, max_pixels)
+    if not decoded:
         return None
+    from PIL import Image
+    pil_img, (w, h) = decoded
+    # The output size follows the full-size image, however far it was reduced
+    ratio = max_w_px / w if w > 0 else 1
+    new_w_px = int(w * ratio)
+    new_h_px = int(h * ratio)
+    with run_metrics.stage("image_resize"):
+        pil_img = pil_img.resize((new_w_px, new_h_px), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+    # Convert to CMYK for print
+    if pil_img.mode != "CMYK":
+        with run_metrics.stage("image_convert"):
+            pil_img = pil_img.convert("CMYK")
+    with run_metrics.stage("image_encode"):
+        img_buffer = io.BytesIO()
+        pil_img.save(img_buffer, format="JPEG", **JPEG_SAVE_OPTIONS)
+    return img_buffer.getvalue(), new_w_px, new_h_px
+
+def process_image_measured(img_bytes, max_w_px, source="", max_pixels=MAX_IMAGE_PIXELS):
+    """process_image in a worker process: returns (result, metrics snapshot) for the parent to merge."""
+    with run_metrics.collecting(enabled=True) as run:
+        result = process_image(img_bytes, max_w_px, source, max_pixels)
+    return result, run.metrics.snapshot()
+
+def processed_image_key(source_sha256, max_w_px, max_pixels=MAX_IMAGE_PIXELS):
+    encoder = ",".join(f"{k}={v}" for k, v in sorted(JPEG_SAVE_OPTIONS.items())) or "default"
+    # A capped run only hits images processed under the same cap, so one cached
+    # by an uncapped run cannot bring back an image the cap leaves out
+    cap = f":max{max_pixels}px" if max_pixels else ""
+    return f"{source_sha256}:w{max_w_px}:dpi{DPI}:CMYK:JPEG[{encoder}]{cap}:v{IMAGE_PIPELINE_VERSION}"
+
+def image_label(img):
+    if img.get("store"):
+        return f"{img['store']}:{img['sha256']}"
+    return img.get("image_path") or f"{img.get('image_data', '')[:100]}..."
+
+# Color modes of the source JPEGs each --image_passthrough policy embeds unchanged:
+# none, those already in print CMYK, or any fpdf can embed as they are
+IMAGE_PASSTHROUGH_POLICIES = {"off": (), "cmyk": ("CMYK",), "any": ("CMYK", "RGB", "L")}
+
+class ImagePassthrough:
+    """
+    Picks the source images embedded in the PDF as their original bytes instead of
+    being decoded and re-encoded: JPEGs no wider than the column at DPI (process_image
+    would only scale them up) in a color mode the policy allows. CMYK JPEGs must
+    carry Adobe's marker, as fpdf embeds them with inverted values. JPEGs over
+    max_pixels go through process_image, which applies the cap. Counts the images
+    that took this path.
+    """
+
+    def __init__(self, policy="cmyk", max_pixels=MAX_IMAGE_PIXELS):
+        self.policy = policy
+        self.max_pixels = max_pixels
+        self.modes = IMAGE_PASSTHROUGH_POLICIES[policy]
+        self.passed = 0
+
+    def candidate(self, img, max_w_px):
+        """Whether img may pass through, judged from its JSON fields alone."""
+        if not self.modes or (img.get("type") or "").lower() not in ("jpeg", "jpg"):
+            return False
+        return not img.get("width") or img["width"] <= max_w_px
+
+    def check(self, img_bytes, max_w_px):
+        """(img_bytes, new_w_px, new_h_px) when the image passes through at max_w_px wide, else None."""
+        from PIL import Image
+        try:
+            with Image.open(io.BytesIO(img_bytes)) as pil_img:
+                if pil_img.format != "JPEG" or pil_img.mode not in self.modes:
+                    return None
+                if pil_img.mode == "CMYK" and "adobe" not in pil_img.info:
+                    return None
+                w, h = pil_img.size
+        except Exception:
+            return None
+        if not 0 < w <= max_w_px or (self.max_pixels and w * h > self.max_pixels):
+            return None
+        self.passed += 1
+        run_metrics.count("images_passthrough")
+        # Laid out exactly as process_image would size it
+        ratio = max_w_px / w
+        return img_bytes, int(w * ratio), int(h * ratio)
+
+    def report(self):
+        return f"Image passthrough ({self.policy}): {self.passed} images embedded unchanged"
+
+def lookup_image(img, json_dir, max_w_px, cache=None, passthrough=None, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Cache half of prepare_image. Returns (cached, img_bytes, key): the processed image
+    on a cache hit or the original image when passthrough (an ImagePassthrough)
+    accepts it; otherwise the source bytes to hand to process_image (None when
+    unreadable) and the cache key to store the result under (None without a cache).
+    Stored images are looked up by their sha256 without reading the file; inline
+    ones are hashed after base64 decoding; the key includes max_pixels when set.
+    """
+    with run_metrics.stage("image_lookup"):
+        img_bytes = None
+        key = None
+        if passthrough is not None and passthrough.candidate(img, max_w_px):
+            img_bytes = image_source_bytes(img, json_dir)
+            if img_bytes is None:
+                return None, None, None
+            passed = passthrough.check(img_bytes, max_w_px)
+            if passed is not None:
+                return passed, None, None
+        if cache is not None:
+            source_sha256 = img.get("sha256")
+            if not source_sha256:
+                if img_bytes is None:
+                    img_bytes = image_source_bytes(img, json_dir)
+                if img_bytes is None:
+                    return None, None, None
+                source_sha256 = hashlib.sha256(img_bytes).hexdigest()
+            key = processed_image_key(source_sha256, max_w_px, max_pixels)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached, None, key
+        if img_bytes is None:
+            img_bytes = image_source_bytes(img, json_dir)
+        return None, img_bytes, key
+
+def prepare_image(img, json_dir, max_w_mm, cache=None, max_pixels=MAX_IMAGE_PIXELS, passthrough=None):
+    """
+    Returns (jpeg_bytes, new_w_px, new_h_px) for a diary image at the column width,
+    from the processed-image cache when possible.
+    """
+    max_w_px = mm_to_px(max_w_mm)
+    cached, img_bytes, key = lookup_image(img, json_dir, max_w_px, cache, passthrough, max_pixels)
+    if cached is not None or img_bytes is None:
+        return cached
+    processed = process_image(img_bytes, max_w_px, image_label(img), max_pixels)
+    if processed is not None and key is not None:
+        cache.put(key, *processed)
+    return processed
+
+def iter_prepared_entries(entries, json_dir, widths_px, cache=None, executor=None, lookahead=16, max_pixels=MAX_IMAGE_PIXELS, passthrough=None):
+    """
+    Yields (entry, {width_px: prepared_images}) in input order, preparing every image
+    of the entry once per distinct target width. With an executor, the images of the
+    next entries are processed by its worker processes while the caller lays out the
+    current one; at most `lookahead` images are in flight and the same image appearing
+    twice in that window is processed once. Cache lookups and stores stay in the
+    calling process, as does the passthrough check (see ImagePassthrough). Worker
+    timings are merged into the active run_metrics.
+    """
+    pending = collections.deque()
+    in_flight = {}
+    num_in_flight = 0
+    metrics = run_metrics.active()
+    process = process_image_measured if metrics.enabled else process_image
+
+    def collect(jobs):
+        prepared = {width_px: [] for width_px in widths_px}
+        for width_px, result, key in jobs:
+            if isinstance(result, concurrent.futures.Future):
+                # A future shared by two jobs is stored and counted once
+                first = key is None or in_flight.pop(key, None) is not None
+                with metrics.stage("wait_image_workers"):
+                    result = result.result()
+                if metrics.enabled:
+                    result, snapshot = result
+                    if first:
+                        metrics.merge(snapshot)
+                if result is not None and key is not None and first:
+                    cache.put(key, *result)
+            prepared[width_px].append(result)
+        return prepared
+
+    for entry in entries:
+        jobs = []
+        submitted = 0
+        for img in entry.get("images", []):
+            for width_px in widths_px:
+                cached, img_bytes, key = lookup_image(img, json_dir, width_px, cache, passthrough, max_pixels)
+                if cached is not None or img_bytes is None:
+                    jobs.append((width_px, cached, None))
+                    continue
+                if executor is None:
+                    processed = process_image(img_bytes, width_px, image_label(img), max_pixels)
+                    if processed is not None and key is not None:
+                        cache.put(key, *processed)
+                    jobs.append((width_px, processed, None))
+                    continue
+                future = in_flight.get(key) if key is not None else None
+                if future is None:
+                    future = executor.submit(process, img_bytes, width_px, image_label(img), max_pixels)
+                    if key is not None:
+                        in_flight[key] = future
+                    submitted += 1
+                jobs.append((width_px, future, key))
+        pending.append((entry, jobs, submitted))
+        num_in_flight += submitted
+        while pending and (executor is None or num_in_flight > lookahead):
+            done_entry, done_jobs, done_submitted = pending.popleft()
+            num_in_flight -= done_submitted
+            yield done_entry, collect(done_jobs)
+    while pending:
+        done_entry, done_jobs, _ = pending.popleft()
+        yield done_entry, collect(done_jobs)
+
 def pt_to_mm(pt):
     """Convert points to millimeters."""
     return pt * 0.352778
@@ -68,12 +368,16 @@ def pt_to_mm(pt):
 def inch_to_mm(inch):
     return inch * 25.4
 
-def add_entry_to_pdf(pdf, entry, config):
+def entry_layout(config):
+    """
+    Dimensions in mm that add_entry_to_pdf lays an entry out with: the text column
+    width, the dateline rectangle, the gap below it, the text line height and the
+    minimum block (dateline + gap + min_text_lines lines) that must fit on the page.
+    """
     margin = config.get("margin_mm", 8.89)
     page_w = config["page_size"][0]
     page_h = config["page_size"][1]
     avail_w_mm = page_w - 2 * margin
-    rect_corner_radius = config.get("rect_corner_radius_mm", 2)  # Default 2mm radius
 
     # Heights
     rect_height_mm = pt_to_mm(config["date_font_size"]) * config["line_spacing"] * 1.5
@@ -83,6 +387,28 @@ def add_entry_to_pdf(pdf, entry, config):
     # Minimum block: dateline + gap + at least 5 lines of text
     min_text_lines = 5
     min_block_height = rect_height_mm + date_gap_mm + (line_height_mm * min_text_lines)
+    return {
+        "margin": margin,
+        "page_w": page_w,
+        "page_h": page_h,
+        "avail_w_mm": avail_w_mm,
+        "rect_height_mm": rect_height_mm,
+        "date_gap_mm": date_gap_mm,
+        "line_height_mm": line_height_mm,
+        "min_block_height": min_block_height,
+    }
+
+def add_entry_to_pdf(pdf, entry, config, prepared_images=None):
+    layout = entry_layout(config)
+    margin = layout["margin"]
+    page_w = layout["page_w"]
+    page_h = layout["page_h"]
+    avail_w_mm = layout["avail_w_mm"]
+    rect_corner_radius = config.get("rect_corner_radius_mm", 2)  # Default 2mm radius
+    rect_height_mm = layout["rect_height_mm"]
+    date_gap_mm = layout["date_gap_mm"]
+    line_height_mm = layout["line_height_mm"]
+    min_block_height = layout["min_block_height"]
 
     current_y = pdf.get_y()
     usable_page_height = page_h - margin
@@ -120,36 +446,36 @@ def add_entry_to_pdf(pdf, entry, config):
     pdf.set_xy(margin, pdf.get_y())
     pdf.set_font(config["text_font"], size=config["text_font_size"])
     logging.debug(f"Adding text for entry: {config['text_font']}")
-    for text_obj in entry["text"]:
-        paragraph = text_obj["text"]
-        try:
-            pdf.multi_cell(avail_w_mm, line_height_mm, paragraph)
-            pdf.ln(line_height_mm)
-        except Exception as e:
-            logging.error(
-                f"[FPDFException] {e}\n"
-                f"Problematic text: {repr(paragraph)}\n"
-                f"Dateline: {repr(entry['dateline'])}\nFull text_obj: {repr(text_obj)}"
-            )
+    text_layout = config.get("text_layout")
+    with run_metrics.stage("text_layout"):
+        for text_obj in entry["text"]:
+            paragraph = text_obj["text"]
+            try:
+                if text_layout is None or not text_layout.write(pdf, avail_w_mm, line_height_mm, paragraph):
+                    pdf.multi_cell(avail_w_mm, line_height_mm, paragraph)
+                pdf.ln(line_height_mm)
+            except Exception as e:
+                logging.error(
+                    f"[FPDFException] {e}\n"
+                    f"Problematic text: {repr(paragraph)}\n"
+                    f"Dateline: {repr(entry['dateline'])}\nFull text_obj: {repr(text_obj)}"
+                )
 
     # Images
     for idx, img in enumerate(entry.get("images", [])):
-        image_type = img.get("type", "png")
-        image_data = img.get("image_data", "")
-        pil_img = decode_base64_image(image_data, image_type)
-        if pil_img:
-            max_w_mm = avail_w_mm
-            w, h = pil_img.size
-            max_w_px = mm_to_px(max_w_mm)
-            ratio = max_w_px / w if w > 0 else 1
-            new_w_px = int(w * ratio)
-            new_h_px = int(h * ratio)
-            pil_img = pil_img.resize((new_w_px, new_h_px), Image.LANCZOS)
-            img_buffer = io.BytesIO()
-            pil_img.save(img_buffer, format="JPEG")
-            img_buffer.seek(0)
+        max_w_mm = avail_w_mm
+        if prepared_images is not None:
+            prepared = prepared_images[idx]
+        else:
+            prepared = prepare_image(
+                img, config["json_dir"], max_w_mm, config.get("image_cache"), config.get("max_image_pixels", MAX_IMAGE_PIXELS), config.get("image_passthrough")
+            )
+        if prepared:
+            jpeg_bytes, _, new_h_px = prepared
+            img_buffer = io.BytesIO(jpeg_bytes)
             try:
-                pdf.image(img_buffer, x=margin, w=max_w_mm, h=px_to_mm(new_h_px))
+                with run_metrics.stage("image_embed"):
+                    pdf.image(img_buffer, x=margin, w=max_w_mm, h=px_to_mm(new_h_px))
                 pdf.ln(px_to_mm(new_h_px) + line_height_mm)
             except Exception as e:
                 logging.error(
@@ -158,122 +484,654 @@ def add_entry_to_pdf(pdf, entry, config):
                 )
     pdf.ln(GAP_BETWEEN_ENTRIES_MM)
 
-def get_date_range_from_json(json_path):
-    """Extract the first and last date from the JSON entries."""
-    import json
-    with open(json_path, "r", encoding="utf-8") as f:
-        diary = json.load(f)
-    dates = []
-    for entry in diary.get("entries", []):
+def new_text_layout(fonts):
+    """The TextLayout of a run, sharing the word widths kept by the FontRegistry's cache; None with an untested fpdf."""
+    from font_registry import fpdf_internals_supported
+    if not fpdf_internals_supported():
+        return None
+    from text_layout import TextLayout
+    return TextLayout(fonts.cache)
+
+def image_header_size(img, json_dir, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    (width_px, height_px) of a diary image from its file header (or its JSON
+    metadata, when that also says it fits max_pixels), without decoding pixels;
+    None when the image would fail to load or exceed max_pixels.
+    """
+    from PIL import Image
+    if (img.get("image_path") or img.get("store")) and img.get("width") and img.get("height"):
+        # JPEGs are reduced while decoding, so only their 1/8 scale has to fit
+        if not max_pixels or img["width"] * img["height"] <= max_pixels:
+            return img["width"], img["height"]
+    img_bytes = image_source_bytes(img, json_dir)
+    if img_bytes is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as pil_img:
+            if decode_scale(pil_img.format, pil_img.size, None, max_pixels) is None:
+                return None
+            return pil_img.size
+    except Exception as e:
+        logging.warning(f"image_header_size error: {e}\nImage source: {image_label(img)}")
+        return None
+
+class PagePlan:
+    """
+    Where add_entry_to_pdf would leave one variant, tracked without drawing: the
+    current page and y. Page breaks follow fpdf's rule for cells, text lines and
+    images (break when y + height passes the bottom margin) and add_entry_to_pdf's
+    min_text_lines rule for datelines. t_margin and b_margin are fpdf's defaults
+    as read from a document (1 cm and 2 cm).
+    """
+
+    def __init__(self, config, t_margin, b_margin):
+        self.config = config
+        self.layout = entry_layout(config)
+        self.t_margin = t_margin
+        self.page_break_trigger = self.layout["page_h"] - b_margin
+        self.page = 1
+        self.y = t_margin
+        self.entry_pages = []
+        # Entries the min_text_lines rule moved to a new page: nothing before them affects their layout
+        self.forced_breaks = []
+
+    def _break_if_needed(self, h):
+        if self.y + h > self.page_break_trigger:
+            self.page += 1
+            self.y = self.t_margin
+
+    def add_entry(self, entry, line_counts, image_sizes):
+        """
+        line_counts: wrapped lines of each paragraph at this variant's font and column
+        width (None for paragraphs multi_cell failed on); image_sizes: header size of
+        each image, or None for images that are skipped.
+        """
+        layout = self.layout
+        line_height_mm = layout["line_height_mm"]
+        if layout["page_h"] - layout["margin"] - self.y < layout["min_block_height"]:
+            self.page += 1
+            self.y = layout["margin"]
+            self.forced_breaks.append(len(self.entry_pages))
+        self._break_if_needed(layout["rect_height_mm"])
+        self.entry_pages.append(self.page)
+        self.y += layout["date_gap_mm"]
+        for text_obj, count in zip(entry["text"], line_counts):
+            if count is None:
+                continue
+            num_lines, trailing_nl = count
+            for _ in range(num_lines):
+                self._break_if_needed(line_height_mm)
+                self.y += line_height_mm
+            if trailing_nl:
+                self.y += line_height_mm
+            self.y += line_height_mm
+        max_w_px = mm_to_px(layout["avail_w_mm"])
+        for size in image_sizes:
+            if size is None:
+                continue
+            w, h = size
+            ratio = max_w_px / w if w > 0 else 1
+            h_mm = px_to_mm(int(h * ratio))
+            self._break_if_needed(h_mm)
+            self.y += h_mm
+            self.y += h_mm + line_height_mm
+        self.y += GAP_BETWEEN_ENTRIES_MM
+
+def plan_pdfs_from_json(json_path, variants, font_dirs=None, font_cache_path=None, selection=None, max_image_pixels=MAX_IMAGE_PIXELS, text_layout=True):
+    """
+    Page count and the start page of every entry for each variant, as
+    create_pdfs_from_json would render them, in one pass over the JSON without
+    decoding images or writing PDFs. Paragraphs are wrapped once per distinct text
+    font, size and column width, by TextLayout (unless text_layout is False) or a
+    dry run of fpdf's multi_cell; images are scaled from their header dimensions.
+    Returns {"json", "datelines", "variants"}, one variant item per variant with
+    its "settings", "pages", "entry_pages" (the page each dateline is on, in
+    dateline order) and "forced_breaks" (indices of the entries the
+    min_text_lines rule starts on a new page). selection is as for
+    iter_json_entries; images over max_image_pixels are left out, as when
+    rendering.
+    """
+    from fpdf.enums import MethodReturnValue
+    from font_registry import FontRegistry, default_font_dirs
+    from PDFRounded import PDFRounded as FPDF
+    variants = [{**VARIANT_DEFAULTS, **variant} for variant in variants]
+    json_dir = input_dir(json_path)
+    fonts = FontRegistry(default_font_dirs(font_dirs or ()), font_cache_path)
+    layout = new_text_layout(fonts) if text_layout else None
+    # One measuring document per text font; tall enough that a dry run never breaks the page
+    measures = {}
+    plans = []
+    for variant in variants:
+        config = variant_config(variant, json_dir)
+        if config["text_font"] not in measures:
+            pdf = FPDF(unit="mm", format=(1000, 100000))
+            fonts.add_to(pdf, config["text_font"])
+            pdf.add_page()
+            measures[config["text_font"]] = pdf
+        pdf = measures[config["text_font"]]
+        plans.append(PagePlan(config, pdf.t_margin, pdf.b_margin))
+    logging.info(fonts.report())
+    wrap_keys = {}
+    for plan in plans:
+        key = (plan.config["text_font"], plan.config["text_font_size"], plan.layout["avail_w_mm"], plan.layout["line_height_mm"])
+        wrap_keys.setdefault(key, []).append(plan)
+
+    datelines = []
+    for entry in iter_json_entries(json_path, selection):
+        datelines.append(entry.get("dateline"))
+        images = entry.get("images", [])
+        image_sizes = [image_header_size(img, json_dir, max_image_pixels) for img in images] if images else []
+        for (text_font, text_font_size, avail_w_mm, line_height_mm), key_plans in wrap_keys.items():
+            pdf = measures[text_font]
+            pdf.set_font(text_font, size=text_font_size)
+            line_counts = []
+            for text_obj in entry["text"]:
+                paragraph = text_obj["text"]
+                num_lines = layout.count_lines(pdf, avail_w_mm, paragraph) if layout is not None else None
+                if num_lines is not None:
+                    line_counts.append((num_lines, False))
+                    continue
+                try:
+                    lines = pdf.multi_cell(avail_w_mm, line_height_mm, paragraph, dry_run=True, output=MethodReturnValue.LINES)
+                    line_counts.append((len(lines), paragraph.replace("\r", "").endswith("\n")))
+                except Exception as e:
+                    logging.error(f"[FPDFException] {e}\nProblematic text: {repr(paragraph)}\nDateline: {repr(entry['dateline'])}")
+                    line_counts.append(None)
+            for plan in key_plans:
+                plan.add_entry(entry, line_counts, image_sizes)
+    if layout is not None:
+        layout.save()
+        logging.info(layout.report())
+    fonts.close()
+    return {
+        "json": json_path,
+        "datelines": datelines,
+        "variants": [
+            {"settings": variant, "pages": plan.page, "entry_pages": plan.entry_pages, "forced_breaks": plan.forced_breaks}
+            for variant, plan in zip(variants, plans)
+        ],
+    }
+
+def input_dir(json_path):
+    """Directory relative image paths are resolved against: the JSON's (the first one's when merging)."""
+    first = json_path if isinstance(json_path, str) else json_path[0]
+    return os.path.dirname(os.path.abspath(first))
+
+def iter_dated_entries(json_path, selection=None):
+    """
+    Yields (sort date, entry) for the entries of one diary, with "date" filled in
+    for JSON converted before entries recorded it and stored image paths made
+    absolute. Undated entries sort with the entry before them.
+    """
+    from entry_index import DateNormalizer
+    dates = DateNormalizer()
+    json_dir = input_dir(json_path)
+    last = ""
+    out_of_order = False
+    for entry in iter_json_entries(json_path, selection):
+        if "date" not in entry:
+            entry["date"] = dates.date_of(entry["dateline"])
+        date = entry["date"] or last
+        if date < last and not out_of_order:
+            logging.warning(f"{json_path}: entries are not in date order (at {entry['dateline']!r}); the merge keeps the order within this diary")
+            out_of_order = True
+        last = max(last, date)
+        entry.setdefault("filename", json_path)
+        for img in entry.get("images", []):
+            if img.get("image_path"):
+                img["image_path"] = os.path.join(json_dir, img["image_path"])
+        yield date, entry
+
+def iter_merged_entries(json_paths, selection=None):
+    """
+    Yields the entries of several diaries in date order, by a streaming k-way merge
+    (heapq.merge) that holds one pending entry per diary. Every entry keeps the
+    filename of its source; entries with the same date keep the order of
+    json_paths. selection applies to each diary, except "entries", which picks
+    positions in the merged order.
+    """
+    import heapq
+    from entry_index import in_ranges
+    selection = dict(selection or {})
+    ranges = selection.pop("entries", None)
+    merged = heapq.merge(*(iter_dated_entries(path, selection or None) for path in json_paths), key=lambda item: item[0])
+    for idx, (_, entry) in enumerate(merged):
+        if ranges is not None:
+            if not in_ranges(idx, ranges):
+                if all(stop is not None and idx >= stop for _, stop in ranges):
+                    return
+                continue
+        yield entry
+
+def iter_json_entries(json_path, selection=None):
+    """
+    Yields the diary entries of a JSON file one at a time. With ijson installed the
+    file is parsed incrementally, so only the current entry is held in memory;
+    otherwise the whole document is loaded with json.load. An SQLite diary store
+    (diary_markdown2json.py --sqlite) is read row by row instead. selection
+    ({"date_from", "date_to", "entries", "query"}, see iter_store_entries) picks
+    the entries to yield; from a JSON file they are read by seeking through its
+    entry index (see entry_index.py), and query needs a store. A list of paths
+    yields the entries of all of them merged by date (see iter_merged_entries).
+    """
+    if not isinstance(json_path, str):
+        yield from iter_merged_entries(json_path, selection)
+        return
+    from diary_store import is_diary_store
+    if is_diary_store(json_path):
+        from diary_store import iter_store_entries
+        yield from iter_store_entries(json_path, **(selection or {}))
+        return
+    if selection:
+        if selection.get("query"):
+            raise ValueError(f"{json_path}: selecting entries by query needs a diary store (diary_markdown2json.py --sqlite)")
+        from entry_index import iter_indexed_entries
+        yield from iter_indexed_entries(json_path, **selection)
+        return
+    try:
+        import ijson
+    except ImportError:
+        logging.warning("ijson is not installed; loading the whole JSON file (pip install ijson to stream it)")
+        with open(json_path, "r", encoding="utf-8") as f:
+            yield from json.load(f).get("entries", [])
+        return
+    with open(json_path, "rb") as f:
+        yield from ijson.items(f, "entries.item", use_float=True)
+
+# Settings of one rendered PDF; see create_pdf_from_json
+VARIANT_DEFAULTS = {
+    "output_pdf": None,
+    "page_size": "A5",
+    "text_font_size": 12,
+    "text_font": "WarblerText",
+    "date_font": "3270NerdFont-Regular",
+    "date_font_size": 18,
+    "line_spacing": 1.3,
+    "margin_inch": 0.35,
+    "rect_corner_radius_mm": 2,
+    "rect_fill_color": (0, 0, 0),
+}
+
+def selection_label(selection):
+    """File name suffix of a selection of entries, e.g. _2015-01-01_to_2015-03-31_entries-0-99_q-board."""
+    if not selection:
+        return ""
+    label = ""
+    if selection.get("date_from") or selection.get("date_to"):
+        label += f"_{selection.get('date_from') or 'start'}_to_{selection.get('date_to') or 'end'}"
+    if selection.get("entries"):
+        label += "_entries-" + "_".join(f"{start}-{'' if stop is None else stop - 1}" if stop != start + 1 else str(start) for start, stop in selection["entries"])
+    if selection.get("query"):
+        label += "_q-" + re.sub(r'[^\w-]+', '_', selection["query"]).strip("_")[:40]
+    return label
+
+def default_output_pdf(json_path, page_size, text_font_size, selection=None):
+    base, _ = os.path.splitext(os.path.basename(json_path))
+    base = re.sub(r'\s+', '_', base) + selection_label(selection)
+    # Output PDF should be in the same directory as the input file
+    input_dir = os.path.dirname(json_path)
+    return os.path.join(input_dir, f"{base}_{page_size.upper()}_{text_font_size}pt.pdf")
+
+def variant_output_paths(json_path, variants, selection=None):
+    """
+    Output PDF of each variant, named <input>_<PAGE>_<size>pt.pdf as for a single
+    render (with the selection, if any, after <input>). Variants that would get the
+    same name (differing only in fonts, colors, etc.) have the settings that tell
+    them apart appended.
+    """
+    paths = [v["output_pdf"] or default_output_pdf(json_path, v["page_size"], v["text_font_size"], selection) for v in variants]
+    clashes = collections.defaultdict(list)
+    for idx, path in enumerate(paths):
+        clashes[path].append(idx)
+    for path, indices in clashes.items():
+        if len(indices) < 2:
+            continue
+        differing = [key for key in VARIANT_DEFAULTS if len({repr(variants[idx][key]) for idx in indices}) > 1]
+        base, ext = os.path.splitext(path)
+        for n, idx in enumerate(indices, 1):
+            labels = ["-".join(map(str, value)) if isinstance(value, (tuple, list)) else str(value) for value in (variants[idx][key] for key in differing)]
+            suffix = "".join("_" + re.sub(r'\s+', '_', label) for label in labels) if differing else f"_{n}"
+            paths[idx] = f"{base}{suffix}{ext}"
+    return paths
+
+def image_width_px(config):
+    """Pixel width images are prepared at: the text column (page width minus margins)."""
+    return mm_to_px(config["page_size"][0] - 2 * config.get("margin_mm", 8.89))
+
+class DiaryStats:
+    """Totals for the metadata.txt written next to every PDF, gathered entry by entry."""
+
+    def __init__(self):
+        self.num_images = 0
+        self.total_image_bytes = 0
+        self.decoded_image_bytes = 0
+        self.total_words = 0
+        self.first_date = None
+        self.last_date = None
+
+    def add(self, entry):
         dateline = entry.get("dateline")
         if dateline:
-            dates.append(dateline)
-    if dates:
-        return dates[0], dates[-1]
-    return None, None
-
-def create_pdf_from_json(json_path, output_pdf=None, page_size="A5", date_font="3270NerdFont-Regular", date_font_size=18, text_font="WarblerText", text_font_size=12, line_spacing=1.3, margin_inch=0.35, rect_corner_radius_mm=2, rect_fill_color=(0,0,0)):
-    margin_mm = inch_to_mm(margin_inch)
-    config = {
+            self.first_date = self.first_date or dateline
+            self.last_date = dateline
+        # Count words in text
+        for text_obj in entry.get("text", []):
+            paragraph = text_obj.get("text", "")
+            self.total_words += len(paragraph.split())
+        # Count images and their sizes
+        for img in entry.get("images", []):
+            self.num_images += 1
+            if img.get("image_path") or img.get("store"):
+                # Stored images carry their decoded size
+                self.total_image_bytes += img.get("size_bytes", 0)
+                self.decoded_image_bytes += img.get("size_bytes", 0)
+                continue
+            image_data = img.get("image_data", "")
+            # Only count base64 size, not decoded image size
+            self.total_image_bytes += len(image_data.encode("utf-8"))
+            # Decoded size, counted alike for inline and stored images
+            self.decoded_image_bytes += decoded_size(image_data)
+
+    def merge(self, later):
+        """Adds the totals of the entries that follow these ones (e.g. the next shard)."""
+        self.num_images += later.num_images
+        self.total_image_bytes += later.total_image_bytes
+        self.decoded_image_bytes += later.decoded_image_bytes
+        self.total_words += later.total_words
+        self.first_date = self.first_date or later.first_date
+        self.last_date = later.last_date or self.last_date
+
+    def write_metadata(self, output_pdf, num_pages):
+        metadata_path = os.path.splitext(output_pdf)[0] + ".metadata.txt"
+        date_range = f"{self.first_date} - {self.last_date}" if self.first_date and self.last_date else ""
+        with open(metadata_path, "w", encoding="utf-8") as meta_f:
+            meta_f.write(f"Number of pages: {num_pages}\n")
+            meta_f.write(f"Date range: {date_range}\n")
+            meta_f.write(f"Number of images: {self.num_images}\n")
+            meta_f.write(f"Total image size (bytes): {self.total_image_bytes}\n")
+            meta_f.write(f"Decoded image size (bytes): {self.decoded_image_bytes}\n")
+            meta_f.write(f"Total number of words: {self.total_words}\n")
+        logging.info(f"Metadata written to {metadata_path}")
+
+def variant_config(variant, json_dir, image_cache=None, max_image_pixels=MAX_IMAGE_PIXELS, image_passthrough=None, text_layout=None):
+    """The add_entry_to_pdf config of a variant (see VARIANT_DEFAULTS)."""
+    page_size = variant["page_size"]
+    return {
         "page_size": PAGE_SIZES.get(page_size.upper(), PAGE_SIZES["A5"]),
+        "date_font": variant["date_font"],
+        "date_font_size": variant["date_font_size"],
+        "text_font": variant["text_font"],
+        "text_font_size": variant["text_font_size"],
+        "line_spacing": variant["line_spacing"],
+        "margin_mm": inch_to_mm(variant["margin_inch"]),
+        "rect_corner_radius_mm": variant["rect_corner_radius_mm"],
+        "rect_fill_color": tuple(variant["rect_fill_color"]),
+        "json_dir": json_dir,
+        "image_cache": image_cache,
+        "max_image_pixels": max_image_pixels,
+        "image_passthrough": image_passthrough,
+        "text_layout": text_layout
+    }
+
+def default_volume_path(json_paths):
+    return os.path.join(os.path.dirname(json_paths[0]), "merged")
+
+def create_pdfs_from_json(json_path, variants, image_cache_path=None, image_cache_size_mb=2048, image_workers=None, font_dirs=None, font_cache_path=None, shards=0, metrics=None, profile=None, selection=None, volume=None, max_image_pixels=MAX_IMAGE_PIXELS, image_passthrough="cmyk", text_layout=True):
+    """
+    Renders one PDF and metadata.txt per variant (a dict of create_pdf_from_json
+    settings) in a single pass over the JSON. Only the fonts the variants use are
+    registered, each parsed at most once (see FontRegistry), and each image is
+    prepared once per distinct column width. With shards > 1 each variant is
+    instead split at page breaks and rendered by that many processes (see
+    pdf_shards.py). metrics is a file for the stage timings and counters of the
+    run ('' for <input>.render.metrics.json, see run_metrics.py) and profile one
+    for cProfile stats ('' for <input>.render.prof). selection renders only some
+    entries (see iter_json_entries). json_path may be a list of diaries to merge
+    into one volume by date; outputs are then named as if the volume were the JSON
+    <volume>.json (default: "merged" next to the first diary). Images larger than
+    max_image_pixels once decoded are left out (0 or None: no limit).
+    image_passthrough is the policy (see IMAGE_PASSTHROUGH_POLICIES) for embedding
+    suitable JPEGs unchanged. Body text is broken into lines from cached word
+    widths (see text_layout.py), or by multi_cell alone when text_layout is False.
+    Returns the PDF paths.
+    """
+    variants = [{**VARIANT_DEFAULTS, **variant} for variant in variants]
+    name_path = json_path if isinstance(json_path, str) else (volume or default_volume_path(json_path)) + ".json"
+    output_paths = variant_output_paths(name_path, variants, selection)
+    base = os.path.splitext(name_path)[0]
+    metrics_path = (metrics or base + ".render.metrics.json") if metrics is not None else None
+    profile_path = (profile or base + ".render.prof") if profile is not None else None
+    with run_metrics.collecting(metrics_path, profile_path, tool="diary_json2pdf", input=json_path, outputs=output_paths, shards=shards, selection=selection) as run:
+        if shards > 1:
+            from pdf_shards import create_pdfs_sharded
+            variants = [dict(variant, output_pdf=output_pdf) for variant, output_pdf in zip(variants, output_paths)]
+            return create_pdfs_sharded(json_path, variants, shards, image_cache_path, image_cache_size_mb, font_dirs, font_cache_path, selection, max_image_pixels, image_passthrough, text_layout)
+        _render_variants(
+            json_path, variants, output_paths, image_cache_path, image_cache_size_mb, image_workers, font_dirs, font_cache_path,
+            metrics=run.metrics, selection=selection, max_image_pixels=max_image_pixels, image_passthrough=image_passthrough, text_layout=text_layout
+        )
+    return output_paths
+
+def _render_variants(json_path, variants, output_paths, image_cache_path, image_cache_size_mb, image_workers, font_dirs, font_cache_path, metrics, selection=None, max_image_pixels=MAX_IMAGE_PIXELS, image_passthrough="cmyk", text_layout=True):
+    json_dir = input_dir(json_path)
+    image_cache = None
+    if image_cache_path:
+        from image_cache import ProcessedImageCache
+        image_cache = ProcessedImageCache(image_cache_path, image_cache_size_mb * 1024 * 1024)
+    passthrough = ImagePassthrough(image_passthrough, max_image_pixels)
+
+    from font_registry import FontRegistry, default_font_dirs
+    from PDFRounded import PDFRounded as FPDF
+    fonts = FontRegistry(default_font_dirs(font_dirs or ()), font_cache_path)
+    # Word widths are read from and saved to the font metrics cache, which stays open until then
+    layout = new_text_layout(fonts) if text_layout else None
+    documents = []
+    with metrics.stage("font_registration"):
+        for variant in variants:
+            config = variant_config(variant, json_dir, image_cache, max_image_pixels, passthrough, layout)
+            pdf = FPDF(unit="mm", format=config["page_size"])
+            # The date font is set first in every entry
+            for font in dict.fromkeys([config["date_font"], config["text_font"]]):
+                fonts.add_to(pdf, font)
+            pdf.add_page()
+            documents.append((pdf, config))
+    metrics.count("fonts_parsed", fonts.parsed)
+    metrics.count("fonts_from_cache", fonts.cache_hits)
+    logging.info(fonts.report())
+
+    # Metadata collection, in the same pass that renders the entries
+    stats = DiaryStats()
+
+    # Images are decoded, resized and encoded in worker processes ahead of the layout
+    if image_workers is None:
+        image_workers = os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(image_workers) if image_workers > 0 else None
+    widths_px = sorted({image_width_px(config) for _, config in documents})
+    entries = iter_prepared_entries(
+        metrics.iterate("json_load", iter_json_entries(json_path, selection)), json_dir, widths_px, image_cache, executor,
+        lookahead=max(image_workers, 1) * 4, max_pixels=max_image_pixels, passthrough=passthrough
+    )
+
+    try:
+        for entry, prepared_images in entries:
+            metrics.count("entries")
+            stats.add(entry)
+            for pdf, config in documents:
+                add_entry_to_pdf(pdf, entry, config, prepared_images[image_width_px(config)])
+    except BaseException:
+        # Drop the images still queued ahead of the layout instead of waiting for them at exit
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        raise
+    if executor is not None:
+        executor.shutdown()
+    metrics.count("images", stats.num_images)
+    metrics.count("words", stats.total_words)
+    if layout is not None:
+        layout.save()
+        metrics.count("paragraphs_laid_out", layout.laid_out)
+        metrics.count("paragraphs_multi_cell", layout.fallbacks)
+        metrics.count("words_measured", layout.measured)
+        logging.info(layout.report())
+    fonts.close()
+
+    for (pdf, _), output_pdf in zip(documents, output_paths):
+        with metrics.stage("pdf_output"):
+            pdf.output(output_pdf)
+        metrics.count("pages", pdf.page_no())
+        metrics.count("pdf_bytes", os.path.getsize(output_pdf))
+        logging.info(f"Created {output_pdf}")
+        stats.write_metadata(output_pdf, pdf.page_no())
+    logging.info(passthrough.report())
+    if image_cache is not None:
+        image_cache.close()
+        metrics.count("image_cache_hits", image_cache.hits)
+        metrics.count("image_cache_misses", image_cache.misses)
+        logging.info(image_cache.report())
+
+def create_pdf_from_json(json_path, output_pdf=None, page_size="A5", date_font="3270NerdFont-Regular", date_font_size=18, text_font="WarblerText", text_font_size=12, line_spacing=1.3, margin_inch=0.35, rect_corner_radius_mm=2, rect_fill_color=(0,0,0), image_cache_path=None, image_cache_size_mb=2048, image_workers=None, font_dirs=None, font_cache_path=None, metrics=None, profile=None, selection=None, shards=0, volume=None, max_image_pixels=MAX_IMAGE_PIXELS, image_passthrough="cmyk", text_layout=True):
+    """Renders one PDF; the options after rect_fill_color are as for create_pdfs_from_json. Returns its path."""
+    variant = {
+        "output_pdf": output_pdf,
+        "page_size": page_size,
         "date_font": date_font,
         "date_font_size": date_font_size,
         "text_font": text_font,
         "text_font_size": text_font_size,
         "line_spacing": line_spacing,
-        "margin_mm": margin_mm,
+        "margin_inch": margin_inch,
         "rect_corner_radius_mm": rect_corner_radius_mm,
-        "rect_fill_color": rect_fill_color
+        "rect_fill_color": rect_fill_color,
     }
-    pdf = FPDF(unit="mm", format=config["page_size"])
-    
-    font_path = "/Users/julian/Dropbox (Personal)/Projects By Year/@2025/OMATA Process Diary/ProcessDiaryEntries/WarblerTextV1.2-Regular.otf"
-    pdf.add_font("WarblerText", "", font_path)
-    
-    nyt_font_path = "/Users/julian/Dropbox (Personal)/Projects By Year/@2025/OMATA Process Diary/ProcessDiaryEntries/nyt-cheltenham-normal.ttf"
-    
-    imperial_font_path = "/Users/julian/Dropbox (Personal)/Projects By Year/@2025/OMATA Process Diary/ProcessDiaryEntries/imperial-italic-600.ttf"
-    
-    pdf.add_font("imperial-italic-600", "", imperial_font_path)
-    
-    pdf.add_font("nyt-cheltenham-normal", "", nyt_font_path)
-    
-    date_font_path = "/Users/julian/Dropbox (Personal)/Projects By Year/@2025/OMATA Process Diary/ProcessDiaryEntries/3270NerdFont-Regular.ttf"
-    pdf.add_font("3270NerdFont-Regular", "", date_font_path)
-    
-    pdf.add_page()
-    with open(json_path, "r", encoding="utf-8") as f:
-        diary = json.load(f)
-
-    # Metadata collection
-    num_images = 0
-    total_image_bytes = 0
-    total_words = 0
-
-    with open(json_path, "r", encoding="utf-8") as f:
-        diary = json.load(f)
-
-    for entry in diary["entries"]:
-        # Count words in text
-        for text_obj in entry.get("text", []):
-            paragraph = text_obj.get("text", "")
-            total_words += len(paragraph.split())
-        # Count images and their sizes
-        for img in entry.get("images", []):
-            num_images += 1
-            image_data = img.get("image_data", "")
-            try:
-                # Only count base64 size, not decoded image size
-                total_image_bytes += len(image_data.encode("utf-8"))
-            except Exception:
-                pass
-        add_entry_to_pdf(pdf, entry, config)
-
-    if not output_pdf:
-        base, _ = os.path.splitext(os.path.basename(json_path))
-        base = re.sub(r'\s+', '_', base)
-        # Output PDF should be in the same directory as the input file
-        input_dir = os.path.dirname(json_path)
-        output_pdf = os.path.join(input_dir, f"{base}_{page_size.upper()}_{text_font_size}pt.pdf")
-    pdf.output(output_pdf)
-    logging.info(f"Created {output_pdf}")
-
-    # Write metadata file
-    metadata_path = os.path.splitext(output_pdf)[0] + ".metadata.txt"
-    num_pages = pdf.page_no()
-    first_date, last_date = get_date_range_from_json(json_path)
-    date_range = f"{first_date} - {last_date}" if first_date and last_date else ""
-    with open(metadata_path, "w", encoding="utf-8") as meta_f:
-        meta_f.write(f"Number of pages: {num_pages}\n")
-        meta_f.write(f"Date range: {date_range}\n")
-        meta_f.write(f"Number of images: {num_images}\n")
-        meta_f.write(f"Total image size (bytes): {total_image_bytes}\n")
-        meta_f.write(f"Total number of words: {total_words}\n")
-    logging.info(f"Metadata written to {metadata_path}")
+    return create_pdfs_from_json(
+        json_path, [variant], image_cache_path, image_cache_size_mb, image_workers, font_dirs, font_cache_path, shards=shards,
+        metrics=metrics, profile=profile, selection=selection, volume=volume, max_image_pixels=max_image_pixels,
+        image_passthrough=image_passthrough, text_layout=text_layout
+    )[0]
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_json", help="Input JSON file")
-    parser.add_argument("--margin", type=float, default=0.35, help="Margin in inches (default: 0.35)")
-    parser.add_argument("--page_size", type=str, default="A5", help="Page size (A4, A5, A6, etc.)")
-    parser.add_argument("--date_font", type=str, default="3270NerdFont-Regular", help="Font for date line")
-    parser.add_argument("--date_font_size", type=float, default=11, help="Font size for date line")
-    parser.add_argument("--text_font", type=str, default="WarblerText", help="Font for text")
-    parser.add_argument("--text_font_size", type=int, default=9, help="Font size for text")
-    parser.add_argument("--line_spacing", type=float, default=1.2, help="Line spacing multiplier")
+    from font_registry import default_font_cache_path
+    from image_cache import default_image_cache_path
+    parser = argparse.ArgumentParser(description="Render a diary JSON to PDF. Options marked [list] take several values; one PDF is rendered per combination.")
+    parser.add_argument("input_json", nargs="+", help="Input JSON file, or SQLite diary store (diary_markdown2json.py --sqlite); several with --merge")
+    parser.add_argument("--merge", nargs="?", const="", default=None, help="Merge all inputs by entry date into one volume, named as if it were the JSON <MERGE>.json (default: merged, next to the first input)")
+    parser.add_argument("--margin", type=float, nargs="+", default=[0.35], help="[list] Margin in inches (default: 0.35)")
+    parser.add_argument("--page_size", type=str, nargs="+", default=["A5"], help="[list] Page size (A4, A5, A6, etc.)")
+    parser.add_argument("--date_font", type=str, nargs="+", default=["3270NerdFont-Regular"], help="[list] Font for date line")
+    parser.add_argument("--date_font_size", type=float, nargs="+", default=[11], help="[list] Font size for date line")
+    parser.add_argument("--text_font", type=str, nargs="+", default=["WarblerText"], help="[list] Font for text")
+    parser.add_argument("--text_font_size", type=int, nargs="+", default=[9], help="[list] Font size for text")
+    parser.add_argument("--line_spacing", type=float, nargs="+", default=[1.2], help="[list] Line spacing multiplier")
     parser.add_argument("--rect_corner_radius_mm", type=float, default=1, help="Corner radius for left corners of date rectangle (mm)")
-    parser.add_argument("--rect_fill_color", type=int, nargs=3, default=[0,0,0], help="Fill color for date rectangle as three RGB values, e.g. --rect_fill_color 30 30 30")
+    parser.add_argument("--image_cache", type=str, default=None, help="SQLite file of processed images reused across runs (default: ~/.cache/diary_json2pdf/images.sqlite)")
+    parser.add_argument("--no_image_cache", action="store_true", help="Process every image from scratch without reading or writing the image cache")
+    parser.add_argument("--image_cache_size_mb", type=int, default=2048, help="Size budget of the image cache in MB; least recently used images are evicted (default: 2048)")
+    parser.add_argument("--image_workers", type=int, default=None, help="Worker processes preparing images ahead of the layout; 0 prepares them inline (default: number of CPUs)")
+    parser.add_argument("--max_image_pixels", type=int, default=MAX_IMAGE_PIXELS, help="Leave out images larger than this many pixels once decoded (JPEGs are reduced while decoding first); bounds peak memory per image, at the cost of the images left out (default: 0, no limit)")
+    parser.add_argument("--image_passthrough", choices=sorted(IMAGE_PASSTHROUGH_POLICIES), default="cmyk", help="Embed JPEGs no wider than the column at 300 DPI as they are, without re-encoding: off; cmyk, only those already in CMYK; any, also RGB and grayscale ones, which then stay out of CMYK (default: cmyk)")
+    parser.add_argument("--shards", type=int, default=0, help="Split each PDF at page breaks into this many parts rendered in parallel processes and merge them; output matches a serial render (default: 0, serial)")
+    parser.add_argument("--font_dir", action="append", default=[], help="Directory searched for fonts by alias before the repo and bundled fonts (repeatable; also $DIARY_FONT_DIRS)")
+    parser.add_argument("--font_cache", type=str, default=None, help="SQLite file of parsed font metrics reused across runs (default: ~/.cache/diary_json2pdf/fonts.sqlite)")
+    parser.add_argument("--no_font_cache", action="store_true", help="Parse every font file without reading or writing the font metrics cache")
+    parser.add_argument("--no_text_layout", action="store_true", help="Wrap every paragraph with fpdf's multi_cell instead of breaking lines from cached word widths (the output is the same, only slower)")
+    parser.add_argument("--rect_fill_color", type=int, nargs=3, action="append", default=None, metavar=("R", "G", "B"), help="[list] Fill color for date rectangle as three RGB values, e.g. --rect_fill_color 30 30 30; repeat for several colors (default: 0 0 0)")
+    parser.add_argument("--from", dest="date_from", type=str, default=None, help="Render only the entries dated on or after this day (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", type=str, default=None, help="Render only the entries dated on or before this day (YYYY-MM-DD)")
+    parser.add_argument("--entries", type=str, default=None, help="Render only the entries at these zero-based positions, e.g. 0-99,150,200- (ranges inclusive)")
+    parser.add_argument("--query", type=str, default=None, help="Render only the entries with a text line matching this SQLite FTS5 query, e.g. 'factory AND tooling'; needs a diary store")
+    parser.add_argument("--plan_only", "--plan-only", action="store_true", help="Only compute the page count and the start page of every entry for each combination; no images are decoded and no PDF is written")
+    parser.add_argument("--plan_output", type=str, default=None, help="With --plan_only, also write the plan (settings, pages and entry start pages of every combination) to this JSON file")
+    parser.add_argument("--metrics", nargs="?", const="", default=None, help="Write stage timings, counters, throughput and peak memory of the run to this JSON file (default file: <input>.render.metrics.json)")
+    parser.add_argument("--cprofile", nargs="?", const="", default=None, help="Run the render under cProfile and dump the stats to this file (default file: <input>.render.prof)")
+    parser.add_argument("--log", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    parser.add_argument("--import_profile", "--import-profile", action="store_true", help="Log the time spent importing each module during the run (fpdf, PIL and fontTools are only imported when rendering starts)")
     args = parser.parse_args()
-    create_pdf_from_json(
-        args.input_json,
-        None,
-        page_size=args.page_size,
-        date_font=args.date_font,
-        date_font_size=args.date_font_size,
-        text_font=args.text_font,
-        text_font_size=args.text_font_size,
-        line_spacing=args.line_spacing,
-        margin_inch=args.margin,
-        rect_corner_radius_mm=args.rect_corner_radius_mm,
-        rect_fill_color=tuple(args.rect_fill_color)
-    )
\ No newline at end of file
+    from import_profile import log_import_profile, start_import_profile
+    profiler = start_import_profile(args.import_profile)
+    logging.basicConfig(
+        level=getattr(logging, args.log.upper(), None),
+        format='%(asctime)s %(levelname)s [%(name)s][Line %(lineno)d]: %(message)s'
+    )
+    logging.getLogger("fpdf").setLevel(logging.WARNING)
+    logging.getLogger("fontTools").setLevel(logging.WARNING)
+    logging.getLogger("PIL").setLevel(logging.WARNING)
+    if len(args.input_json) > 1 and args.merge is None:
+        parser.error("several inputs are only rendered together with --merge")
+    json_input = args.input_json if args.merge is not None else args.input_json[0]
+    entry_ranges = None
+    if args.entries:
+        from entry_index import parse_entry_ranges
+        try:
+            entry_ranges = parse_entry_ranges(args.entries)
+        except ValueError as e:
+            parser.error(f"--entries: {e}")
+    selection = {
+        key: value for key, value in (("date_from", args.date_from), ("date_to", args.date_to), ("entries", entry_ranges), ("query", args.query)) if value
+    } or None
+    if selection:
+        from diary_store import date_bounds, is_diary_store
+        if args.query and not all(is_diary_store(path) for path in args.input_json):
+            parser.error("--query needs a diary store input (diary_markdown2json.py --sqlite)")
+        try:
+            date_bounds(args.date_from, args.date_to)
+        except ValueError as e:
+            parser.error(f"--from/--to: {e}")
+    variants = []
+    for page_size, text_font_size, date_font_size, text_font, date_font, rect_fill_color, line_spacing, margin in itertools.product(
+        args.page_size, args.text_font_size, args.date_font_size, args.text_font, args.date_font, args.rect_fill_color or [[0, 0, 0]], args.line_spacing, args.margin
+    ):
+        variant = {
+            "page_size": page_size,
+            "date_font": date_font,
+            "date_font_size": date_font_size,
+            "text_font": text_font,
+            "text_font_size": text_font_size,
+            "line_spacing": line_spacing,
+            "margin_inch": margin,
+            "rect_corner_radius_mm": args.rect_corner_radius_mm,
+            "rect_fill_color": tuple(rect_fill_color),
+        }
+        if variant not in variants:
+            variants.append(variant)
+    if args.plan_only:
+        plan = plan_pdfs_from_json(
+            json_input,
+            variants,
+            font_dirs=args.font_dir,
+            font_cache_path=None if args.no_font_cache else (args.font_cache or default_font_cache_path()),
+            selection=selection,
+            max_image_pixels=args.max_image_pixels,
+            text_layout=not args.no_text_layout
+        )
+        # Settings that differ between the combinations label each line of the summary
+        swept = [key for key in VARIANT_DEFAULTS if len({repr(v["settings"][key]) for v in plan["variants"]}) > 1] or ["page_size", "text_font_size"]
+        for item in sorted(plan["variants"], key=lambda v: v["pages"]):
+            label = ", ".join(f"{key}={item['settings'][key]}" for key in swept)
+            logging.info(f"Plan: {item['pages']} pages: {label}")
+            for dateline, page in zip(plan["datelines"], item["entry_pages"]):
+                logging.debug(f"  page {page}: {dateline}")
+        if args.plan_output:
+            with open(args.plan_output + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(plan, f, ensure_ascii=False, indent=2)
+            os.replace(args.plan_output + ".tmp", args.plan_output)
+            logging.info(f"Plan written to {args.plan_output}")
+        log_import_profile(profiler)
+        raise SystemExit(0)
+    create_pdfs_from_json(
+        json_input,
+        variants,
+        image_cache_path=None if args.no_image_cache else (args.image_cache or default_image_cache_path()),
+        image_cache_size_mb=args.image_cache_size_mb,
+        image_workers=args.image_workers,
+        font_dirs=args.font_dir,
+        font_cache_path=None if args.no_font_cache else (args.font_cache or default_font_cache_path()),
+        shards=args.shards,
+        metrics=args.metrics,
+        profile=args.cprofile,
+        selection=selection,
+        volume=args.merge or None,
+        max_image_pixels=args.max_image_pixels,
+        image_passthrough=args.image_passthrough,
+        text_layout=not args.no_text_layout
+    )
+    log_import_profile(profiler)
@@ -1,78 +1,84 @@
+import collections
+import contextlib
+import hashlib
+import io
+import itertools
+import json
 import logging
-import spacy
-from dateutil import parser
+import mmap
+import os
+import re
+import run_metrics
+from detect_dates import DateLineClassifier, VerdictCache, is_date_line, lazy_spacy_model, verdict_cache_namespace
 
-# Load spaCy English model
-def load_spacy_model():
-    try:
-        return spacy.load("en_core_web_sm")
-    except OSError:
-        logging.error("spaCy model not found. Please run: python -m spacy download en_core_web_sm")
-        exit(1)
+IMAGE_MARKER = "![](data:image/"
+IMAGE_MARKER_BYTES = IMAGE_MARKER.encode()
+PROGRESS_LINES = 10000
+# Most lines resolve_ner_verdicts holds back waiting for a full NER batch; diaries
+# with few date candidates would otherwise be held almost whole
+MAX_HELD_LINES = 10000
+NEWLINE_RE = re.compile(rb'\n')
 
-def is_date_line(line, nlp):
+class ImageBlock:
     """
-    Returns True if the line is likely to be a date line.
-    Uses spaCy NER and dateutil.parser for robustness.
+    The lines of an image block in a memory-mapped markdown file, held as byte
+    offsets instead of text: from the line starting with IMAGE_MARKER (at offset
+    marker) through the line holding the closing parenthesis, [start, end) with
+    the final newline. image_type and has_base64 are read from its first line,
+    as build_entry does for an image line.
+    """
+
+    __slots__ = ("buffer", "start", "marker", "end", "lines", "image_type", "has_base64")
+
+    def __init__(self, buffer, start, marker, end, lines, image_type, has_base64):
+        self.buffer = buffer
+        self.start = start
+        self.marker = marker
+        self.end = end
+        self.lines = lines
+        self.image_type = image_type
+        self.has_base64 = has_base64
+
+    def text(self):
+        """The lines as read in text mode, newlines included."""
+        return self.buffer[self.start:self.end].decode('utf-8')
+
+    def image_data(self):
+        """From the marker to the end of the closing line, without its newline."""
+        end = self.end - 1 if self.buffer[self.end - 1:self.end] == b'\n' else self.end
+        return self.buffer[self.marker:end].decode('utf-8')
+
+    def update_hash(self, h):
+        with memoryview(self.buffer) as view, view[self.start:self.end] as raw:
+            h.update(raw)
+
+def line_count(line):
+    """Number of markdown lines a region item stands for (a line, or an ImageBlock)."""
+    return line.lines if isinstance(line, ImageBlock) else 1
+
+def scan_markdown_lines(lines, classifier, reference_nlp=None, start=0):
+    """
+    First pass over the markdown, one line at a time, numbering lines from start.
+    Yields (index, line, verdict, reference) for every line. Image blocks are never
+    datelines; verdict is None when only spaCy NER can decide the line. reference is
+    the untiered is_date_line verdict when reference_nlp is given, else None.
     """
-    import re
-    stripped = line.strip()
-    if not stripped:
-        return False
-    # Heuristic: skip lines that are only digits or too short to be a date
-    if stripped.isdigit() or len(stripped) < 5:
-        return False
-    # Heuristic: require at least one alphabetic character (for month names, etc.)
-    if not any(c.isalpha() for c in stripped):
-        return False
-    # Reject likely base64 (long, no spaces, mostly alphanum + /+=)
-    if len(stripped) > 30 and " " not in stripped:
-        if re.fullmatch(r"[A-Za-z0-9+/=]+", stripped):
-            return False
-    # Try parsing with dateutil
-    try:
-        dt = parser.parse(stripped, fuzzy=False, default=None)
-        return True
-    except Exception:
-        pass
-    # Use spaCy NER
-    doc = nlp(stripped)
-    for ent in doc.ents:
-        if ent.label_ == "DATE" and ent.text == stripped:
-            # Additional check: require at least one digit or month name in the string
-            if re.search(r"\d", stripped) or re.search(r"\b(January|February|March|April|May|June|July|August|September|October|November|December|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\b", stripped, re.IGNORECASE):
-                return True
-    return False
-
-def extract_date_lines(filepath):
-    nlp = load_spacy_model()
-    with open(filepath, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    import json
-    diary_entries = []
-    total = len(lines)
-    logging.info(f"Processing {total} lines...")
-    # First, collect all date line indices, log progress every 10,000 lines
-    date_indices = []
-    import re
-    i = 0
     inside_image_block = False
     image_start = None
     image_type = None
     base64_data = ''
     image_end = None
-    while i < total:
-        line = lines[i]
+    for i, line in enumerate(lines, start):
         stripped = line.strip()
         if (i+1) % 10000 == 0:
-            logging.info(f"Progress: processed {i+1}/{total} lines...")
+            logging.info(f"Progress: processed {i+1} lines...")
         # Detect start of image block
-        if not inside_image_block and stripped.startswith("![](data:image/"):
+        if not inside_image_block and stripped.startswith(IMAGE_MARKER):
             logging.info(f"Semantic element detected: IMAGE at line {i+1}")
             image_type = None
             base64_start = line.find('base64,')
             try:
-                image_type = line.split('![](data:image/')[1].split(';')[0]
+                image_type = line.split(IMAGE_MARKER)[1].split(';')[0]
             except Exception:
                 image_type = 'unknown'
                 logging.warning(f"Failed to parse image type at line {i+1}: {line.strip()}")
@@ -86,16 +92,14 @@ def extract_date_lines(filepath):
                 size_bytes = int(len(base64_data) * 3 / 4) if base64_data else 0
                 image_snippet = base64_data[:40] + ('...' if len(base64_data) > 40 else '')
                 logging.info(f"Image detected at lines {image_start+1}-{image_end+1}: type={image_type}, size~{size_bytes} bytes, snippet='{image_snippet}'")
-                i += 1
-                continue
             else:
                 # Start accumulating image block
                 if base64_start != -1:
                     base64_data = line[base64_start+7:].strip()
                 inside_image_block = True
                 image_end = i
-                i += 1
-                continue
+            yield i, line, False, None
+            continue
         elif inside_image_block:
             # Accumulate base64 lines until closing parenthesis
             base64_data += stripped
@@ -109,183 +113,729 @@ def extract_date_lines(filepath):
                 image_type = None
                 base64_data = ''
                 image_end = None
-                i += 1
-                continue
-            else:
-                i += 1
-                continue
+            yield i, line, False, None
+            continue
         # Only run date detection on non-image lines
-        if is_date_line(line, nlp):
-            logging.info(f"Semantic element detected: DATELINE at line {i+1}")
-            logging.info(f"Date detected at line {i+1}: {line.strip()}")
-            # Log the next line for debugging/robustness
-            if i+1 < total:
-                next_line = lines[i+1].strip()
-                logging.info(f"  Next line after dateline: {next_line}")
-            else:
-                logging.info(f"  No next line after dateline (end of file)")
-            date_indices.append(i)
-        i += 1
-
-    logging.info(f"Starting second pass: processing {len(date_indices)} diary entries...")
-    total_image_count = 0
-    total_image_bytes = 0
-    total_word_count = 0
-    for i, date_idx in enumerate(date_indices):
-        date_line = lines[date_idx].strip()
-        next_date_idx = date_indices[i + 1] if i + 1 < len(date_indices) else len(lines)
-        entry_text_lines = []
-        images = []
-        image_count = 0
-        image_total_size = 0
-        word_count = 0
-        # Log every diary entry (dateline) as it is processed
-        logging.info(f"Processing DIARY ENTRY {i+1}/{len(date_indices)}: dateline at line {date_idx+1}: {date_line}")
-        j = date_idx + 1
-        while j < next_date_idx:
-            content = lines[j].rstrip('\n')
-            if content.strip() == "":
-                j += 1
-                continue
-            # Handle inline images: split line at ![](data:image/
-            img_marker = "![](data:image/"
-            if img_marker in content:
-                img_start_idx = content.find(img_marker)
-                text_part = content[:img_start_idx].strip()
-                image_part = content[img_start_idx:]
-                # Add text before image (if any)
-                if text_part:
-                    entry_text_lines.append({
-                        "text": text_part,
-                        "line": j + 1,
-                        "filename": filepath
-                    })
-                    word_count += len(text_part.split())
-                # Now process image block
-                image_type = None
-                base64_start = image_part.find('base64,')
-                try:
-                    image_type = image_part.split('![](data:image/')[1].split(';')[0]
-                except Exception:
-                    image_type = 'unknown'
-                image_start = j
-                image_end = j
-                image_data = image_part
-                # If image is multi-line, accumulate until closing parenthesis
-                if ')' not in image_part:
-                    k = j + 1
-                    while k < next_date_idx:
-                        next_line = lines[k].rstrip('\n')
-                        image_data += '\n' + next_line
-                        if ')' in next_line:
-                            image_end = k
-                            break
-                        k += 1
-                    j = image_end
-                size_bytes = int(len(image_data) * 3 / 4) if base64_start != -1 else 0
-                images.append({
-                    "type": image_type,
-                    "image_data": image_data,
-                    "line_start": image_start + 1,
-                    "line_end": image_end + 1,
-                    "size_bytes": size_bytes,
+        _, verdict, _ = classifier.classify_fast(line)
+        reference = is_date_line(line, reference_nlp) if reference_nlp is not None else None
+        yield i, line, verdict, reference
+
+def count_newlines(buffer, start, end):
+    # mmap has no count(); the regex scans the mapping without copying it
+    return len(NEWLINE_RE.findall(buffer, start, end))
+
+def map_markdown(filepath, stack):
+    """
+    The markdown file memory-mapped for scan_markdown_buffer, unmapped when stack
+    closes; None when it is empty or has \\r line ends, which text mode turns into
+    \\n and which are therefore read as text.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        buffer = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return buffer if buffer.find(b'\r') == -1 else None
+
+def scan_markdown_buffer(buffer, classifier, reference_nlp=None):
+    """
+    scan_markdown_lines over a memory-mapped markdown file without \\r line ends,
+    working on bytes: line boundaries and image blocks are found with bytes.find,
+    and a block (a line starting with IMAGE_MARKER through the line with the
+    closing parenthesis) is yielded once, as (first index, ImageBlock, False,
+    None), with its payload neither decoded nor copied. Other lines are decoded
+    and classified as scan_markdown_lines does. An image that is never closed runs
+    to the end of the file, as there.
+    """
+    size = len(buffer)
+    pos = 0
+    i = 0
+    next_progress = PROGRESS_LINES
+    while pos < size:
+        nl = buffer.find(b'\n', pos)
+        end = size if nl == -1 else nl + 1
+        marker = buffer.find(IMAGE_MARKER_BYTES, pos, end)
+        if marker != -1 and not buffer[pos:marker].decode('utf-8').strip():
+            logging.info(f"Semantic element detected: IMAGE at line {i+1}")
+            line_end = end if nl == -1 else nl
+            type_end = buffer.find(b';', marker, line_end)
+            image_type = buffer[marker + len(IMAGE_MARKER_BYTES):line_end if type_end == -1 else type_end].decode('utf-8')
+            base64_start = buffer.find(b'base64,', marker, line_end)
+            close = buffer.find(b')', marker)
+            if close == -1:
+                # Unclosed: every remaining line belongs to the image
+                for j, line in enumerate(io.StringIO(buffer[pos:].decode('utf-8'), newline='\n'), i):
+                    yield j, line, False, None
+                return
+            close_nl = buffer.find(b'\n', close)
+            block_end = size if close_nl == -1 else close_nl + 1
+            lines = count_newlines(buffer, pos, close) + 1
+            payload = 0
+            snippet = ''
+            if base64_start != -1:
+                payload = close - base64_start - 7 - count_newlines(buffer, base64_start, close)
+                snippet = buffer[base64_start + 7:min(close, base64_start + 47)].decode('utf-8', 'replace').strip()
+            logging.info(f"Image detected at lines {i+1}-{i+lines}: type={image_type}, size~{int(payload * 3 / 4)} bytes, snippet='{snippet}{'...' if payload > 40 else ''}'")
+            yield i, ImageBlock(buffer, pos, marker, block_end, lines, image_type, base64_start != -1), False, None
+            pos = block_end
+            i += lines
+        else:
+            line = buffer[pos:end].decode('utf-8')
+            _, verdict, _ = classifier.classify_fast(line)
+            reference = is_date_line(line, reference_nlp) if reference_nlp is not None else None
+            yield i, line, verdict, reference
+            pos = end
+            i += 1
+        if i >= next_progress:
+            logging.info(f"Progress: processed {i} lines...")
+            next_progress = (i // PROGRESS_LINES + 1) * PROGRESS_LINES
+
+def resolve_ner_verdicts(scanned, classifier, batch_size=256, n_process=1, max_held=MAX_HELD_LINES):
+    """
+    Fills in the verdicts scan_markdown_lines left to spaCy. Lines are held back from
+    the first undecided one until enough NER candidates are queued to keep every
+    process busy (batch_size per process), or max_held lines are waiting, then all
+    go through nlp.pipe together and the held lines are released in order.
+    """
+    processes = (os.cpu_count() or 1) if n_process == -1 else max(n_process, 1)
+    window = batch_size * processes
+    held = []
+    pending = []
+
+    def flush():
+        texts = [stripped for _, stripped in pending]
+        logging.info(f"Running spaCy NER on {len(texts)} candidate lines (batch_size={batch_size}, n_process={n_process})...")
+        with run_metrics.stage("ner"):
+            verdicts = list(classifier.classify_ner_batch(texts, batch_size=batch_size, n_process=n_process))
+        for (pos, _), verdict in zip(pending, verdicts):
+            held[pos][2] = verdict
+        yield from (tuple(item) for item in held)
+        held.clear()
+        pending.clear()
+
+    for item in scanned:
+        if item[2] is None:
+            pending.append((len(held), item[1].strip()))
+        if not pending:
+            yield item
+            continue
+        held.append(list(item))
+        if len(pending) >= window or len(held) >= max_held:
+            yield from flush()
+    if pending:
+        yield from flush()
+
+def build_entry(filepath, date_idx, date_line, region):
+    """
+    Builds one diary entry from its dateline and the raw lines that follow it up to
+    the next dateline (or the end of the file). region may hold ImageBlock items in
+    place of the lines of an image block.
+    """
+    # region[j] starts at file line first + offsets[j] (0-based)
+    first = date_idx + 1
+    offsets = list(itertools.accumulate(map(line_count, region), initial=0))
+    entry_text_lines = []
+    images = []
+    j = 0
+    while j < len(region):
+        if isinstance(region[j], ImageBlock):
+            # Decoded in one piece, as the lines below would be joined
+            block = region[j]
+            image_data = block.image_data()
+            images.append({
+                "type": block.image_type,
+                "image_data": image_data,
+                "line_start": first + offsets[j] + 1,
+                "line_end": first + offsets[j + 1],
+                "size_bytes": int(len(image_data) * 3 / 4) if block.has_base64 else 0,
+                "filename": filepath
+            })
+            j += 1
+            continue
+        content = region[j].rstrip('\n')
+        if content.strip() == "":
+            j += 1
+            continue
+        # Handle inline images: split line at ![](data:image/
+        if IMAGE_MARKER in content:
+            img_start_idx = content.find(IMAGE_MARKER)
+            text_part = content[:img_start_idx].strip()
+            image_part = content[img_start_idx:]
+            # Add text before image (if any)
+            if text_part:
+                entry_text_lines.append({
+                    "text": text_part,
+                    "line": first + offsets[j] + 1,
                     "filename": filepath
                 })
-                image_count += 1
-                image_total_size += size_bytes
-                j += 1
-                continue
-            # Otherwise, treat as text (skip image blocks)
-            entry_text_lines.append({
-                "text": content.strip(),
-                "line": j + 1,
+            # Now process image block
+            image_type = None
+            base64_start = image_part.find('base64,')
+            try:
+                image_type = image_part.split(IMAGE_MARKER)[1].split(';')[0]
+            except Exception:
+                image_type = 'unknown'
+            image_start = j
+            image_end = j
+            image_data = image_part
+            # If image is multi-line, accumulate until closing parenthesis
+            if ')' not in image_part:
+                parts = [image_part]
+                k = j + 1
+                while k < len(region):
+                    next_line = region[k].text() if isinstance(region[k], ImageBlock) else region[k]
+                    next_line = next_line.rstrip('\n')
+                    parts.append(next_line)
+                    if ')' in next_line:
+                        image_end = k
+                        break
+                    k += 1
+                image_data = '\n'.join(parts)
+                j = image_end
+            size_bytes = int(len(image_data) * 3 / 4) if base64_start != -1 else 0
+            images.append({
+                "type": image_type,
+                "image_data": image_data,
+                "line_start": first + offsets[image_start] + 1,
+                "line_end": first + offsets[image_end + 1],
+                "size_bytes": size_bytes,
                 "filename": filepath
             })
-            word_count += len(content.strip().split())
             j += 1
-        diary_entries.append({
-            "dateline": date_line,
-            "dateline_line": date_idx + 1,
-            "filename": filepath,
-            "text": entry_text_lines,
-            "images": images
+            continue
+        # Otherwise, treat as text (skip image blocks)
+        entry_text_lines.append({
+            "text": content.strip(),
+            "line": first + offsets[j] + 1,
+            "filename": filepath
         })
-        total_image_count += image_count
-        total_image_bytes += image_total_size
-        total_word_count += word_count
-    logging.info(f"Finished second pass: processed {len(date_indices)} diary entries.")
-    logging.info(f"Finished processing {total} lines. {len(date_indices)} date-like lines found.")
-    logging.info(f"SUMMARY: {len(date_indices)} diary entries, {total_image_count} images, {total_word_count} words, {total_image_bytes} image bytes.")
-    return diary_entries
+        j += 1
+    return {
+        "dateline": date_line,
+        "dateline_line": date_idx + 1,
+        "filename": filepath,
+        "text": entry_text_lines,
+        "images": images
+    }
+
+def chunk_sha256(lines):
+    """SHA-256 of raw markdown lines (or ImageBlock items), as recorded per entry for incremental re-conversion."""
+    h = hashlib.sha256()
+    for line in lines:
+        if isinstance(line, ImageBlock):
+            line.update_hash(h)
+        else:
+            h.update(line.encode('utf-8'))
+    return h.hexdigest()
+
+def match_previous_chunks(lines, old_chunks):
+    """
+    Finds entries of the previous conversion whose raw lines (dateline up to the next
+    dateline) appear unchanged in lines, in their old order. Returns [(start, chunk
+    index)]. The old last entry only matches at the end of the file, since text
+    appended after it may belong to it.
+    """
+    by_dateline = collections.defaultdict(list)
+    for idx, chunk in enumerate(old_chunks):
+        by_dateline[chunk["dateline"]].append(idx)
+    matches = []
+    last = -1
+    p = 0
+    while p < len(lines):
+        matched = None
+        for idx in by_dateline.get(lines[p].strip(), ()):
+            n = old_chunks[idx]["lines"]
+            if idx <= last or p + n > len(lines):
+                continue
+            if idx == len(old_chunks) - 1 and p + n != len(lines):
+                continue
+            if chunk_sha256(lines[p:p + n]) == old_chunks[idx]["sha256"]:
+                matched = idx
+                break
+        if matched is None:
+            p += 1
+            continue
+        matches.append((p, matched))
+        last = matched
+        p += old_chunks[matched]["lines"]
+    return matches
+
+def plan_incremental(lines, old_chunks, classify):
+    """
+    Splits the file into entries re-used from the previous conversion and regions to
+    parse. Returns ("reuse", start, chunk index) and ("parse", items) segments in
+    file order; classify(start) yields the resolved (index, line, verdict, reference)
+    items of the lines from start on.
+    A region ends at the first re-used entry whose dateline is still a dateline there;
+    entries it runs into (e.g. through an unclosed image) are parsed as part of it.
+    A re-used entry followed by anything but a dateline is parsed again as well.
+    """
+    matches = match_previous_chunks(lines, old_chunks)
+    segments = []
+    pos = 0
+    k = 0
+    while pos < len(lines):
+        while k < len(matches) and matches[k][0] < pos:
+            k += 1
+        if k < len(matches) and matches[k][0] == pos:
+            segments.append(("reuse", pos, matches[k][1]))
+            pos += old_chunks[matches[k][1]]["lines"]
+            k += 1
+            continue
+        items = []
+        for item in classify(pos):
+            while k < len(matches) and matches[k][0] < item[0]:
+                k += 1
+            if k < len(matches) and matches[k][0] == item[0]:
+                if item[2]:
+                    break
+                k += 1
+            items.append(item)
+        if segments and segments[-1][0] == "reuse" and not items[0][2]:
+            # The previous entry continues into this region
+            pos = segments.pop()[1]
+            continue
+        segments.append(("parse", items))
+        pos = items[-1][0] + 1
+    return segments
+
+def shift_entry(entry, delta):
+    """Moves the line numbers of a re-used entry by delta lines."""
+    entry["dateline_line"] += delta
+    for text_obj in entry["text"]:
+        text_obj["line"] += delta
+    for img in entry["images"]:
+        img["line_start"] += delta
+        img["line_end"] += delta
+    return entry
+
+def iter_diary_entries(filepath, dateline_max_length=80, verify_classifier=False, ner_batch_size=256, ner_processes=1, verdict_cache_path=None, verdict_cache_size=200000, previous=None, chunks=None):
+    """
+    Single pass over the markdown file that yields each diary entry as soon as the
+    next dateline (or the end of the file) closes it. Only the lines of the open
+    entry, plus lines waiting on a spaCy batch, are held in memory. Each entry
+    gets the ISO "date" of its dateline (see entry_index.DateNormalizer), or None.
+
+    previous=(entries, state) from load_previous_conversion switches to incremental
+    mode: the file is read whole, entries whose raw lines are unchanged are re-used
+    with their line numbers shifted, and only the regions between them are classified
+    and parsed. chunks, when given, receives the incremental state record of every
+    yielded entry.
+    """
+    metrics = run_metrics.active()
+    nlp = lazy_spacy_model()
+    cache = VerdictCache(verdict_cache_path, verdict_cache_namespace(nlp), verdict_cache_size) if verdict_cache_path else None
+    classifier = DateLineClassifier(nlp, max_length=dateline_max_length, cache=cache)
+    reference_nlp = nlp if verify_classifier else None
+    mismatches = 0
+    total = 0
+    summary = {"entries": 0, "images": 0, "words": 0, "image_bytes": 0}
+    from entry_index import DateNormalizer
+    dates = DateNormalizer()
+
+    def tally(entry):
+        # Every entry, re-used ones included, is dated against the entry before it now
+        date = dates.date_of(entry["dateline"])
+        entry = {"dateline": entry["dateline"], "date": date, **{key: value for key, value in entry.items() if key not in ("dateline", "date")}}
+        metrics.count("entries")
+        summary["entries"] += 1
+        summary["images"] += len(entry["images"])
+        summary["image_bytes"] += sum(img["size_bytes"] for img in entry["images"])
+        summary["words"] += sum(len(t["text"].split()) for t in entry["text"])
+        # Log every diary entry (dateline) as it is processed
+        logging.info(f"Processing DIARY ENTRY {summary['entries']}: dateline at line {entry['dateline_line']}: {entry['dateline']}")
+        return entry
+
+    def close_entry(date_idx, date_raw, region):
+        if chunks is not None:
+            chunks.append({"dateline": date_raw.strip(), "line": date_idx + 1, "lines": sum(map(line_count, region)) + 1, "sha256": chunk_sha256([date_raw] + region)})
+        return tally(build_entry(filepath, date_idx, date_raw.strip(), region))
+
+    def split(items):
+        # Groups classified lines into entries; lines before the first dateline are dropped
+        nonlocal mismatches, total
+        date_idx = None
+        date_raw = None
+        region = []
+        announce_next = False
+        for i, line, verdict, reference in items:
+            total = max(total, i + line_count(line))
+            # Log the line after each dateline for debugging/robustness
+            if announce_next:
+                logging.info(f"  Next line after dateline: {line.strip() if isinstance(line, str) else IMAGE_MARKER + line.image_type + ';...'}")
+                announce_next = False
+            if reference is not None and reference != verdict:
+                mismatches += 1
+                logging.warning(f"Classifier mismatch at line {i+1}: tiered={verdict}, reference={reference}: {line.strip()}")
+            if not verdict:
+                if date_idx is not None:
+                    region.append(line)
+                continue
+            logging.info(f"Semantic element detected: DATELINE at line {i+1}")
+            logging.info(f"Date detected at line {i+1}: {line.strip()}")
+            announce_next = True
+            if date_idx is not None:
+                yield close_entry(date_idx, date_raw, region)
+            date_idx, date_raw, region = i, line, []
+        if announce_next:
+            logging.info(f"  No next line after dateline (end of file)")
+        if date_idx is not None:
+            yield close_entry(date_idx, date_raw, region)
+
+    logging.info(f"Processing {filepath}...")
+    try:
+        if previous is None:
+            with contextlib.ExitStack() as stack:
+                with metrics.stage("file_read"):
+                    buffer = map_markdown(filepath, stack)
+                if buffer is not None:
+                    scanned = scan_markdown_buffer(buffer, classifier, reference_nlp)
+                else:
+                    f = stack.enter_context(open(filepath, 'r', encoding='utf-8'))
+                    scanned = scan_markdown_lines(metrics.iterate("file_read", f), classifier, reference_nlp)
+                scanned = metrics.iterate("first_pass", scanned)
+                yield from metrics.iterate("second_pass", split(resolve_ner_verdicts(scanned, classifier, ner_batch_size, ner_processes)))
+        else:
+            old_entries, state = previous
+            old_chunks = state["chunks"]
+            with metrics.stage("file_read"), open(filepath, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            total = len(lines)
+
+            def classify(start):
+                scanned = scan_markdown_lines((lines[j] for j in range(start, len(lines))), classifier, reference_nlp, start)
+                return resolve_ner_verdicts(metrics.iterate("first_pass", scanned), classifier, ner_batch_size, ner_processes)
+
+            old = enumerate(old_entries)
+            reused = 0
+            parsed_lines = 0
+            for segment in plan_incremental(lines, old_chunks, classify):
+                if segment[0] == "parse":
+                    parsed_lines += len(segment[1])
+                    yield from metrics.iterate("second_pass", split(segment[1]))
+                    continue
+                _, start, idx = segment
+                for old_idx, entry in old:
+                    if old_idx == idx:
+                        break
+                chunk = old_chunks[idx]
+                if chunks is not None:
+                    chunks.append(dict(chunk, line=start + 1))
+                reused += 1
+                yield tally(shift_entry(entry, start + 1 - chunk["line"]))
+            logging.info(f"Incremental: re-used {reused} of {len(old_chunks)} previous entries, parsed {parsed_lines} of {len(lines)} lines")
+    finally:
+        logging.info(classifier.report())
+        for tier, lines_decided in classifier.stats.items():
+            metrics.count(f"tier_{tier}", lines_decided)
+        if cache is not None:
+            with metrics.stage("verdict_cache"):
+                cache.close()
+            metrics.count("verdict_cache_hits", cache.hits)
+            metrics.count("verdict_cache_misses", cache.misses)
+            logging.info(cache.report())
+    if verify_classifier:
+        logging.info(f"Classifier verification: {mismatches} mismatches against is_date_line")
+    metrics.count("lines", total)
+    metrics.count("images", summary["images"])
+    metrics.count("image_bytes", summary["image_bytes"])
+    metrics.count("words", summary["words"])
+    logging.info(f"Finished processing {total} lines. {summary['entries']} date-like lines found.")
+    logging.info(f"SUMMARY: {summary['entries']} diary entries, {summary['images']} images, {summary['words']} words, {summary['image_bytes']} image bytes.")
+
+def extract_date_lines(filepath, **options):
+    """
+    Returns every diary entry of the markdown file as a list (see iter_diary_entries).
+    """
+    return list(iter_diary_entries(filepath, **options))
+
+class DiaryTotals:
+    """The metadata block of a diary document, totalled entry by entry."""
+
+    def __init__(self):
+        self.num_entries = 0
+        self.total_images = 0
+        self.total_words = 0
+        self.total_image_bytes = 0
+        self.line_min = None
+        self.line_max = None
+        self.first_entry = None
+        self.last_entry = None
+
+    def _track_line(self, line_num):
+        if self.line_min is None or line_num < self.line_min:
+            self.line_min = line_num
+        if self.line_max is None or line_num > self.line_max:
+            self.line_max = line_num
+
+    def add(self, entry):
+        for t in entry["text"]:
+            self._track_line(t["line"])
+            self.total_words += len(t["text"].split())
+        for img in entry["images"]:
+            self.total_images += 1
+            self.total_image_bytes += img.get("size_bytes", 0)
+            self._track_line(img["line_start"])
+            self._track_line(img["line_end"])
+        if self.first_entry is None:
+            self.first_entry = entry["dateline"]
+        self.last_entry = entry["dateline"]
+        self.num_entries += 1
+
+    def metadata(self):
+        return {
+            "num_entries": self.num_entries,
+            "line_range": [self.line_min, self.line_max],
+            "total_images": self.total_images,
+            "total_words": self.total_words,
+            "total_image_bytes": self.total_image_bytes,
+            "first_entry": self.first_entry,
+            "last_entry": self.last_entry
+        }
+
+class DiaryJSONWriter:
+    """
+    Writes the diary document one entry at a time, so only the entry being written
+    is held in memory. Metadata totals are kept as entries arrive and the metadata
+    block is written after the entries on close(); the layout matches json.dump
+    with indent=2, or has no whitespace at all when compact. With index, the byte
+    offset, length and date of every entry are kept in .index for the entry index
+    sidecar (see entry_index.py).
+    """
+
+    def __init__(self, f, compact=False, index=False):
+        self.f = f
+        self.compact = compact
+        self.totals = DiaryTotals()
+        self.index = None
+        if index:
+            from entry_index import DateNormalizer
+            self.index = []
+            self.dates = DateNormalizer()
+        header = '{"entries":[' if compact else '{\n  "entries": ['
+        self.offset = len(header)
+        self.f.write(header)
+
+    def _dumps(self, obj, depth):
+        if self.compact:
+            return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+        # JSON strings never contain raw newlines, so indenting by line is safe
+        return json.dumps(obj, ensure_ascii=False, indent=2).replace('\n', '\n' + '  ' * depth)
+
+    def write_entry(self, entry):
+        separator = ',' if self.totals.num_entries else ''
+        if not self.compact:
+            separator += '\n    '
+        self.totals.add(entry)
+        text = self._dumps(entry, 2)
+        self.f.write(separator + text)
+        if self.index is not None:
+            length = len(text.encode('utf-8'))
+            self.index.append([self.offset + len(separator), length, self.dates.date_of(entry["dateline"], entry.get("date"))])
+            self.offset += len(separator) + length
+
+    def metadata(self):
+        return self.totals.metadata()
+
+    def close(self):
+        metadata = self.metadata()
+        if self.compact:
+            self.f.write('],"metadata":' + self._dumps(metadata, 1) + '}')
+        else:
+            closing = '\n  ],' if self.totals.num_entries else '],'
+            self.f.write(closing + '\n  "metadata": ' + self._dumps(metadata, 1) + '\n}')
+        return metadata
+
+def write_diary_json(entries, output_json, compact=False, index=False):
+    """
+    Streams entries into output_json through a temporary file that replaces the
+    output only once the document is complete. With index, also writes the entry
+    index sidecar (see entry_index.py). Returns the metadata block.
+    """
+    tmp_path = output_json + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        writer = DiaryJSONWriter(f, compact=compact, index=index)
+        for entry in entries:
+            with run_metrics.stage("json_write"):
+                writer.write_entry(entry)
+        with run_metrics.stage("json_write"):
+            metadata = writer.close()
+    os.replace(tmp_path, output_json)
+    if index:
+        from entry_index import write_entry_index
+        write_entry_index(output_json, writer.index)
+    return metadata
+
+# Bump when build_entry or the state layout changes
+INCREMENTAL_STATE_VERSION = 1
+
+def incremental_state_path(output_json):
+    return os.path.splitext(output_json)[0] + '.convstate.json'
+
+def conversion_fingerprint(filepath, image_store, options):
+    """Settings that must match for entries of a previous conversion to be re-used."""
+    return {
+        "version": INCREMENTAL_STATE_VERSION,
+        "filename": filepath,
+        "dateline_max_length": options.get("dateline_max_length", 80),
+        "classifier": verdict_cache_namespace(lazy_spacy_model()),
+        "image_store": image_store is not None,
+    }
+
+def iter_previous_entries(json_path):
+    """Streams the entries of an earlier JSON output (with ijson when installed)."""
+    try:
+        import ijson
+    except ImportError:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            yield from json.load(f).get("entries", [])
+        return
+    with open(json_path, 'rb') as f:
+        yield from ijson.items(f, "entries.item", use_float=True)
+
+def load_previous_conversion(output_json, fingerprint):
+    """
+    Returns (entries, state) of the previous conversion to output_json when its state
+    sidecar matches the settings and the JSON file is the one it describes, else None.
+    """
+    state_path = incremental_state_path(output_json)
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        st = os.stat(output_json)
+    except (OSError, ValueError):
+        logging.info(f"Incremental: no usable state in {state_path}; converting the whole file")
+        return None
+    if state.get("fingerprint") != fingerprint:
+        logging.info(f"Incremental: settings changed since the last conversion; converting the whole file")
+        return None
+    if state.get("json") != [st.st_size, st.st_mtime_ns]:
+        logging.info(f"Incremental: {output_json} changed since the last conversion; converting the whole file")
+        return None
+    return run_metrics.active().iterate("json_load", iter_previous_entries(output_json)), state
+
+def save_conversion_state(output_json, fingerprint, chunks):
+    st = os.stat(output_json)
+    state_path = incremental_state_path(output_json)
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({"fingerprint": fingerprint, "json": [st.st_size, st.st_mtime_ns], "chunks": chunks}, f)
+    os.replace(state_path + '.tmp', state_path)
+
+def convert_markdown_file(filepath, output_json=None, image_store=None, compact=False, incremental=False, diary_store=None, metrics=None, profile=None, **options):
+    """
+    Converts a markdown diary to JSON (default: <input>.json), streaming the entries
+    of iter_diary_entries(filepath, **options) to disk. image_store is a directory for
+    content-addressed images ('' for <output>_images), or None to inline base64.
+    With incremental, entries unchanged since the previous conversion are re-used
+    from the existing output (see iter_diary_entries) and a <output>.convstate.json
+    sidecar is kept for the next run. A <output>.entryindex.json sidecar records
+    where each entry starts, for diary_json2pdf.py --from/--to/--entries (see
+    entry_index.py). metrics is a file for the stage timings and
+    counters of the conversion ('' for <output>.convert.metrics.json, see
+    run_metrics.py) and profile one for cProfile stats ('' for <output>.convert.prof).
+    diary_store writes an SQLite diary store (see diary_store.py) to that file
+    instead of JSON ('' for <input>.sqlite). Returns the output path.
+    """
+    if diary_store is not None:
+        if incremental or image_store is not None:
+            raise ValueError("diary_store cannot be combined with incremental or image_store")
+        output_json = diary_store or os.path.splitext(filepath)[0] + '.sqlite'
+    output_json = output_json or os.path.splitext(filepath)[0] + '.json'
+    base = os.path.splitext(output_json)[0]
+    metrics_path = (metrics or base + '.convert.metrics.json') if metrics is not None else None
+    profile_path = (profile or base + '.convert.prof') if profile is not None else None
+    with run_metrics.collecting(metrics_path, profile_path, tool="diary_markdown2json", input=filepath, output=output_json):
+        if diary_store is not None:
+            _convert_to_diary_store(filepath, output_json, options)
+        else:
+            _convert_markdown_file(filepath, output_json, image_store, compact, incremental, options)
+    return output_json
+
+def _convert_to_diary_store(filepath, store_path, options):
+    from diary_store import write_diary_store
+    logging.info(f"Writing structured diary entries to the diary store {store_path}")
+    metadata = write_diary_store(iter_diary_entries(filepath, **options), store_path, source=filepath)
+    logging.info(f"Metadata: {metadata}")
+    logging.info(f"Wrote structured diary entries to {store_path}")
+
+def _convert_markdown_file(filepath, output_json, image_store, compact, incremental, options):
+    chunks = None
+    if incremental:
+        fingerprint = conversion_fingerprint(filepath, image_store, options)
+        options = dict(options, previous=load_previous_conversion(output_json, fingerprint), chunks=[])
+        chunks = options["chunks"]
+    diary_entries = iter_diary_entries(filepath, **options)
+    store = None
+    if image_store is not None:
+        from image_store import ImageBlobStore
+        store = ImageBlobStore(image_store or os.path.splitext(output_json)[0] + '_images')
+        json_dir = os.path.dirname(os.path.abspath(output_json))
+
+        def externalize(entry):
+            # Re-used entries of an incremental run already reference stored images
+            with run_metrics.stage("image_store"):
+                return dict(entry, images=[store.externalize(img, json_dir) if "image_data" in img else img for img in entry["images"]])
+
+        diary_entries = (externalize(entry) for entry in diary_entries)
+    # Write to JSON file, one entry at a time
+    logging.info(f"Writing structured diary entries to {output_json}")
+    metadata = write_diary_json(diary_entries, output_json, compact=compact, index=True)
+    logging.info(f"Metadata: {metadata}")
+    if store is not None:
+        logging.info(store.report())
+    if chunks is not None:
+        save_conversion_state(output_json, fingerprint, chunks)
+    logging.info(f"Wrote structured diary entries to {output_json}")
 
 def main():
     import argparse
     parser_ = argparse.ArgumentParser(description="Detect date-like lines in a markdown file using spaCy.")
     parser_.add_argument("markdown_file", help="Path to the markdown file to process.")
     parser_.add_argument("--log", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    parser_.add_argument("--dateline_max_length", type=int, default=80, help="Lines longer than this are never treated as datelines (default: 80)")
+    parser_.add_argument("--ner_batch_size", type=int, default=256, help="Lines per spaCy nlp.pipe batch for the NER fallback (default: 256)")
+    parser_.add_argument("--ner_processes", type=int, default=1, help="Processes for the NER fallback; -1 uses every core (default: 1)")
+    parser_.add_argument("--verdict_cache", default=None, help="SQLite file of cached dateline verdicts (default: next to the input, <input>.datecache.sqlite)")
+    parser_.add_argument("--no_verdict_cache", action="store_true", help="Decide every line from scratch without reading or writing the verdict cache")
+    parser_.add_argument("--verdict_cache_size", type=int, default=200000, help="Maximum cached verdicts before least recently used ones are evicted (default: 200000)")
+    parser_.add_argument("--image_store", nargs='?', const='', default=None, help="Store each image once as a file in this content-addressed directory and reference it by SHA-256 instead of inlining base64 (default directory: <output>_images)")
+    parser_.add_argument("--compact", action="store_true", help="Write JSON without indentation or spaces between items")
+    parser_.add_argument("--incremental", action="store_true", help="Re-use entries unchanged since the previous conversion and only parse edited or new regions (state kept in <output>.convstate.json)")
+    parser_.add_argument("--sqlite", nargs='?', const='', default=None, help="Write an SQLite diary store with date and full-text indexes instead of JSON, for diary_json2pdf.py --from/--to/--query (default file: <input>.sqlite)")
+    parser_.add_argument("--verify_classifier", action="store_true", help="Also run the untiered is_date_line on every line and log any disagreement (slow)")
+    parser_.add_argument("--metrics", nargs='?', const='', default=None, help="Write stage timings, counters, throughput and peak memory of the conversion to this JSON file (default file: <output>.convert.metrics.json)")
+    parser_.add_argument("--cprofile", nargs='?', const='', default=None, help="Run the conversion under cProfile and dump the stats to this file (default file: <output>.convert.prof)")
+    parser_.add_argument("--import_profile", "--import-profile", action="store_true", help="Log the time spent importing each module during the run (spaCy and its model are only imported when a line needs NER)")
     args = parser_.parse_args()
+    from import_profile import log_import_profile, start_import_profile
+    profiler = start_import_profile(args.import_profile)
 
     logging.basicConfig(
         level=getattr(logging, args.log.upper(), None),
         format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s'
     )
 
-    import os
     filepath = args.markdown_file
-    output_json = os.path.splitext(filepath)[0] + '.json'
-    diary_entries = extract_date_lines(filepath)
-    # Compute metadata
-    total_entries = len(diary_entries)
-    total_lines = 0
-    total_images = 0
-    total_words = 0
-    total_image_bytes = 0
-    line_min = None
-    line_max = None
-    for entry in diary_entries:
-        if entry["text"]:
-            for t in entry["text"]:
-                line_num = t["line"]
-                if line_min is None or line_num < line_min:
-                    line_min = line_num
-                if line_max is None or line_num > line_max:
-                    line_max = line_num
-                total_lines += 1
-                total_words += len(t["text"].split())
-        if entry["images"]:
-            for img in entry["images"]:
-                total_images += 1
-                total_image_bytes += img.get("size_bytes", 0)
-                if line_min is None or img["line_start"] < line_min:
-                    line_min = img["line_start"]
-                if line_max is None or img["line_end"] > line_max:
-                    line_max = img["line_end"]
-    first_entry = diary_entries[0]["dateline"] if diary_entries else None
-    last_entry = diary_entries[-1]["dateline"] if diary_entries else None
-    metadata = {
-        "num_entries": total_entries,
-        "line_range": [line_min, line_max],
-        "total_images": total_images,
-        "total_words": total_words,
-        "total_image_bytes": total_image_bytes,
-        "first_entry": first_entry,
-        "last_entry": last_entry
-    }
-    output = {
-        "metadata": metadata,
-        "entries": diary_entries
-    }
-    logging.info(f"Metadata: {metadata}")
-    # Write to JSON file
-    logging.info(f"Writing structured diary entries to {output_json}")
-    import json
-    with open(output_json, 'w', encoding='utf-8') as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
-    logging.info(f"Wrote structured diary entries to {output_json}")
+    if args.sqlite is not None and (args.incremental or args.image_store is not None):
+        parser_.error("--sqlite cannot be combined with --incremental or --image_store")
+    verdict_cache_path = None
+    if not args.no_verdict_cache:
+        verdict_cache_path = args.verdict_cache or os.path.splitext(filepath)[0] + '.datecache.sqlite'
+    convert_markdown_file(
+        filepath,
+        image_store=args.image_store,
+        compact=args.compact,
+        incremental=args.incremental,
+        diary_store=args.sqlite,
+        metrics=args.metrics,
+        profile=args.cprofile,
+        dateline_max_length=args.dateline_max_length,
+        verify_classifier=args.verify_classifier,
+        ner_batch_size=args.ner_batch_size,
+        ner_processes=args.ner_processes,
+        verdict_cache_path=verdict_cache_path,
+        verdict_cache_size=args.verdict_cache_size
+    )
+    log_import_profile(profiler)
 
 if __name__ == "__main__":
     main()
-import logging
-import spacy
-from dateutil import parser
-
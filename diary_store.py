@@ -0,0 +1,254 @@
+"""
+SQLite diary store, an alternative to the single JSON document: entries, their
+text lines and their images in separate tables, with image bytes in their own
+table (stored once per SHA-256), an index on the parsed date of each entry and
+an FTS5 full-text index over the text lines. diary_markdown2json.py --sqlite
+writes it, and diary_json2pdf.py renders from it with --from/--to/--query,
+reading one entry at a time.
+"""
+import base64
+import binascii
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+# Bump when the tables below change
+STORE_SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE entries (
+    id INTEGER PRIMARY KEY, dateline TEXT NOT NULL, dateline_line INTEGER NOT NULL,
+    filename TEXT NOT NULL, date TEXT);
+CREATE INDEX entries_date ON entries (date);
+CREATE TABLE text_lines (
+    id INTEGER PRIMARY KEY, entry_id INTEGER NOT NULL REFERENCES entries (id),
+    text TEXT NOT NULL, line INTEGER NOT NULL, filename TEXT NOT NULL);
+CREATE INDEX text_lines_entry ON text_lines (entry_id);
+CREATE TABLE image_blobs (sha256 TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE images (
+    id INTEGER PRIMARY KEY, entry_id INTEGER NOT NULL REFERENCES entries (id),
+    type TEXT, sha256 TEXT REFERENCES image_blobs (sha256), width INTEGER, height INTEGER,
+    image_data TEXT, line_start INTEGER NOT NULL, line_end INTEGER NOT NULL,
+    size_bytes INTEGER NOT NULL, filename TEXT NOT NULL);
+CREATE INDEX images_entry ON images (entry_id);
+"""
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+def is_diary_store(path):
+    """True when path is an SQLite file (a diary store) rather than a JSON document."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+def date_bounds(date_from=None, date_to=None):
+    """
+    ISO bounds [low, high) of the entries dated from date_from to date_to inclusive
+    (YYYY-MM-DD strings or dates; either may be None for an open end).
+    """
+    low = datetime.date.fromisoformat(str(date_from)).isoformat() if date_from else None
+    high = (datetime.date.fromisoformat(str(date_to)) + datetime.timedelta(days=1)).isoformat() if date_to else None
+    return low, high
+
+class DiaryStoreWriter:
+    """
+    Writes diary entries (as yielded by iter_diary_entries) to a new store at path,
+    one entry at a time, through a temporary file that replaces path on close().
+    Inline base64 images are decoded into image_blobs; images that cannot be
+    decoded keep their image_data, as with --image_store. Entries get the date
+    their dateline parses to, with missing fields taken from the previous entry.
+    """
+
+    def __init__(self, path, source=None):
+        from diary_markdown2json import DiaryTotals
+        from entry_index import DateNormalizer
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.conn = sqlite3.connect(self.tmp_path)
+        # The file only replaces path once complete, so no journal is needed
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.executescript(SCHEMA)
+        self.fts = True
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE text_fts USING fts5(text, content='text_lines', content_rowid='id')")
+        except sqlite3.OperationalError as e:
+            logging.warning(f"SQLite has no FTS5 ({e}); --query will scan the text instead")
+            self.fts = False
+        self.source = source
+        self.totals = DiaryTotals()
+        self.dates = DateNormalizer()
+        self.stored_blobs = 0
+        self.deduplicated = 0
+
+    def _put_image(self, entry_id, img):
+        if "image_data" not in img:
+            # Already externalized; the store keeps its own copy of the bytes
+            raise ValueError("DiaryStoreWriter needs inline images (do not combine --sqlite with --image_store)")
+        from image_store import base64_payload, image_dimensions
+        payload = base64_payload(img["image_data"])
+        try:
+            data = base64.b64decode(payload, validate=True) if payload else None
+        except (binascii.Error, ValueError):
+            data = None
+        sha256 = width = height = None
+        image_data = None
+        size_bytes = img["size_bytes"]
+        if data:
+            sha256 = hashlib.sha256(data).hexdigest()
+            cursor = self.conn.execute("INSERT OR IGNORE INTO image_blobs (sha256, data) VALUES (?, ?)", (sha256, data))
+            if cursor.rowcount:
+                self.stored_blobs += 1
+            else:
+                self.deduplicated += 1
+            width, height = image_dimensions(data)
+            size_bytes = len(data)
+        else:
+            logging.warning(f"Keeping image at lines {img['line_start']}-{img['line_end']} inline: no decodable base64 data")
+            image_data = img["image_data"]
+        self.conn.execute(
+            "INSERT INTO images (entry_id, type, sha256, width, height, image_data, line_start, line_end, size_bytes, filename) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry_id, img["type"], sha256, width, height, image_data, img["line_start"], img["line_end"], size_bytes, img["filename"]),
+        )
+        return dict(img, size_bytes=size_bytes)
+
+    def write_entry(self, entry):
+        date = self.dates.date_of(entry["dateline"], entry.get("date"))
+        cursor = self.conn.execute(
+            "INSERT INTO entries (dateline, dateline_line, filename, date) VALUES (?, ?, ?, ?)",
+            (entry["dateline"], entry["dateline_line"], entry["filename"], date),
+        )
+        entry_id = cursor.lastrowid
+        self.conn.executemany(
+            "INSERT INTO text_lines (entry_id, text, line, filename) VALUES (?, ?, ?, ?)",
+            ((entry_id, t["text"], t["line"], t["filename"]) for t in entry["text"]),
+        )
+        images = [self._put_image(entry_id, img) for img in entry["images"]]
+        # Metadata counts decoded image bytes, as for --image_store
+        self.totals.add(dict(entry, images=images))
+
+    def close(self):
+        """Builds the full-text index, records the metadata and moves the store into place; returns the metadata."""
+        metadata = self.totals.metadata()
+        if self.fts:
+            self.conn.execute("INSERT INTO text_fts (text_fts) VALUES ('rebuild')")
+        meta = {
+            "schema_version": STORE_SCHEMA_VERSION,
+            "metadata": metadata,
+            "source": self.source,
+            "fts": self.fts,
+        }
+        self.conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", ((key, json.dumps(value)) for key, value in meta.items()))
+        self.conn.commit()
+        self.conn.close()
+        os.replace(self.tmp_path, self.path)
+        return metadata
+
+    def report(self):
+        return f"Diary store {self.path}: {self.stored_blobs} images stored, {self.deduplicated} duplicates skipped"
+
+def write_diary_store(entries, path, source=None):
+    """Streams entries into a new store at path; returns the metadata block."""
+    import run_metrics
+    writer = DiaryStoreWriter(path, source)
+    try:
+        for entry in entries:
+            with run_metrics.stage("store_write"):
+                writer.write_entry(entry)
+    except BaseException:
+        writer.conn.close()
+        os.remove(writer.tmp_path)
+        raise
+    with run_metrics.stage("store_write"):
+        metadata = writer.close()
+    logging.info(writer.report())
+    return metadata
+
+@functools.lru_cache(maxsize=None)
+def _connect(path, pid):
+    return sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, check_same_thread=False)
+
+def _read_connection(path):
+    # One read-only connection per process: a connection must not be used across fork
+    return _connect(path, os.getpid())
+
+def read_store_meta(path):
+    return {key: json.loads(value) for key, value in _read_connection(path).execute("SELECT key, value FROM meta")}
+
+def store_image_bytes(path, sha256):
+    """The bytes of an image in the store, or None."""
+    row = _read_connection(path).execute("SELECT data FROM image_blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    return bytes(row[0]) if row else None
+
+def iter_store_entries(path, date_from=None, date_to=None, query=None, entries=None):
+    """
+    Yields the entries of a store in file order, as dicts shaped like the JSON
+    entries, reading one entry's rows at a time. date_from/date_to (inclusive,
+    YYYY-MM-DD) keep the entries dated in that range, entries (a list of
+    zero-based (start, stop) ranges, stop exclusive or None, see
+    entry_index.parse_entry_ranges) those at these positions, and query those with
+    a text line matching the FTS5 query (a case-insensitive substring without
+    FTS5). Images carry their sha256 and "store" (this path) instead of image
+    bytes; store_image_bytes reads them when needed.
+    """
+    conn = _read_connection(path)
+    meta = read_store_meta(path)
+    if meta.get("schema_version") != STORE_SCHEMA_VERSION:
+        raise ValueError(f"{path}: diary store schema {meta.get('schema_version')}, expected {STORE_SCHEMA_VERSION}")
+    low, high = date_bounds(date_from, date_to)
+    conditions = []
+    params = []
+    if low is not None:
+        conditions.append("date >= ?")
+        params.append(low)
+    if high is not None:
+        conditions.append("date < ?")
+        params.append(high)
+    if entries:
+        # Entries are numbered from 1 in file order
+        ranges = []
+        for start, stop in entries:
+            ranges.append("(id > ?" + ("" if stop is None else " AND id <= ?") + ")")
+            params.extend([start] if stop is None else [start, stop])
+        conditions.append("(" + " OR ".join(ranges) + ")")
+    if query:
+        if meta.get("fts"):
+            conditions.append("id IN (SELECT entry_id FROM text_lines WHERE id IN (SELECT rowid FROM text_fts WHERE text_fts MATCH ?))")
+            params.append(query)
+        else:
+            conditions.append("id IN (SELECT entry_id FROM text_lines WHERE text LIKE ?)")
+            params.append(f"%{query}%")
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    store = os.path.abspath(path)
+    rows = conn.execute(f"SELECT id, dateline, dateline_line, filename, date FROM entries{where} ORDER BY id", params)
+    for entry_id, dateline, dateline_line, filename, date in rows:
+        text = [
+            {"text": text, "line": line, "filename": text_filename}
+            for text, line, text_filename in conn.execute("SELECT text, line, filename FROM text_lines WHERE entry_id = ? ORDER BY id", (entry_id,))
+        ]
+        images = []
+        for image_type, sha256, width, height, image_data, line_start, line_end, size_bytes, image_filename in conn.execute(
+            "SELECT type, sha256, width, height, image_data, line_start, line_end, size_bytes, filename FROM images WHERE entry_id = ? ORDER BY id",
+            (entry_id,),
+        ):
+            img = {"type": image_type}
+            if sha256 is not None:
+                img.update({"sha256": sha256, "store": store, "width": width, "height": height})
+            else:
+                img["image_data"] = image_data
+            img.update({"line_start": line_start, "line_end": line_end, "size_bytes": size_bytes, "filename": image_filename})
+            images.append(img)
+        entry = {"dateline": dateline, "dateline_line": dateline_line, "filename": filename, "text": text, "images": images}
+        if date is not None:
+            entry["date"] = date
+        yield entry
@@ -0,0 +1,182 @@
+"""
+Sidecar index of a diary JSON (<json>.entryindex.json): the byte offset and
+length of every entry in the file and the date its dateline stands for, so
+that a selection of entries (diary_json2pdf.py --from/--to/--entries) is read
+by seeking to those entries instead of parsing the whole document.
+diary_markdown2json.py writes it with the JSON; diary_json2pdf.py builds it by
+scanning the JSON when it is missing or the JSON changed since.
+"""
+import json
+import logging
+import mmap
+import os
+import re
+
+# Bump when the sidecar layout or date normalization changes
+ENTRY_INDEX_VERSION = 1
+
+# JSON strings (escapes included) and brackets; everything else between entries is skipped
+JSON_TOKEN_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+DATELINE_KEY_RE = re.compile(rb'"dateline"\s*:\s*("[^"\\]*(?:\\.[^"\\]*)*")')
+DATE_KEY_RE = re.compile(rb'"date"\s*:\s*("[^"\\]*"|null)')
+# Where the keys of an entry written by build_entry are found
+ENTRY_HEAD_BYTES = 4096
+
+def entry_index_path(json_path):
+    return os.path.splitext(json_path)[0] + '.entryindex.json'
+
+class DateNormalizer:
+    """
+    ISO date of each entry in file order: the entry's own "date" when it has one,
+    else its dateline parsed with missing fields (usually the year) taken from
+    the previous dated entry. None when the dateline has no readable date.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def date_of(self, dateline, date=None):
+        import datetime
+        if date is None:
+            from detect_dates import parse_dateline
+            parsed = parse_dateline(dateline, self.previous)
+            date = parsed.isoformat() if parsed else None
+        if date is not None:
+            self.previous = datetime.datetime.fromisoformat(date)
+        return date
+
+def write_entry_index(json_path, entries):
+    """Writes the sidecar of json_path for entries, a list of [offset, length, date] in file order."""
+    st = os.stat(json_path)
+    path = entry_index_path(json_path)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({"version": ENTRY_INDEX_VERSION, "json": [st.st_size, st.st_mtime_ns], "entries": entries}, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+    return path
+
+def load_entry_index(json_path):
+    """The [offset, length, date] of every entry from the sidecar, or None when it is missing or stale."""
+    path = entry_index_path(json_path)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        st = os.stat(json_path)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != ENTRY_INDEX_VERSION or index.get("json") != [st.st_size, st.st_mtime_ns]:
+        logging.info(f"{path} is out of date; rebuilding it")
+        return None
+    return index["entries"]
+
+def scan_entry_offsets(buffer):
+    """
+    Yields (offset, length) of every object in the top-level "entries" array of a
+    diary JSON held in buffer (bytes or mmap), matching strings and brackets with
+    one regex so that image payloads are skipped in C.
+    """
+    depth = 0
+    in_entries = False
+    expect_entries = False
+    start = None
+    for m in JSON_TOKEN_RE.finditer(buffer):
+        token = m.group()
+        first = token[:1]
+        if first == b'"':
+            expect_entries = depth == 1 and not in_entries and token == b'"entries"'
+            continue
+        if first in b'[{':
+            if expect_entries and first == b'[':
+                in_entries = True
+            elif in_entries and depth == 2 and first == b'{':
+                start = m.start()
+            depth += 1
+        else:
+            depth -= 1
+            if in_entries and depth == 2 and start is not None:
+                yield start, m.end() - start
+                start = None
+            elif in_entries and depth == 1:
+                return
+        expect_entries = False
+
+def entry_head_fields(buffer, offset, length):
+    """(dateline, date) of the entry at offset, read from the start of the entry (date None when not recorded)."""
+    head = buffer[offset:offset + min(length, ENTRY_HEAD_BYTES)]
+    dateline = DATELINE_KEY_RE.search(head)
+    if dateline is None:
+        entry = json.loads(buffer[offset:offset + length])
+        return entry.get("dateline", ""), entry.get("date")
+    date = DATE_KEY_RE.search(head)
+    return json.loads(dateline.group(1)), json.loads(date.group(1)) if date else None
+
+def build_entry_index(json_path):
+    """Scans json_path for the offset, length and date of every entry; returns them, saving the sidecar when possible."""
+    entries = []
+    dates = DateNormalizer()
+    with open(json_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return entries
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for offset, length in scan_entry_offsets(buffer):
+                dateline, date = entry_head_fields(buffer, offset, length)
+                entries.append([offset, length, dates.date_of(dateline, date)])
+    try:
+        path = write_entry_index(json_path, entries)
+        logging.info(f"Entry index of {len(entries)} entries written to {path}")
+    except OSError as e:
+        logging.warning(f"Could not write the entry index of {json_path}: {e}")
+    return entries
+
+def parse_entry_ranges(spec):
+    """
+    Entry index ranges from e.g. "0-99,150,200-" (zero-based, inclusive, an open
+    end runs to the last entry) as a list of (start, stop) with stop exclusive or
+    None. Raises ValueError on a malformed range.
+    """
+    ranges = []
+    for part in spec.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, dash, last = part.partition('-')
+        start = int(first)
+        stop = (int(last) + 1 if last else None) if dash else start + 1
+        if start < 0 or (stop is not None and stop <= start):
+            raise ValueError(f"bad entry range {part!r}")
+        ranges.append((start, stop))
+    if not ranges:
+        raise ValueError(f"no entry ranges in {spec!r}")
+    return ranges
+
+def in_ranges(idx, ranges):
+    return any(start <= idx and (stop is None or idx < stop) for start, stop in ranges)
+
+def select_entries(index, date_from=None, date_to=None, entries=None):
+    """Positions in index of the entries dated from date_from to date_to (inclusive) and within the entries ranges."""
+    from diary_store import date_bounds
+    low, high = date_bounds(date_from, date_to)
+    selected = []
+    for idx, (_, _, date) in enumerate(index):
+        if entries is not None and not in_ranges(idx, entries):
+            continue
+        if (low is not None or high is not None) and date is None:
+            continue
+        if (low is not None and date < low) or (high is not None and date >= high):
+            continue
+        selected.append(idx)
+    return selected
+
+def iter_indexed_entries(json_path, date_from=None, date_to=None, entries=None):
+    """
+    Yields the selected entries of a diary JSON in file order, reading each with
+    one seek and read through the entry index (built first when missing or stale).
+    """
+    index = load_entry_index(json_path)
+    if index is None:
+        index = build_entry_index(json_path)
+    selected = select_entries(index, date_from, date_to, entries)
+    logging.info(f"Selected {len(selected)} of {len(index)} entries of {json_path}")
+    with open(json_path, 'rb') as f:
+        for idx in selected:
+            offset, length, date = index[idx]
+            f.seek(offset)
+            yield json.loads(f.read(length))
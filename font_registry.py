@@ -0,0 +1,276 @@
+import functools
+import json
+import logging
+import os
+import sqlite3
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Font trees bundled with the repo, searched after the fonts in the repo root
+BUNDLED_FONT_TREES = ("Inter,Noto_Serif,Space_Mono", "dejavu-fonts-ttf-2.37")
+FONT_EXTENSIONS = (".ttf", ".otf")
+
+# Aliases whose font file is named differently; any other alias is the file name without extension
+FONT_ALIASES = {
+    "WarblerText": "WarblerTextV1.2-Regular",
+    "Inter": "Inter_18pt-Regular",
+    "NotoSerif": "NotoSerif-Regular",
+    "Noto_Serif": "NotoSerif-Regular",
+    "SpaceMono": "SpaceMono-Regular",
+    "Space_Mono": "SpaceMono-Regular",
+    "DejaVu": "DejaVuSans",
+}
+
+# Part of every font metrics cache key; bump when the cached fields change
+FONT_METRICS_VERSION = 1
+# The fpdf2 release series whose private API build_font, text_layout.py and
+# pdf_shards.py were written against; other versions use fpdf's public API only
+FPDF_TESTED_SERIES = (2, 8)
+
+def default_font_dirs(extra_dirs=()):
+    """
+    Font search path: extra_dirs, then $DIARY_FONT_DIRS (os.pathsep separated), the
+    repo root and the bundled font trees.
+    """
+    env_dirs = [d for d in os.environ.get("DIARY_FONT_DIRS", "").split(os.pathsep) if d]
+    bundled = [os.path.join(REPO_DIR, tree) for tree in BUNDLED_FONT_TREES]
+    return list(extra_dirs) + env_dirs + [REPO_DIR] + bundled
+
+def default_font_cache_path():
+    from image_cache import default_cache_dir
+    return os.path.join(default_cache_dir(), "fonts.sqlite")
+
+@functools.lru_cache(maxsize=None)
+def fpdf_internals_supported():
+    """
+    True when the installed fpdf2 is of FPDF_TESTED_SERIES. Otherwise fonts are
+    added with add_font, text goes through multi_cell and shards render serially.
+    """
+    import fpdf
+    try:
+        series = tuple(int(part) for part in fpdf.__version__.split(".")[:2])
+    except ValueError:
+        series = None
+    if series != FPDF_TESTED_SERIES:
+        tested = ".".join(map(str, FPDF_TESTED_SERIES))
+        logging.warning(f"fpdf {fpdf.__version__} is not the tested {tested}.x series; using fpdf's public API only (slower)")
+        return False
+    return True
+
+def _font_files(font_dir):
+    # The repo root is searched flat (it also holds diaries and images); other directories recursively
+    if os.path.abspath(font_dir) == REPO_DIR:
+        walk = [(font_dir, [], os.listdir(font_dir))]
+    else:
+        walk = os.walk(font_dir)
+    for root, dirs, files in walk:
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.lower().endswith(FONT_EXTENSIONS):
+                yield os.path.join(root, name)
+
+def font_metrics(font):
+    """
+    The parsed state of an fpdf TTFFont that does not depend on the document, or
+    None when the font cannot be rebuilt from it (compressed, color or patched fonts).
+    """
+    from fontTools import ttLib
+    if font.is_compressed or font.color_font is not None:
+        return None
+    ttfont = ttLib.TTFont(font.ttffile, recalcTimestamp=False, lazy=True)
+    try:
+        if any(table in ttfont for table in ("COLR", "CBDT", "sbix", "SVG ")):
+            return None
+        if "glyf" in ttfont and ".notdef" not in ttfont["glyf"]:
+            return None
+    finally:
+        ttfont.close()
+    desc = font.desc
+    return {
+        "name": font.name,
+        "scale": font.scale,
+        "is_cff": font.is_cff,
+        "is_cid_keyed": font.is_cid_keyed,
+        "is_symbol": font.is_symbol,
+        "cff_ros": list(font.cff_ros) if font.cff_ros else None,
+        "up": font.up, "ut": font.ut, "sp": font.sp, "ss": font.ss,
+        "desc": {
+            "ascent": desc.ascent,
+            "descent": desc.descent,
+            "cap_height": desc.cap_height,
+            "flags": desc.flags.value,
+            "font_b_box": desc.font_b_box,
+            "italic_angle": desc.italic_angle,
+            "stem_v": desc.stem_v,
+            "missing_width": desc.missing_width,
+        },
+        # cmap order matters: fpdf falls back to its first glyph
+        "cmap": list(font.cmap.items()),
+        "cw": list(font.cw.items()),
+        "glyph_ids": list(font.glyph_ids.items()),
+    }
+
+def build_font(pdf, family, path, metrics):
+    """
+    Creates the fpdf TTFFont of a document from cached metrics, with its own subset map
+    and a lazily opened fontTools font for subsetting on output.
+    """
+    from collections import defaultdict
+    from pathlib import Path
+    from fontTools import ttLib
+    from fpdf.enums import FontDescriptorFlags, TextEmphasis
+    from fpdf.fonts import PDFFontDescriptor, SubsetMap, TTFFont
+    desc = dict(metrics["desc"], flags=FontDescriptorFlags(metrics["desc"]["flags"]))
+    font = TTFFont.__new__(TTFFont)
+    font.i = len(pdf.fonts) + 1
+    font.type = "TTF"
+    font.ttffile = Path(path)
+    font.is_compressed = False
+    font._hbfont = None
+    font.fontkey = family.lower()
+    font.biggest_size_pt = 0
+    font.collection_font_number = 0
+    font.ttfont = ttLib.TTFont(path, recalcTimestamp=False, lazy=True)
+    font.is_cff = metrics["is_cff"]
+    font.is_cid_keyed = metrics["is_cid_keyed"]
+    font.is_symbol = metrics["is_symbol"]
+    font.cff_ros = tuple(metrics["cff_ros"]) if metrics["cff_ros"] else None
+    font.scale = metrics["scale"]
+    font.desc = PDFFontDescriptor(**desc)
+    missing_width = desc["missing_width"]
+    font.cw = defaultdict(lambda: missing_width, metrics["cw"])
+    font.cmap = dict(metrics["cmap"])
+    font.glyph_ids = dict(metrics["glyph_ids"])
+    font.missing_glyphs = []
+    font.name = metrics["name"]
+    font.up, font.ut, font.sp, font.ss = metrics["up"], metrics["ut"], metrics["sp"], metrics["ss"]
+    font.emphasis = TextEmphasis.coerce("")
+    font.subset = SubsetMap(font)
+    font.palette_index = 0
+    font.color_font = None
+    if font.is_cff and font.is_cid_keyed:
+        pdf._set_min_pdf_version("1.6")
+    return font
+
+class FontMetricsCache:
+    """
+    Parsed font metrics in SQLite, keyed by font path, size, modification time and
+    the fpdf version, so fontTools only parses a font file once. The widths in font
+    units of the words text_layout.py has laid out in each font are kept alongside
+    and dropped with the metrics when the font file changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS fonts (path TEXT PRIMARY KEY, key TEXT NOT NULL, metrics TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS word_widths (path TEXT NOT NULL, word TEXT NOT NULL, units INTEGER NOT NULL, PRIMARY KEY (path, word))"
+        )
+
+    @staticmethod
+    def key(path):
+        import fpdf
+        st = os.stat(path)
+        return f"{st.st_size}:{st.st_mtime_ns}:fpdf{fpdf.__version__}:v{FONT_METRICS_VERSION}"
+
+    def get(self, path):
+        """Returns (found, metrics); metrics is None for fonts that cannot be rebuilt from the cache."""
+        row = self.conn.execute("SELECT key, metrics FROM fonts WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != self.key(path):
+            return False, None
+        return True, json.loads(row[1]) if row[1] else None
+
+    def put(self, path, metrics):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO fonts (path, key, metrics) VALUES (?, ?, ?)",
+                (path, self.key(path), json.dumps(metrics) if metrics else None),
+            )
+            self.conn.execute("DELETE FROM word_widths WHERE path = ?", (path,))
+
+    def get_word_widths(self, path):
+        """{word: width in font units} of the font at path; empty unless its metrics are current."""
+        row = self.conn.execute("SELECT key FROM fonts WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != self.key(path):
+            return {}
+        return dict(self.conn.execute("SELECT word, units FROM word_widths WHERE path = ?", (path,)))
+
+    def put_word_widths(self, path, widths):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO word_widths (path, word, units) VALUES (?, ?, ?)",
+                ((path, word, units) for word, units in widths.items()),
+            )
+
+    def close(self):
+        self.conn.close()
+
+class FontRegistry:
+    """
+    Resolves font aliases (e.g. "nyt-cheltenham-normal", "WarblerText", "Inter") to
+    font files on the search path and adds them to FPDF documents on demand. Each
+    font file is parsed at most once per process, and not at all when its metrics
+    are in the on-disk cache.
+    """
+
+    def __init__(self, font_dirs=None, cache_path=None):
+        self.font_dirs = font_dirs if font_dirs is not None else default_font_dirs()
+        self.cache = FontMetricsCache(cache_path) if cache_path else None
+        self._files = None
+        self._metrics = {}
+        self.parsed = 0
+        self.cache_hits = 0
+
+    def resolve(self, alias):
+        """Path of the font file for alias; raises FileNotFoundError when there is none."""
+        if self._files is None:
+            self._files = {}
+            for font_dir in self.font_dirs:
+                if not os.path.isdir(font_dir):
+                    continue
+                for path in _font_files(font_dir):
+                    stem = os.path.splitext(os.path.basename(path))[0].lower()
+                    self._files.setdefault(stem, path)
+        name = FONT_ALIASES.get(alias, alias).lower()
+        if name not in self._files:
+            raise FileNotFoundError(f"Font {alias!r} not found in {os.pathsep.join(self.font_dirs)}")
+        return self._files[name]
+
+    def add_to(self, pdf, alias):
+        """Registers alias with pdf unless it is already there or one of the PDF core fonts."""
+        from fpdf.fonts import CORE_FONTS
+        fontkey = alias.lower()
+        if fontkey in pdf.fonts or fontkey in CORE_FONTS:
+            return
+        path = self.resolve(alias)
+        if not fpdf_internals_supported():
+            # build_font sets TTFFont's private fields, as this fpdf series lays them out
+            pdf.add_font(alias, "", path)
+            self.parsed += 1
+            return
+        if path not in self._metrics and self.cache is not None:
+            found, metrics = self.cache.get(path)
+            if found:
+                self._metrics[path] = metrics
+                self.cache_hits += 1
+        if path not in self._metrics:
+            pdf.add_font(alias, "", path)
+            self.parsed += 1
+            metrics = font_metrics(pdf.fonts[fontkey])
+            self._metrics[path] = metrics
+            if self.cache is not None:
+                self.cache.put(path, metrics)
+            return
+        metrics = self._metrics[path]
+        if metrics is None:
+            pdf.add_font(alias, "", path)
+            return
+        pdf.fonts[fontkey] = build_font(pdf, alias, path, metrics)
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    def report(self):
+        return f"Fonts: {self.parsed} parsed, {self.cache_hits} loaded from the metrics cache"
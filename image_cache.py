@@ -0,0 +1,105 @@
+import logging
+import os
+import sqlite3
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "diary_json2pdf")
+
+def default_image_cache_path():
+    return os.path.join(default_cache_dir(), "images.sqlite")
+
+class ProcessedImageCache:
+    """
+    Persistent cache of the final JPEG bytes embedded in the PDF, stored in SQLite
+    and keyed by everything that decides those bytes (source image hash, target
+    pixel width, DPI, color mode and encoder settings). close() bumps the
+    last-used run of every hit and evicts the least recently used images until
+    the cache fits in max_bytes.
+
+    With defer_writes (for worker processes sharing one cache file) the cache is
+    only read: new images and hits are kept in memory, and deferred() hands them
+    to the owning process to apply with merge_deferred().
+    """
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3, defer_writes=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.defer_writes = defer_writes
+        self._deferred_puts = []
+        self.hits = 0
+        self.misses = 0
+        self.stored_bytes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "key TEXT PRIMARY KEY, width INTEGER NOT NULL, height INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, data BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used)")
+        self.run = (self.conn.execute("SELECT MAX(last_used) FROM images").fetchone()[0] or 0) + 1
+        self._used = set()
+
+    def get(self, key):
+        """
+        Returns (jpeg_bytes, width_px, height_px) or None.
+        """
+        row = self.conn.execute("SELECT data, width, height FROM images WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(key)
+        return bytes(row[0]), row[1], row[2]
+
+    def put(self, key, data, width, height):
+        if self.defer_writes:
+            self._deferred_puts.append((key, data, width, height))
+            self.stored_bytes += len(data)
+            return
+        # Committed right away, so other runs sharing the file are never locked out for long
+        with self.conn:
+            self._insert(key, data, width, height)
+
+    def _insert(self, key, data, width, height):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO images (key, width, height, size, data, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, width, height, len(data), data, self.run),
+        )
+        self.stored_bytes += len(data)
+
+    def deferred(self):
+        """The puts and hits of a defer_writes cache, for merge_deferred() in the owning process."""
+        return {"puts": self._deferred_puts, "used": sorted(self._used), "hits": self.hits, "misses": self.misses}
+
+    def merge_deferred(self, deferred):
+        # Committed at once: workers still reading the file would wait out a long write transaction
+        with self.conn:
+            for item in deferred["puts"]:
+                self._insert(*item)
+        self._used.update(deferred["used"])
+        self.hits += deferred["hits"]
+        self.misses += deferred["misses"]
+
+    def close(self):
+        if self.defer_writes:
+            self.conn.close()
+            return
+        with self.conn:
+            self.conn.executemany("UPDATE images SET last_used = ? WHERE key = ?", ((self.run, key) for key in self._used))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            evicted = 0
+            if total > self.max_bytes:
+                for key, size in self.conn.execute("SELECT key, size FROM images ORDER BY last_used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self.conn.execute("DELETE FROM images WHERE key = ?", (key,))
+                    total -= size
+                    evicted += 1
+        if evicted:
+            logging.info(f"Image cache: evicted {evicted} least recently used images")
+        self.conn.close()
+
+    def report(self):
+        return f"Image cache {self.path}: {self.hits} hits, {self.misses} misses, {self.stored_bytes} bytes added"
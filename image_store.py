@@ -0,0 +1,119 @@
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import os
+import re
+
+# File extensions for the data:image/<type> values Bear exports
+IMAGE_EXTENSIONS = {
+    "jpeg": "jpg",
+    "jpg": "jpg",
+    "png": "png",
+    "gif": "gif",
+    "webp": "webp",
+    "tiff": "tif",
+    "heic": "heic",
+    "svg+xml": "svg",
+}
+
+# Base64 text that b64decode(validate=True) accepts, when its length is a multiple of 4
+BASE64_TEXT_RE = re.compile(r'[A-Za-z0-9+/]*={0,2}')
+
+def base64_payload(image_data):
+    """
+    Returns the base64 text of a markdown image ![](data:image/TYPE;base64,....)
+    with line breaks removed, or None when the data URI is not closed.
+    """
+    start = image_data.find('base64,')
+    if start == -1:
+        return None
+    end = image_data.find(')', start)
+    if end == -1:
+        return None
+    return ''.join(image_data[start + 7:end].split())
+
+def decoded_size(image_data):
+    """
+    Bytes the base64 payload of a markdown image decodes to (the size_bytes the
+    image and diary stores record), counted without decoding; 0 when it does not decode.
+    """
+    payload = base64_payload(image_data)
+    if not payload or len(payload) % 4 or not BASE64_TEXT_RE.fullmatch(payload):
+        return 0
+    return len(payload) // 4 * 3 - (len(payload) - len(payload.rstrip('=')))
+
+def image_dimensions(data):
+    """
+    Reads (width, height) from the image header without decoding pixels.
+    """
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+class ImageBlobStore:
+    """
+    Content-addressed directory of image files. Each image is stored once under
+    <root>/<first two hex digits>/<sha256>.<ext>, however many entries paste it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.stored = 0
+        self.deduplicated = 0
+
+    def path_for(self, sha256, image_type):
+        ext = IMAGE_EXTENSIONS.get(image_type, "bin")
+        return os.path.join(self.root, sha256[:2], f"{sha256}.{ext}")
+
+    def put(self, data, image_type):
+        """
+        Stores the image bytes if they are not already present; returns (sha256, path).
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256, image_type)
+        if os.path.exists(path):
+            self.deduplicated += 1
+            return sha256, path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.stored += 1
+        return sha256, path
+
+    def externalize(self, img, json_dir):
+        """
+        Replaces the inline image_data of a diary image with a reference to the
+        stored bytes: sha256, image_path (relative to json_dir), width and height.
+        Images that cannot be decoded are left inline.
+        """
+        payload = base64_payload(img["image_data"])
+        try:
+            data = base64.b64decode(payload, validate=True) if payload else None
+        except (binascii.Error, ValueError):
+            data = None
+        if not data:
+            logging.warning(f"Keeping image at lines {img['line_start']}-{img['line_end']} inline: no decodable base64 data")
+            return img
+        sha256, path = self.put(data, img["type"])
+        width, height = image_dimensions(data)
+        return {
+            "type": img["type"],
+            "sha256": sha256,
+            "image_path": os.path.relpath(path, json_dir).replace(os.sep, '/'),
+            "width": width,
+            "height": height,
+            "line_start": img["line_start"],
+            "line_end": img["line_end"],
+            "size_bytes": len(data),
+            "filename": img["filename"]
+        }
+
+    def report(self):
+        return f"Image store {self.root}: {self.stored} images stored, {self.deduplicated} duplicates skipped"
@@ -0,0 +1,149 @@
+import importlib.abc
+import logging
+import os
+import subprocess
+import sys
+import time
+
+# Modules whose import starts each CLI, and the heavy packages they leave to the
+# run that needs them
+CLI_MODULES = ("diary_markdown2json", "diary_json2pdf", "build_corpus")
+DEFERRED_PACKAGES = ("spacy", "fpdf", "PIL", "fontTools")
+# Most milliseconds importing one CLI module may take (its own imports included)
+IMPORT_BUDGET_MS = 250
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    """
+    Times every module imported while installed, like python -X importtime but
+    switchable from a CLI flag: a finder at the front of sys.meta_path wraps the
+    exec_module of each module's loader. Self time excludes the imports a module
+    makes itself; cumulative time includes them. Modules imported before start() (the
+    interpreter and the script's own top-level imports) are not covered; use
+    python -X importtime for those.
+    """
+
+    def __init__(self):
+        self.timings = {}  # module name -> [self seconds, cumulative seconds]
+        self._stack = []
+        self.started = None
+        self.modules_before = 0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.modules_before = len(sys.modules)
+        sys.meta_path.insert(0, self)
+        return self
+
+    def stop(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        loader = spec.loader
+        if loader is None or not hasattr(loader, "exec_module"):
+            return spec
+        exec_module = loader.exec_module
+        profiler = self
+
+        def timed_exec_module(module):
+            profiler._stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = profiler._stack.pop()
+                if profiler._stack:
+                    profiler._stack[-1] += elapsed
+                profiler.timings[fullname] = [elapsed - nested, elapsed]
+
+        # Path-based loaders are created per module; class-level loaders (builtins, frozen) are shared
+        if isinstance(loader, type):
+            return spec
+        try:
+            loader.exec_module = timed_exec_module
+        except AttributeError:
+            pass
+        return spec
+
+    def report(self, top=10):
+        """Lines for the log: totals, the top-level packages by the self time of their modules, and the slowest modules."""
+        self.stop()
+        total = sum(self_time for self_time, _ in self.timings.values())
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+        lines = [f"Import profile: {len(self.timings)} modules imported in {total * 1000:.1f} ms "
+                 f"({elapsed:.2f} s run, {self.modules_before} modules already loaded at start)"]
+        packages = {}
+        for name, (self_time, _) in self.timings.items():
+            total_time, count = packages.get(name.split(".")[0], (0.0, 0))
+            packages[name.split(".")[0]] = (total_time + self_time, count + 1)
+        for name, (self_time, count) in sorted(packages.items(), key=lambda kv: -kv[1][0])[:top]:
+            lines.append(f"  {self_time * 1000:9.1f} ms  {name} ({count} modules)")
+        lines.append(f"Import profile: slowest modules by self time")
+        for name, (self_time, cumulative) in sorted(self.timings.items(), key=lambda kv: -kv[1][0])[:top]:
+            lines.append(f"  {self_time * 1000:9.1f} ms self  {name}")
+        return lines
+
+def start_import_profile(enabled):
+    """Starts an ImportProfiler when enabled (the CLIs' --import_profile); returns it or None."""
+    return ImportProfiler().start() if enabled else None
+
+def log_import_profile(profiler):
+    if profiler is not None:
+        for line in profiler.report():
+            logging.info(line)
+
+def measure_startup(module):
+    """
+    Imports module in a fresh interpreter under python -X importtime; returns the
+    milliseconds it took (imports included) and the DEFERRED_PACKAGES it loaded.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+    )
+    elapsed_ms = None
+    packages = set()
+    for line in result.stderr.splitlines():
+        fields = line[len("import time:"):].split("|") if line.startswith("import time:") else []
+        # Skips the header line and anything else on stderr
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        _, cumulative, name = fields
+        name = name.strip()
+        packages.add(name.split(".")[0])
+        if name == module:
+            elapsed_ms = int(cumulative) / 1000
+    return elapsed_ms, sorted(packages.intersection(DEFERRED_PACKAGES))
+
+def check_import_budget(modules=CLI_MODULES, budget_ms=IMPORT_BUDGET_MS):
+    """Returns a message for every module that takes longer than budget_ms to import or loads a deferred package."""
+    failures = []
+    for module in modules:
+        elapsed_ms, packages = measure_startup(module)
+        logging.info(f"{module}: imported in {elapsed_ms:.1f} ms")
+        if elapsed_ms > budget_ms:
+            failures.append(f"{module} takes {elapsed_ms:.1f} ms to import, over the {budget_ms} ms budget")
+        if packages:
+            failures.append(f"{module} imports {', '.join(packages)} at startup")
+    return failures
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Fail when importing a CLI module exceeds the import-time budget or loads a heavy package.")
+    parser.add_argument("modules", nargs="*", default=list(CLI_MODULES), help=f"Modules to check (default: {' '.join(CLI_MODULES)})")
+    parser.add_argument("--budget_ms", type=float, default=IMPORT_BUDGET_MS, help=f"Import-time budget per module in milliseconds (default: {IMPORT_BUDGET_MS})")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s')
+    failures = check_import_budget(args.modules, args.budget_ms)
+    for failure in failures:
+        logging.error(failure)
+    raise SystemExit(1 if failures else 0)
@@ -0,0 +1,296 @@
+"""
+Sharded rendering for diary_json2pdf.py: a variant's entries are split at entries
+that start on a new page because of add_entry_to_pdf's min_text_lines rule, so
+nothing before a split point affects the layout after it. Each shard is rendered
+to its own FPDF document in a worker process, and the shards' pages are merged
+into one document whose fonts, images and content streams match a serial render.
+
+Merging relies on fpdf internals (fpdf2 2.8): font subsets number glyphs in order
+of first use, so the text of later shards is re-encoded for the merged subset,
+and images are numbered in order of first use, so /I<n> references are remapped.
+"""
+import concurrent.futures
+import itertools
+import logging
+import os
+import re
+import run_metrics
+
+# A font selection or a literal string in an fpdf content stream; fpdf escapes
+# every parenthesis inside text, so literal strings never nest
+CONTENT_TEXT_RE = re.compile(rb"/F(\d+) [-+]?\d+(?:\.\d+)? Tf|\((?:[^\\)]|\\.)*\)", re.DOTALL)
+CONTENT_IMAGE_RE = re.compile(rb"/I(\d+) Do")
+ESCAPE_RE = re.compile(rb"\\(.)", re.DOTALL)
+
+def choose_split_points(plan_item, config, shards):
+    """
+    Entry indices to start shards 2..n at: forced breaks nearest to equal page
+    counts. Empty when the variant's pages cannot be split safely.
+    """
+    from diary_json2pdf import entry_layout
+    layout = entry_layout(config)
+    # After a forced break the entry starts at y = margin; it must not break again there
+    if layout["page_h"] - 2 * layout["margin"] < layout["min_block_height"]:
+        return []
+    candidates = [idx for idx in plan_item["forced_breaks"] if idx > 0]
+    entry_pages = plan_item["entry_pages"]
+    splits = []
+    for k in range(1, shards):
+        target = plan_item["pages"] * k / shards
+        remaining = [idx for idx in candidates if not splits or idx > splits[-1]]
+        if not remaining:
+            break
+        best = min(remaining, key=lambda idx: abs(entry_pages[idx] - target))
+        splits.append(best)
+    return sorted(set(splits))
+
+def render_shard(json_path, variant, start, stop, image_cache_path=None, font_dirs=None, font_cache_path=None, measure=False, selection=None, max_image_pixels=None, image_passthrough="cmyk", text_layout=True):
+    """
+    Worker: renders entries [start, stop) of the JSON (of the selected entries, when
+    selection is set) for one variant, starting as
+    add_entry_to_pdf does after a min_text_lines page break (unless start is 0).
+    Returns the pages' content streams and everything merge_shards needs, plus a
+    run_metrics snapshot when measure is set. image_passthrough is the policy of
+    ImagePassthrough; text_layout as for create_pdfs_from_json (the word widths
+    measured are not saved: the plan has already measured every paragraph).
+    """
+    with run_metrics.collecting(enabled=measure) as run:
+        result = _render_shard(json_path, variant, start, stop, image_cache_path, font_dirs, font_cache_path, selection, max_image_pixels, image_passthrough, text_layout)
+    result["metrics"] = run.metrics.snapshot() if measure else None
+    return result
+
+def _render_shard(json_path, variant, start, stop, image_cache_path, font_dirs, font_cache_path, selection, max_image_pixels, image_passthrough, text_layout):
+    from diary_json2pdf import DiaryStats, ImagePassthrough, add_entry_to_pdf, input_dir, iter_json_entries, new_text_layout, variant_config
+    from font_registry import FontRegistry, default_font_dirs
+    from PDFRounded import PDFRounded as FPDF
+    image_cache = None
+    if image_cache_path:
+        from image_cache import ProcessedImageCache
+        image_cache = ProcessedImageCache(image_cache_path, defer_writes=True)
+    json_dir = input_dir(json_path)
+    passthrough = ImagePassthrough(image_passthrough, max_image_pixels)
+    fonts = FontRegistry(default_font_dirs(font_dirs or ()), font_cache_path)
+    layout = new_text_layout(fonts) if text_layout else None
+    config = variant_config(variant, json_dir, image_cache, max_image_pixels, passthrough, layout)
+    pdf = FPDF(unit="mm", format=config["page_size"])
+    with run_metrics.stage("font_registration"):
+        for font in dict.fromkeys([config["date_font"], config["text_font"]]):
+            fonts.add_to(pdf, font)
+    if start > 0:
+        # The state add_entry_to_pdf leaves behind when it breaks the page: the
+        # text font and the dateline fill are carried onto the new page
+        pdf.set_font(config["text_font"], size=config["text_font_size"])
+        pdf.set_fill_color(*config["rect_fill_color"])
+    pdf.add_page()
+    if start > 0:
+        pdf.set_y(config["margin_mm"])
+    stats = DiaryStats()
+    if selection:
+        entries = itertools.islice(iter_json_entries(json_path, selection), start, stop)
+    else:
+        # Seek straight to the shard's entries (through the entry index or the store) instead of parsing those before them
+        entries = iter_json_entries(json_path, {"entries": [(start, stop)]})
+    for entry in run_metrics.active().iterate("json_load", entries):
+        run_metrics.count("entries_rendered")
+        stats.add(entry)
+        add_entry_to_pdf(pdf, entry, config)
+    fonts.close()
+    if layout is not None:
+        run_metrics.count("paragraphs_laid_out", layout.laid_out)
+        run_metrics.count("paragraphs_multi_cell", layout.fallbacks)
+        run_metrics.count("words_measured", layout.measured)
+    catalog = pdf._resource_catalog
+    result = {
+        "pages": [bytes(pdf.pages[n].contents) for n in range(1, pdf.pages_count + 1)],
+        "resources": [
+            {resource_type: sorted(catalog.resources_per_page[(page, resource_type)])
+             for (page, resource_type) in catalog.resources_per_page if page == n}
+            for n in range(1, pdf.pages_count + 1)
+        ],
+        "images": sorted(pdf.image_cache.images.items(), key=lambda item: item[1]["i"]),
+        "icc_profiles": {i: profile for profile, i in pdf.image_cache.icc_profiles.items()},
+        "fonts": [
+            (font.i, sorted(font.subset.items(), key=lambda item: item[1]), list(font.missing_glyphs))
+            for font in pdf.fonts.values() if hasattr(font, "subset")
+        ],
+        "pdf_version": pdf.pdf_version,
+        "end_y": pdf.get_y(),
+        "stats": stats,
+        "image_cache": image_cache.deferred() if image_cache is not None else None,
+        "images_passthrough": passthrough.passed,
+    }
+    if image_cache is not None:
+        image_cache.close()
+    return result
+
+def _unescape(literal):
+    return ESCAPE_RE.sub(lambda m: b"\r" if m.group(1) == b"r" else m.group(1), literal)
+
+def remap_content(content, char_maps, image_map):
+    """
+    Re-encodes the text of a shard page for the merged font subsets (char_maps:
+    font number -> {shard char id: merged char id}) and renumbers its images.
+    """
+    from fpdf.util import escape_parens
+    current = None
+
+    def text(m):
+        nonlocal current
+        if m.group(1) is not None:
+            current = char_maps.get(int(m.group(1)))
+            return m.group(0)
+        if current is None:
+            return m.group(0)
+        codes = _unescape(m.group(0)[1:-1]).decode("utf-16-be")
+        mapped = "".join(chr(current[ord(c)]) for c in codes)
+        return b"(" + escape_parens(mapped.encode("utf-16-be")) + b")"
+
+    if char_maps:
+        content = CONTENT_TEXT_RE.sub(text, content)
+    if image_map:
+        content = CONTENT_IMAGE_RE.sub(lambda m: b"/I%d Do" % image_map[int(m.group(1))], content)
+    return content
+
+def merge_shards(pdf, results):
+    """
+    Appends the pages of the rendered shards, in order, to pdf (fonts registered as
+    in the shards, no pages yet). Font subsets and images are merged in order of
+    first use, as one document rendering every entry would have numbered them.
+    """
+    from fpdf.enums import PDFResourceType
+    fonts_by_number = {font.i: font for font in pdf.fonts.values()}
+    images = pdf.image_cache.images
+    catalog = pdf._resource_catalog
+    for result in results:
+        char_maps = {}
+        for number, glyphs, missing_glyphs in result["fonts"]:
+            font = fonts_by_number[number]
+            char_map = {char_id: font.subset.pick_glyph(glyph) for glyph, char_id in glyphs}
+            if any(char_id != merged for char_id, merged in char_map.items()):
+                char_maps[number] = char_map
+            font.missing_glyphs.extend(u for u in missing_glyphs if u not in font.missing_glyphs)
+        image_map = {}
+        for name, info in result["images"]:
+            local_i = info["i"]
+            merged = images.get(name)
+            if merged is not None:
+                merged["usages"] += info["usages"]
+            else:
+                merged = info
+                merged["i"] = len(images) + 1
+                if info.get("iccp_i") is not None:
+                    profile = result["icc_profiles"][info["iccp_i"]]
+                    merged["iccp_i"] = pdf.image_cache.icc_profiles.setdefault(profile, len(pdf.image_cache.icc_profiles))
+                images[name] = merged
+            image_map[local_i] = merged["i"]
+        if all(local == merged for local, merged in image_map.items()):
+            image_map = {}
+        for content, resources in zip(result["pages"], result["resources"]):
+            pdf.add_page()
+            pdf.pages[pdf.page].contents = bytearray(remap_content(content, char_maps, image_map))
+            for resource_type, resource_ids in resources.items():
+                for resource_id in resource_ids:
+                    if resource_type == PDFResourceType.X_OBJECT:
+                        resource_id = image_map.get(resource_id, resource_id)
+                    catalog.add(resource_type, resource_id, pdf.page)
+        pdf._set_min_pdf_version(result["pdf_version"])
+
+def create_pdfs_sharded(json_path, variants, shards, image_cache_path=None, image_cache_size_mb=2048, font_dirs=None, font_cache_path=None, selection=None, max_image_pixels=None, image_passthrough="cmyk", text_layout=True):
+    """
+    Renders each variant (with output_pdf set) as up to `shards` shards in parallel
+    and merges them. The split points come from plan_pdfs_from_json; a variant that
+    cannot be split, or whose shards do not join up as planned, is rendered
+    serially instead. selection, max_image_pixels, image_passthrough and text_layout
+    are as for create_pdfs_from_json (None: every entry, no pixel limit). Returns the PDF paths.
+    """
+    from diary_json2pdf import DiaryStats, create_pdfs_from_json, entry_layout, input_dir, plan_pdfs_from_json, variant_config
+    from font_registry import FontRegistry, default_font_dirs, fpdf_internals_supported
+    from PDFRounded import PDFRounded as FPDF
+    if not fpdf_internals_supported():
+        # merge_shards rewrites fpdf's pages, resource catalog and image cache as this fpdf series keeps them
+        logging.warning("Rendering serially: shard merging needs the tested fpdf series")
+        return create_pdfs_from_json(json_path, variants, image_cache_path, image_cache_size_mb, font_dirs=font_dirs, font_cache_path=font_cache_path, selection=selection, max_image_pixels=max_image_pixels, image_passthrough=image_passthrough, text_layout=text_layout)
+    metrics = run_metrics.active()
+    with metrics.stage("plan"):
+        plan = plan_pdfs_from_json(json_path, variants, font_dirs, font_cache_path, selection, max_image_pixels, text_layout)
+    num_entries = len(plan["datelines"])
+    json_dir = input_dir(json_path)
+    jobs = []
+    serial = []
+    for variant, item in zip(variants, plan["variants"]):
+        splits = choose_split_points(item, variant_config(variant, json_dir), shards)
+        if not splits:
+            logging.info(f"{variant['output_pdf']}: no page break to split at; rendering serially")
+            serial.append(variant)
+            continue
+        bounds = [0] + splits + [num_entries]
+        jobs.append((variant, item, list(zip(bounds, bounds[1:]))))
+
+    if not selection and isinstance(json_path, str):
+        from diary_store import is_diary_store
+        from entry_index import build_entry_index, load_entry_index
+        # Shards seek to their first entry through the entry index; build it once here rather than in every shard
+        if not is_diary_store(json_path) and load_entry_index(json_path) is None:
+            build_entry_index(json_path)
+
+    image_cache = None
+    if image_cache_path:
+        from image_cache import ProcessedImageCache
+        image_cache = ProcessedImageCache(image_cache_path, image_cache_size_mb * 1024 * 1024)
+    fonts = FontRegistry(default_font_dirs(font_dirs or ()), font_cache_path)
+    passed = 0
+    with concurrent.futures.ProcessPoolExecutor(min(shards, sum(len(ranges) for _, _, ranges in jobs)) or 1) as executor:
+        submitted = [
+            (variant, item, ranges, [
+                executor.submit(render_shard, json_path, variant, start, stop, image_cache_path, font_dirs, font_cache_path, metrics.enabled, selection, max_image_pixels, image_passthrough, text_layout)
+                for start, stop in ranges
+            ])
+            for variant, item, ranges in jobs
+        ]
+        for variant, item, ranges, futures in submitted:
+            output_pdf = variant["output_pdf"]
+            with metrics.stage("wait_shards"):
+                results = [future.result() for future in futures]
+            for result in results:
+                metrics.merge(result["metrics"])
+            if image_cache is not None:
+                for result in results:
+                    image_cache.merge_deferred(result["image_cache"])
+            config = variant_config(variant, json_dir)
+            layout = entry_layout(config)
+            # Each shard must end where the next one's first entry breaks the page
+            joined = all(layout["page_h"] - layout["margin"] - result["end_y"] < layout["min_block_height"] for result in results[:-1])
+            if not joined:
+                logging.warning(f"{output_pdf}: shards do not end at the planned page breaks; rendering serially")
+                serial.append(variant)
+                continue
+            passed += sum(result["images_passthrough"] for result in results)
+            pdf = FPDF(unit="mm", format=config["page_size"])
+            with metrics.stage("font_registration"):
+                for font in dict.fromkeys([config["date_font"], config["text_font"]]):
+                    fonts.add_to(pdf, font)
+            with metrics.stage("shard_merge"):
+                merge_shards(pdf, results)
+            if pdf.page_no() != item["pages"]:
+                logging.warning(f"{output_pdf}: merged {pdf.page_no()} pages, planned {item['pages']}")
+            with metrics.stage("pdf_output"):
+                pdf.output(output_pdf)
+            metrics.count("pages", pdf.page_no())
+            metrics.count("pdf_bytes", os.path.getsize(output_pdf))
+            logging.info(f"Created {output_pdf} from {len(ranges)} shards (entries split at {', '.join(str(start) for start, _ in ranges[1:])})")
+            stats = DiaryStats()
+            for result in results:
+                stats.merge(result["stats"])
+            stats.write_metadata(output_pdf, pdf.page_no())
+    fonts.close()
+    if jobs:
+        metrics.count("entries", num_entries)
+        logging.info(f"Image passthrough ({image_passthrough}): {passed} images embedded unchanged")
+    if image_cache is not None:
+        image_cache.close()
+        metrics.count("image_cache_hits", image_cache.hits)
+        metrics.count("image_cache_misses", image_cache.misses)
+        logging.info(image_cache.report())
+    if serial:
+        create_pdfs_from_json(json_path, serial, image_cache_path, image_cache_size_mb, font_dirs=font_dirs, font_cache_path=font_cache_path, selection=selection, max_image_pixels=max_image_pixels, image_passthrough=image_passthrough, text_layout=text_layout)
+    return [variant["output_pdf"] for variant in variants]
@@ -25,4 +25,6 @@ source .venv/bin/activate
 # Run for A6
 for f in "${FILES[@]}"; do
   python3 ./diary_json2pdf.py "$f" --page_size POCKET --text_font_size 9 --date_font_size 9.5 --rect_fill_color 40 40 60 --text_font "nyt-cheltenham-normal" --date_font "imperial-italic-600"
-done
\ No newline at end of file
+done
+# One chronological volume of all the diaries (entries merged by date)
+# python3 ./diary_json2pdf.py "${FILES[@]}" --merge DiaryEntriesFromBear/OMATA_Volume --page_size POCKET --text_font_size 9 --date_font_size 9.5 --rect_fill_color 40 40 60 --text_font "nyt-cheltenham-normal" --date_font "imperial-italic-600"
@@ -0,0 +1,192 @@
+import collections
+import json
+import logging
+import os
+import sys
+import time
+
+class _Stage:
+    __slots__ = ("metrics", "name", "start", "nested")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.metrics._stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.metrics._stack
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        totals = self.metrics.stages[self.name]
+        totals[0] += elapsed - self.nested
+        totals[1] += 1
+        return False
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+class RunMetrics:
+    """
+    Stage timings and counters of one conversion or render, written as a
+    .metrics.json next to its outputs. Stages nest: the time of a stage excludes
+    the stages entered inside it (as self time does in ImportProfiler), so the
+    stages of a pipeline of generators add up to the time spent in them. A
+    disabled instance (the default outside collecting()) records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = collections.defaultdict(lambda: [0.0, 0])  # name -> [self seconds, calls]
+        self.counters = collections.Counter()
+        self._stack = []
+        self.started = time.perf_counter()
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else _NO_STAGE
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def iterate(self, name, iterable):
+        """iterable, with the time spent producing each item recorded as stage name."""
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name, iterator):
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def snapshot(self):
+        """Stages and counters as plain data, for merge() in another process."""
+        return {"stages": {name: list(totals) for name, totals in self.stages.items()}, "counters": dict(self.counters)}
+
+    def merge(self, snapshot):
+        """Adds the stages and counters a worker process recorded (see snapshot())."""
+        if not self.enabled or not snapshot:
+            return
+        for name, (seconds, calls) in snapshot["stages"].items():
+            totals = self.stages[name]
+            totals[0] += seconds
+            totals[1] += calls
+        self.counters.update(snapshot["counters"])
+
+    def throughput(self, wall_seconds):
+        """Rates over the whole run; image MB/s is over the time spent in image_* stages."""
+        rates = {}
+        for counter, rate in (("lines", "lines_per_s"), ("entries", "entries_per_s"), ("pages", "pages_per_s")):
+            if self.counters.get(counter) and wall_seconds > 0:
+                rates[rate] = self.counters[counter] / wall_seconds
+        image_seconds = sum(seconds for name, (seconds, _) in self.stages.items() if name.startswith("image_"))
+        if self.counters.get("image_source_bytes") and image_seconds > 0:
+            rates["image_mb_per_s"] = self.counters["image_source_bytes"] / image_seconds / (1024 * 1024)
+        return rates
+
+    def summary(self, **info):
+        wall_seconds = time.perf_counter() - self.started
+        stages = {
+            name: {"seconds": round(seconds, 6), "calls": calls}
+            for name, (seconds, calls) in sorted(self.stages.items(), key=lambda kv: -kv[1][0])
+        }
+        return {
+            **info,
+            "wall_seconds": round(wall_seconds, 6),
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+            "throughput": {name: round(rate, 3) for name, rate in self.throughput(wall_seconds).items()},
+            "peak_rss_bytes": peak_rss_bytes(),
+            "children_peak_rss_bytes": peak_rss_bytes(children=True),
+        }
+
+    def write(self, path, **info):
+        """Writes summary(**info) to path (atomically) and returns it."""
+        summary = self.summary(**info)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+        logging.info(f"Metrics written to {path}: {summary['wall_seconds']:.2f} s, peak RSS {(summary['peak_rss_bytes'] or 0) / (1024 * 1024):.0f} MB")
+        return summary
+
+def peak_rss_bytes(children=False):
+    """Peak resident set size of this process (or of its largest waited-for child), None where unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+_active = RunMetrics(enabled=False)
+
+def active():
+    """The RunMetrics of the run in progress in this process (a disabled one when none is)."""
+    return _active
+
+def stage(name):
+    return _active.stage(name)
+
+def count(name, n=1):
+    _active.count(name, n)
+
+class collecting:
+    """
+    Context manager that makes a new RunMetrics the active one for the block and,
+    when path is set, writes it there on exit with info (extra fields, updated by
+    the block through .info). enabled collects without writing (worker processes
+    return metrics.snapshot() instead). profile_path additionally runs the block
+    under cProfile and dumps the stats there (load them with pstats or snakeviz).
+    Without any of them the enclosing run, if any, stays the active one.
+    """
+
+    def __init__(self, path=None, profile_path=None, enabled=False, **info):
+        self.path = path
+        self.profile_path = profile_path
+        self.info = info
+        self.replace = bool(path) or enabled
+        self.metrics = RunMetrics(enabled=self.replace)
+        self._previous = None
+        self._profiler = None
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        if self.replace:
+            _active = self.metrics
+        else:
+            self.metrics = _active
+        if self.profile_path:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _active
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            logging.info(f"cProfile stats written to {self.profile_path}")
+        _active = self._previous
+        if self.path and exc_type is None:
+            self.metrics.write(self.path, **self.info)
+        return False
@@ -6,17 +6,30 @@ const DiaryTextLineSchema = z.object({
   filename: z.string(),
 });
 
-const DiaryImageSchema = z.object({
-  type: z.string(),
-  image_data: z.string(),
-  line_start: z.number(),
-  line_end: z.number(),
-  size_bytes: z.number(),
-  filename: z.string(),
-});
+// Images are either inline (image_data holds the markdown data URI) or, with
+// diary_markdown2json.py --image_store, a reference to a content-addressed file.
+const DiaryImageSchema = z
+  .object({
+    type: z.string(),
+    image_data: z.string().optional(),
+    sha256: z.string().optional(),
+    image_path: z.string().optional(),
+    width: z.number().nullable().optional(),
+    height: z.number().nullable().optional(),
+    line_start: z.number(),
+    line_end: z.number(),
+    size_bytes: z.number(),
+    filename: z.string(),
+  })
+  .refine((img) => img.image_data !== undefined || img.image_path !== undefined, {
+    message: "image needs either image_data or image_path",
+  });
 
+// date: the ISO timestamp the dateline stands for (null when it has no readable
+// date); absent in JSON written before diary_markdown2json.py recorded it.
 const DiaryEntrySchema = z.object({
   dateline: z.string(),
+  date: z.string().nullable().optional(),
   dateline_line: z.number(),
   filename: z.string(),
   text: z.array(DiaryTextLineSchema),
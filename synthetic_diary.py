@@ -0,0 +1,152 @@
+"""
+Writes synthetic Bear-style markdown diaries for benchmarks and for trying the
+tools without the private diaries: datelines in several formats, prose,
+bullet lists and headings, and inline or multi-line base64 images, laid out as
+extract_date_lines expects them.
+
+    python synthetic_diary.py synthetic.md --entries 500 --image_size 1600 1200 --image_format JPEG PNG
+"""
+import argparse
+import base64
+import datetime
+import io
+import logging
+import os
+import random
+
+WORDS = (
+    "the a of to and in prototype firmware board supplier sample order meeting investor team "
+    "design test batch factory shipment enclosure battery sensor strap app release bug fix "
+    "call plan week month cost price quote revision assembly yield tooling mould launch "
+    "customer feedback ride bike cycling data sync cloud server email slides budget hire"
+).split()
+
+# Each format renders a datetime as a dateline; all but "week" are decided by
+# dateutil or its templates, "week" needs the spaCy NER tier
+DATELINE_FORMATS = {
+    "long": lambda d, week: d.strftime("%A, %B ") + f"{d.day}, {d.year}",
+    "day_month_time": lambda d, week: f"{d.day} {d.strftime('%B %Y %H:%M')}",
+    "short": lambda d, week: d.strftime("%b ") + f"{d.day}, {d.year}",
+    "ordinal": lambda d, week: d.strftime("%B ") + f"{d.day}{_ordinal_suffix(d.day)} {d.year}",
+    "iso_weekday": lambda d, week: d.strftime("%Y-%m-%d %A"),
+    "week": lambda d, week: f"Week {week} " + d.strftime("%A %B ") + str(d.day),
+}
+
+def _ordinal_suffix(day):
+    if 10 <= day % 100 <= 20:
+        return "th"
+    return {1: "st", 2: "nd", 3: "rd"}.get(day % 10, "th")
+
+def sentence(rng, min_words=6, max_words=24):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + rng.choice((".", ".", ".", "!", "?"))
+
+def paragraph(rng):
+    return " ".join(sentence(rng) for _ in range(rng.randint(1, 5)))
+
+def synthetic_image(rng, size, image_format):
+    """Encoded bytes of a unique noisy gradient image (noise keeps JPEG and PNG sizes realistic)."""
+    from PIL import Image
+    w, h = size
+    base = Image.linear_gradient("L").resize((w, h))
+    noise = Image.frombytes("L", (w, h), rng.randbytes(w * h))
+    channels = [Image.blend(base, noise, rng.uniform(0.2, 0.8)) for _ in range(3)]
+    img = Image.merge("RGB", [channel.point(lambda v, k=rng.randint(0, 255): (v + k) % 256) for channel in channels])
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+def image_lines(data, image_format, multiline, prefix="", wrap=76):
+    """The markdown lines of one embedded image: a single line, or base64 wrapped at wrap columns."""
+    mime = "jpeg" if image_format.upper() in ("JPEG", "JPG") else image_format.lower()
+    payload = base64.b64encode(data).decode("ascii")
+    head = f"{prefix}![](data:image/{mime};base64,"
+    if not multiline:
+        return [head + payload + ")"]
+    lines = [head + payload[:wrap]]
+    lines.extend(payload[i:i + wrap] for i in range(wrap, len(payload), wrap))
+    lines[-1] += ")"
+    return lines
+
+def generate_diary(entries=100, seed=0, start_date=datetime.datetime(2014, 3, 3, 9, 0), dateline_formats=tuple(DATELINE_FORMATS),
+                   images_per_entry=0.3, image_size=(800, 600), image_formats=("JPEG",), multiline_images=0.5, inline_images=0.1):
+    """
+    Yields the lines (without newlines) of a synthetic diary. Entries are one to
+    three days apart, each with one to eight blocks of prose, lists or headings;
+    images_per_entry is the mean number of images per entry, image_size their
+    largest size (each is drawn between half and full size), multiline_images the
+    share wrapped over several lines and inline_images the share that follows text
+    on the same line.
+    """
+    rng = random.Random(seed)
+    date = start_date
+    yield "Process diary, synthetic export"
+    yield ""
+    for idx in range(entries):
+        date += datetime.timedelta(days=rng.randint(1, 3), minutes=rng.randint(0, 600))
+        week = 1 + (date - start_date).days // 7
+        yield DATELINE_FORMATS[rng.choice(dateline_formats)](date, week)
+        for _ in range(rng.randint(1, 8)):
+            kind = rng.random()
+            if kind < 0.65:
+                yield paragraph(rng)
+            elif kind < 0.8:
+                for _ in range(rng.randint(2, 5)):
+                    yield "- " + sentence(rng, 2, 8).rstrip(".!?")
+            elif kind < 0.9:
+                yield "## " + sentence(rng, 1, 4).rstrip(".!?")
+            else:
+                # Mentions a date, but is prose
+                yield f"Moved the call to {date.strftime('%B')} {rng.randint(1, 28)}, can we make it?"
+            if rng.random() < 0.3:
+                yield ""
+        num_images = int(images_per_entry) + (rng.random() < images_per_entry % 1)
+        for _ in range(num_images):
+            scale = rng.uniform(0.5, 1.0)
+            size = (max(int(image_size[0] * scale), 1), max(int(image_size[1] * scale), 1))
+            image_format = rng.choice(image_formats)
+            data = synthetic_image(rng, size, image_format)
+            prefix = sentence(rng, 2, 6) + " " if rng.random() < inline_images else ""
+            yield from image_lines(data, image_format, rng.random() < multiline_images, prefix)
+        if idx % 1000 == 999:
+            logging.info(f"Generated {idx + 1} of {entries} entries")
+
+def write_diary(path, **options):
+    """Writes generate_diary(**options) to path; returns the number of lines."""
+    count = 0
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for line in generate_diary(**options):
+            f.write(line + "\n")
+            count += 1
+    os.replace(path + ".tmp", path)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic Bear-style markdown diary.")
+    parser.add_argument("output", help="Markdown file to write")
+    parser.add_argument("--entries", type=int, default=100, help="Number of diary entries (default: 100)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed; the same seed and options give the same file (default: 0)")
+    parser.add_argument("--dateline_formats", nargs="+", choices=sorted(DATELINE_FORMATS), default=sorted(DATELINE_FORMATS), help="Dateline formats to draw from (default: all; 'week' needs the spaCy NER tier)")
+    parser.add_argument("--images_per_entry", type=float, default=0.3, help="Mean number of images per entry (default: 0.3)")
+    parser.add_argument("--image_size", type=int, nargs=2, default=[800, 600], metavar=("W", "H"), help="Largest image size in pixels (default: 800 600)")
+    parser.add_argument("--image_format", nargs="+", default=["JPEG"], help="Image formats to draw from, as PIL names (default: JPEG)")
+    parser.add_argument("--multiline_images", type=float, default=0.5, help="Share of images whose base64 is wrapped over several lines (default: 0.5)")
+    parser.add_argument("--inline_images", type=float, default=0.1, help="Share of images that follow text on the same line (default: 0.1)")
+    parser.add_argument("--log", default="INFO", help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=getattr(logging, args.log.upper(), None),
+        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d]: %(message)s'
+    )
+    lines = write_diary(
+        args.output,
+        entries=args.entries,
+        seed=args.seed,
+        dateline_formats=tuple(args.dateline_formats),
+        images_per_entry=args.images_per_entry,
+        image_size=tuple(args.image_size),
+        image_formats=tuple(args.image_format),
+        multiline_images=args.multiline_images,
+        inline_images=args.inline_images,
+    )
+    logging.info(f"Wrote {args.output}: {args.entries} entries, {lines} lines")
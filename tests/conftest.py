@@ -0,0 +1,55 @@
+"""
+Shared fixtures: the scripts live at the repo root, synthetic diaries come from
+synthetic_diary.py and the spaCy model is the one the converter would load.
+"""
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import detect_dates
+from synthetic_diary import generate_diary
+
+@pytest.fixture(scope="session")
+def nlp():
+    """
+    en_core_web_sm when installed. Otherwise a blank English pipeline whose only
+    DATE entities are the "Week N <weekday> <month> <day>" datelines, which is all
+    the synthetic diaries need from the NER tier; the equivalence tests compare
+    verdicts reached through the same pipeline either way.
+    """
+    spacy = pytest.importorskip("spacy")
+    if spacy.util.is_package(detect_dates.SPACY_MODEL):
+        return detect_dates.load_spacy_model()
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([{"label": "DATE", "pattern": [{"LOWER": "week"}, {"IS_DIGIT": True}, {"IS_ALPHA": True}, {"IS_ALPHA": True}, {"IS_DIGIT": True}]}])
+    return nlp
+
+@pytest.fixture(scope="session")
+def spacy_model(nlp):
+    """Makes nlp the model the converter loads on its first NER line."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(detect_dates.lazy_spacy_model(), "_nlp", nlp)
+        yield nlp
+
+def write_markdown(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(line + "\n" for line in lines)
+    return str(path)
+
+def synthetic_lines(entries=40, seed=0, **options):
+    """A small synthetic diary with a few tiny images (see generate_diary)."""
+    options = {"image_size": (48, 32), "image_formats": ("JPEG", "PNG"), **options}
+    return list(generate_diary(entries=entries, seed=seed, **options))
+
+@pytest.fixture(scope="session")
+def diary_json(tmp_path_factory, spacy_model):
+    """A synthetic diary converted to JSON, long enough to fill a few dozen A5 pages."""
+    from diary_markdown2json import convert_markdown_file
+    directory = tmp_path_factory.mktemp("diary")
+    markdown = write_markdown(directory / "diary.md", synthetic_lines(entries=60, seed=3))
+    return convert_markdown_file(markdown, str(directory / "diary.json"))
@@ -0,0 +1,56 @@
+"""build_corpus.py must build diaries in parallel and rebuild only what its settings change."""
+import functools
+import json
+import logging
+import os
+import sqlite3
+
+import pytest
+
+from build_corpus import build_corpus
+from conftest import synthetic_lines, write_markdown
+
+def write_manifest(directory, render):
+    path = str(directory / "corpus.json")
+    manifest = {
+        "inputs": ["*.md"],
+        "variants": [{"page_size": "A6", "text_font_size": 10}, {"page_size": "A5"}],
+        "render": render,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return path
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch, spacy_model):
+    # The image and font caches of every worker go to the default files under here
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    for seed in range(3):
+        write_markdown(tmp_path / f"diary{seed}.md", synthetic_lines(entries=12, seed=20 + seed, images_per_entry=2))
+    return tmp_path
+
+def built(caplog):
+    return [record.getMessage() for record in caplog.records if record.getMessage().startswith("Built ")]
+
+def test_parallel_build_shares_the_image_cache(corpus, caplog, monkeypatch):
+    # Small diaries render quickly; a short busy timeout makes workers that would
+    # wait on each other's write lock fail instead
+    monkeypatch.setattr(sqlite3, "connect", functools.partial(sqlite3.connect, timeout=0.2))
+    with caplog.at_level(logging.INFO):
+        assert build_corpus(write_manifest(corpus, {}), workers=3) == 0
+    assert len(built(caplog)) == 3
+    assert os.path.exists(corpus / "cache" / "diary_json2pdf" / "images.sqlite")
+    for seed in range(3):
+        assert os.path.exists(corpus / f"diary{seed}_A6_10pt.pdf") and os.path.exists(corpus / f"diary{seed}_A5_12pt.metadata.txt")
+
+def test_render_settings_are_fingerprinted(corpus, caplog):
+    assert build_corpus(write_manifest(corpus, {}), workers=3) == 0
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        assert build_corpus(write_manifest(corpus, {}), workers=3) == 0
+    assert built(caplog) == []
+    with caplog.at_level(logging.INFO):
+        assert build_corpus(write_manifest(corpus, {"image_passthrough": "off", "text_layout": False}), workers=3) == 0
+    # Only the PDFs are rendered again
+    assert sorted(built(caplog)) == [f"Built diary{seed}.md: 2 PDFs rendered" for seed in range(3)]
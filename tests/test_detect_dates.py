@@ -0,0 +1,75 @@
+"""DateLineClassifier must give the verdicts of is_date_line, tier by tier."""
+import pytest
+
+from conftest import synthetic_lines
+from detect_dates import DateLineClassifier, VerdictCache, is_date_line, verdict_cache_namespace
+from synthetic_diary import DATELINE_FORMATS
+
+# Lines near the edges of the tiers: out-of-range fields, words dateutil reads as
+# timezones or skips, and numbers that fit a learned template's shape
+EDGE_LINES = [
+    "March 32, 2020",
+    "February 29, 2015",
+    "Sunday, February 29, 2016",
+    "2020-13-01 Monday",
+    "2020-02-30 Sunday",
+    "31 April 2019 10:00",
+    "12 May",
+    "May of 2020",
+    "March of madness",
+    "EST 2020",
+    "Week 3 Monday March 5",
+    "Week of March 5",
+    "14:30",
+    "1 2 3",
+    "June",
+    "Meeting on June 3",
+    "June 3 - meeting",
+    "Tuesday",
+    "Q3 2019",
+    "the 5th of May",
+    "5/6/2020",
+    "2020",
+    "Dec 25, 2019 at 9:00",
+    "## Launch plan",
+    "- ship the firmware",
+    "",
+    "   ",
+]
+
+@pytest.fixture(scope="module")
+def lines():
+    return synthetic_lines(entries=200, seed=1, dateline_formats=tuple(DATELINE_FORMATS), images_per_entry=0.2) + EDGE_LINES
+
+def test_classifier_agrees_with_is_date_line(lines, nlp):
+    classifier = DateLineClassifier(nlp)
+    for line in lines:
+        assert classifier(line) == is_date_line(line, nlp), line
+    # Most lines are settled before dateutil, and the learned templates take over
+    assert classifier.stats["heuristic"] + classifier.stats["prefilter"] > len(lines) // 2
+    assert classifier.templates and classifier.stats["template"] > 0
+
+def test_ner_batch_agrees_with_is_date_line(lines, nlp):
+    classifier = DateLineClassifier(nlp)
+    verdicts = {}
+    undecided = []
+    for idx, line in enumerate(lines):
+        stripped, verdict, _ = classifier.classify_fast(line)
+        if verdict is None:
+            undecided.append(idx)
+        else:
+            verdicts[idx] = verdict
+    texts = [lines[idx].strip() for idx in undecided]
+    verdicts.update(zip(undecided, classifier.classify_ner_batch(texts, batch_size=16)))
+    assert [verdicts[idx] for idx in range(len(lines))] == [is_date_line(line, nlp) for line in lines]
+
+def test_cached_verdicts_agree_with_is_date_line(lines, nlp, tmp_path):
+    path = str(tmp_path / "verdicts.sqlite")
+    for run in range(2):
+        cache = VerdictCache(path, verdict_cache_namespace(nlp))
+        classifier = DateLineClassifier(nlp, cache=cache)
+        for line in lines:
+            assert classifier(line) == is_date_line(line, nlp), line
+        cache.close()
+    # The second run never reaches spaCy
+    assert classifier.stats["spacy"] == 0 and cache.hits > 0
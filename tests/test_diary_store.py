@@ -0,0 +1,87 @@
+"""A diary store must give back the entries of the JSON, and select them by date, position and text."""
+import base64
+import json
+import re
+
+import pytest
+
+from conftest import synthetic_lines, write_markdown
+from diary_markdown2json import convert_markdown_file
+from diary_store import iter_store_entries, read_store_meta, store_image_bytes
+from entry_index import in_ranges, parse_entry_ranges
+from image_store import base64_payload
+
+@pytest.fixture(scope="module")
+def converted(tmp_path_factory, spacy_model):
+    directory = tmp_path_factory.mktemp("store")
+    lines = synthetic_lines(entries=40, seed=14, images_per_entry=0.8) + ["Friday, January 1, 2016", "![](data:image/png;base64,not base64!)"]
+    markdown = write_markdown(directory / "diary.md", lines)
+    json_path = convert_markdown_file(markdown)
+    with open(json_path, "r", encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+    return entries, convert_markdown_file(markdown, diary_store="")
+
+def as_json(store, entry):
+    """A store entry in the JSON's form: stored images back as inline base64 and no date key for undated entries."""
+    images = []
+    for img in entry["images"]:
+        img = dict(img)
+        if "store" in img:
+            data = store_image_bytes(store, img.pop("sha256"))
+            del img["store"], img["width"], img["height"]
+            img["data"] = data
+        images.append(img)
+    return dict(entry, images=images)
+
+def json_form(entry):
+    images = []
+    for img in entry["images"]:
+        img = dict(img)
+        payload = base64_payload(img["image_data"])
+        try:
+            data = base64.b64decode(payload, validate=True)
+        except (TypeError, ValueError):
+            data = None
+        if data:
+            del img["image_data"]
+            img["data"] = data
+            img["size_bytes"] = len(data)
+        images.append(img)
+    entry = dict(entry, images=images)
+    if entry.get("date") is None:
+        entry.pop("date", None)
+    return entry
+
+def test_store_round_trip(converted):
+    entries, store = converted
+    assert [as_json(store, entry) for entry in iter_store_entries(store)] == [json_form(entry) for entry in entries]
+
+def words(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+@pytest.mark.parametrize("query, matches", [
+    ("factory", lambda w: "factory" in w),
+    ("Factory AND tooling", lambda w: {"factory", "tooling"} <= w),
+    ("supplier OR yield", lambda w: bool({"supplier", "yield"} & w)),
+    ("bike NOT data", lambda w: "bike" in w and "data" not in w),
+])
+def test_fts_query(converted, query, matches):
+    entries, store = converted
+    if not read_store_meta(store).get("fts"):
+        pytest.skip("SQLite without FTS5")
+    expected = [entry["dateline"] for entry in entries if any(matches(words(t["text"])) for t in entry["text"])]
+    assert expected
+    assert [entry["dateline"] for entry in iter_store_entries(store, query=query)] == expected
+
+def test_date_and_position_selection(converted):
+    entries, store = converted
+    dates = sorted(entry["date"][:10] for entry in entries if entry.get("date"))
+    date_from, date_to = dates[5], dates[20]
+    ranges = parse_entry_ranges("3-30")
+    expected = [
+        entry["dateline"] for idx, entry in enumerate(entries)
+        if entry.get("date") and date_from <= entry["date"][:10] <= date_to and in_ranges(idx, ranges)
+    ]
+    assert expected
+    selected = iter_store_entries(store, date_from=date_from, date_to=date_to, entries=ranges)
+    assert [entry["dateline"] for entry in selected] == expected
@@ -0,0 +1,83 @@
+"""scan_entry_offsets must find exactly the entries json.load reads."""
+import json
+import mmap
+
+import pytest
+
+from diary_markdown2json import write_diary_json
+from entry_index import build_entry_index, iter_indexed_entries, load_entry_index, scan_entry_offsets
+
+# Strings with every character the scanner has to see through
+TRICKY_TEXT = [
+    'Brackets ] } [ { inside a string',
+    'Quotes \\" and "entries": [ {"dateline": "x"} ]',
+    'Backslashes \\\\ at the end \\',
+    'Unicode: café — 日記 \U0001F600',
+    'Control\tcharacters\nand a "quoted" line',
+]
+
+def tricky_entries(count=12):
+    entries = []
+    for idx in range(count):
+        line = idx * 10 + 1
+        images = [] if idx % 3 else [{
+            "type": "png", "image_data": "data:image/png;base64,iVBORw0KGgo=",
+            "line_start": line + 1, "line_end": line + 1, "size_bytes": 8, "filename": "diary.md",
+        }]
+        entries.append({
+            "dateline": f"Monday, March {idx + 1}, 2021",
+            "date": f"2021-03-{idx + 1:02d}",
+            "dateline_line": line,
+            "filename": "diary.md",
+            "text": [{"text": TRICKY_TEXT[idx % len(TRICKY_TEXT)], "line": line + 2, "filename": "diary.md"}],
+            "images": images,
+            "nested": {"entries": [[], {}, [{"a": ["]"]}]]},
+        })
+    return entries
+
+def offsets_match_json_load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)["entries"]
+    scanned = [json.loads(data[offset:offset + length]) for offset, length in scan_entry_offsets(data)]
+    assert scanned == entries
+    # The renderer scans an mmap of the file
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        assert list(scan_entry_offsets(buffer)) == list(scan_entry_offsets(data))
+    return entries
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_offsets_of_written_diary(tmp_path, compact):
+    path = str(tmp_path / "diary.json")
+    write_diary_json(tricky_entries(), path, compact=compact, index=True)
+    entries = offsets_match_json_load(path)
+    # The sidecar written with the JSON records the same offsets
+    assert [entry[:2] for entry in load_entry_index(path)] == [list(span) for span in scan_entry_offsets(open(path, "rb").read())]
+    assert len(entries) == 12
+
+@pytest.mark.parametrize("document", [
+    {"metadata": {"entries": [{"x": 1}]}, "entries": tricky_entries(3)},
+    {"entries": []},
+    {"entries": [{}, {"text": []}, {"dateline": "[{"}]},
+])
+@pytest.mark.parametrize("indent", [None, 1, 4])
+def test_offsets_of_any_json_layout(tmp_path, document, indent):
+    path = str(tmp_path / "diary.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=indent, ensure_ascii=indent is None)
+    assert offsets_match_json_load(path) == document["entries"]
+
+def test_converted_diary(diary_json):
+    offsets_match_json_load(diary_json)
+
+@pytest.mark.parametrize("ranges", [[(0, 5)], [(3, 4), (8, None)], [(20, 30)]])
+def test_indexed_entries_match_json_load(tmp_path, ranges):
+    path = str(tmp_path / "diary.json")
+    entries = tricky_entries()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"entries": entries}, f, indent=2)
+    expected = [entry for idx, entry in enumerate(entries) if any(start <= idx and (stop is None or idx < stop) for start, stop in ranges)]
+    assert list(iter_indexed_entries(path, entries=ranges)) == expected
+    # The index is built on first use and then read back
+    assert len(load_entry_index(path)) == len(build_entry_index(path)) == len(entries)
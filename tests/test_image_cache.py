@@ -0,0 +1,33 @@
+"""Renders sharing one processed-image cache must not lock each other out."""
+import sqlite3
+
+from image_cache import ProcessedImageCache
+
+def test_concurrent_caches_share_the_file(tmp_path):
+    path = str(tmp_path / "images.sqlite")
+    first = ProcessedImageCache(path)
+    second = ProcessedImageCache(path)
+    first.put("a", b"first", 10, 20)
+    # A second run writes while the first is still open
+    second.conn.execute("PRAGMA busy_timeout = 100")
+    second.put("b", b"second", 30, 40)
+    assert second.get("a") == (b"first", 10, 20)
+    assert first.get("b") == (b"second", 30, 40)
+    first.close()
+    second.close()
+    third = ProcessedImageCache(path)
+    assert third.get("a") and third.get("b")
+    third.close()
+
+def test_deferred_writes_are_merged(tmp_path):
+    path = str(tmp_path / "images.sqlite")
+    owner = ProcessedImageCache(path)
+    worker = ProcessedImageCache(path, defer_writes=True)
+    worker.put("c", b"worker", 1, 2)
+    assert worker.get("c") is None
+    owner.merge_deferred(worker.deferred())
+    worker.close()
+    assert owner.get("c") == (b"worker", 1, 2)
+    # Merged writes are committed, so another connection reads them while the owner is open
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM images").fetchone()[0] == 1
+    owner.close()
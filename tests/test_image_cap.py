@@ -0,0 +1,27 @@
+"""A pixel cap must leave out the same images whether or not the image cache is warm."""
+import logging
+
+from diary_json2pdf import create_pdfs_from_json
+from test_pdf_shards import read_metadata, read_pdf
+
+# Below the 48x32 synthetic images: PNGs are left out, JPEGs are decoded reduced
+CAP = 1000
+
+def render(json_path, output_pdf, **options):
+    variants = [{"output_pdf": str(output_pdf), "page_size": "A6", "text_font_size": 10}]
+    return create_pdfs_from_json(json_path, variants, image_workers=0, **options)[0]
+
+def test_cached_images_keep_the_cap(diary_json, tmp_path, caplog):
+    uncapped = render(diary_json, tmp_path / "uncapped.pdf", max_image_pixels=0)
+    cold = render(diary_json, tmp_path / "cold.pdf", max_image_pixels=CAP)
+    cache = str(tmp_path / "images.sqlite")
+    render(diary_json, tmp_path / "warm_up.pdf", image_cache_path=cache, max_image_pixels=0)
+    with caplog.at_level(logging.ERROR):
+        warm = render(diary_json, tmp_path / "warm.pdf", image_cache_path=cache, max_image_pixels=CAP)
+    assert f"exceeds {CAP} pixels" in caplog.text
+    assert read_pdf(warm) == read_pdf(cold)
+    assert read_metadata(warm) == read_metadata(cold)
+    assert read_pdf(cold) != read_pdf(uncapped)
+    # And a second capped run is served from the cache
+    again = render(diary_json, tmp_path / "again.pdf", image_cache_path=cache, max_image_pixels=CAP)
+    assert read_pdf(again) == read_pdf(cold)
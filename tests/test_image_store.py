@@ -0,0 +1,51 @@
+"""Stored images must carry the bytes inline ones decode to, and metadata.txt must count both alike."""
+import base64
+import json
+import os
+
+import pytest
+
+from conftest import synthetic_lines, write_markdown
+from diary_json2pdf import DiaryStats
+from diary_markdown2json import convert_markdown_file
+from image_store import base64_payload, decoded_size
+
+def load_entries(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["entries"]
+
+def stats(entries):
+    totals = DiaryStats()
+    for entry in entries:
+        totals.add(entry)
+    return totals
+
+@pytest.fixture(scope="module")
+def converted(tmp_path_factory, spacy_model):
+    directory = tmp_path_factory.mktemp("store")
+    markdown = write_markdown(directory / "diary.md", synthetic_lines(entries=20, seed=11, images_per_entry=1.5) + ["![](data:image/png;base64,not base64!)"])
+    inline = load_entries(convert_markdown_file(markdown, str(directory / "inline.json")))
+    stored_json = convert_markdown_file(markdown, str(directory / "stored.json"), image_store="")
+    return inline, load_entries(stored_json), os.path.dirname(stored_json)
+
+def test_stored_images_decode_to_the_inline_bytes(converted):
+    inline, stored, json_dir = converted
+    pairs = [(a, b) for x, y in zip(inline, stored) for a, b in zip(x["images"], y["images"])]
+    assert pairs
+    for inline_img, stored_img in pairs:
+        if "image_path" not in stored_img:
+            # Data that does not decode stays inline
+            assert stored_img == inline_img and decoded_size(inline_img["image_data"]) == 0
+            continue
+        with open(os.path.join(json_dir, stored_img["image_path"]), "rb") as f:
+            data = f.read()
+        assert data == base64.b64decode(base64_payload(inline_img["image_data"]))
+        assert stored_img["size_bytes"] == len(data) == decoded_size(inline_img["image_data"])
+
+def test_metadata_sizes(converted):
+    inline, stored, _ = converted
+    inline_stats, stored_stats = stats(inline), stats(stored)
+    assert inline_stats.decoded_image_bytes == stored_stats.decoded_image_bytes > 0
+    # Total image size keeps counting the base64 text of inline images
+    assert inline_stats.total_image_bytes == sum(len(img["image_data"].encode("utf-8")) for entry in inline for img in entry["images"])
+    assert stored_stats.num_images == inline_stats.num_images
@@ -0,0 +1,16 @@
+"""Each CLI must start within the import-time budget, leaving its heavy packages to the run."""
+import pytest
+
+from import_profile import CLI_MODULES, IMPORT_BUDGET_MS, check_import_budget, measure_startup
+
+@pytest.mark.parametrize("module", CLI_MODULES)
+def test_cli_starts_within_budget(module):
+    elapsed_ms, packages = measure_startup(module)
+    assert packages == []
+    assert elapsed_ms <= IMPORT_BUDGET_MS
+
+def test_budget_check_reports_overruns():
+    failures = check_import_budget(["diary_json2pdf"], budget_ms=0)
+    assert len(failures) == 1 and "over the 0 ms budget" in failures[0]
+    # fpdf itself brings in PIL and fontTools
+    assert "fpdf imports PIL, fontTools, fpdf at startup" in check_import_budget(["fpdf"])
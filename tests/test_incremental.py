@@ -0,0 +1,60 @@
+"""An incremental re-conversion must write what a full conversion of the edited diary writes."""
+import json
+import logging
+import re
+
+from conftest import synthetic_lines, write_markdown
+from diary_markdown2json import convert_markdown_file
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def reused(caplog):
+    match = re.search(r"Incremental: re-used (\d+) of (\d+) previous entries", caplog.text)
+    return int(match.group(1)) if match else None
+
+def edited(lines):
+    """Edits an early entry, inserts lines at the top and in the middle, and appends two entries."""
+    lines = list(lines)
+    paragraph = next(idx for idx in range(len(lines) // 4, len(lines)) if lines[idx].endswith(".") and not lines[idx].startswith("!"))
+    lines[paragraph] = lines[paragraph][:-1] + ", corrected."
+    middle = len(lines) // 2
+    lines[middle:middle] = ["Inserted note without a date", "", "- one more item"]
+    lines[1:1] = ["Exported again", ""]
+    lines += ["Monday, March 2, 2020", "An entry added since the last conversion.", "Tuesday, March 3, 2020", "- and another"]
+    return lines
+
+def test_incremental_matches_full_conversion(tmp_path, spacy_model, caplog):
+    lines = synthetic_lines(entries=40, seed=2)
+    markdown = write_markdown(tmp_path / "diary.md", lines)
+    incremental = str(tmp_path / "incremental.json")
+    full = str(tmp_path / "full.json")
+    convert_markdown_file(markdown, incremental, incremental=True)
+
+    write_markdown(tmp_path / "diary.md", edited(lines))
+    with caplog.at_level(logging.INFO):
+        convert_markdown_file(markdown, incremental, incremental=True)
+    convert_markdown_file(markdown, full)
+    assert load(incremental) == load(full)
+    # Everything but the edited, split and appended entries was re-used
+    assert 30 <= reused(caplog) < 40
+
+def test_unchanged_diary_reuses_every_entry(tmp_path, spacy_model, caplog):
+    markdown = write_markdown(tmp_path / "diary.md", synthetic_lines(entries=20, seed=4))
+    output = str(tmp_path / "diary.json")
+    convert_markdown_file(markdown, output, incremental=True)
+    first = load(output)
+    with caplog.at_level(logging.INFO):
+        convert_markdown_file(markdown, output, incremental=True)
+    assert load(output) == first
+    assert reused(caplog) == len(first["entries"]) == 20
+
+def test_changed_settings_convert_the_whole_file(tmp_path, spacy_model, caplog):
+    markdown = write_markdown(tmp_path / "diary.md", synthetic_lines(entries=10, seed=5))
+    output = str(tmp_path / "diary.json")
+    convert_markdown_file(markdown, output, incremental=True)
+    with caplog.at_level(logging.INFO):
+        convert_markdown_file(markdown, output, incremental=True, dateline_max_length=60)
+    assert reused(caplog) is None
+    assert load(output) == load(convert_markdown_file(markdown, str(tmp_path / "full.json"), dateline_max_length=60))
@@ -0,0 +1,56 @@
+"""Merging diaries into one volume must order their entries as a stable sort by date would."""
+import datetime
+
+import pytest
+
+from conftest import synthetic_lines, write_markdown
+from diary_json2pdf import iter_json_entries, iter_merged_entries
+from diary_markdown2json import convert_markdown_file
+from entry_index import in_ranges, parse_entry_ranges
+from synthetic_diary import DATELINE_FORMATS
+
+YEAR_FORMATS = tuple(name for name in DATELINE_FORMATS if name != "week")
+
+@pytest.fixture(scope="module")
+def diaries(tmp_path_factory, spacy_model):
+    """
+    Three diaries whose dates interleave, one of them a diary store. Their datelines
+    all carry the year, so every diary is in date order.
+    """
+    directory = tmp_path_factory.mktemp("merge")
+    paths = []
+    for n, start in enumerate([datetime.datetime(2014, 3, 3, 9), datetime.datetime(2014, 3, 10, 9), datetime.datetime(2014, 2, 20, 9)]):
+        markdown = write_markdown(directory / f"diary{n}.md", synthetic_lines(entries=25, seed=20 + n, start_date=start, images_per_entry=0.2, dateline_formats=YEAR_FORMATS))
+        paths.append(convert_markdown_file(markdown, diary_store="" if n == 2 else None))
+    return paths
+
+def sorted_entries(paths):
+    """All entries of the diaries in input order, then sorted by date; undated entries keep the date before them."""
+    keyed = []
+    for path in paths:
+        last = ""
+        for entry in iter_json_entries(path):
+            last = max(last, entry.get("date") or last)
+            keyed.append((last, entry["filename"], entry["dateline_line"]))
+    return [(filename, line) for _, filename, line in sorted(keyed, key=lambda item: item[0])]
+
+def positions(entries):
+    return [(entry["filename"], entry["dateline_line"]) for entry in entries]
+
+def test_merge_orders_by_date(diaries):
+    merged = list(iter_merged_entries(diaries))
+    assert positions(merged) == sorted_entries(diaries)
+    sources = [entry["filename"] for entry in merged]
+    assert sum(a != b for a, b in zip(sources, sources[1:])) > len(diaries)
+    assert len({entry["filename"] for entry in merged}) == len(diaries)
+    dates = [entry["date"] for entry in merged if entry["date"]]
+    assert dates == sorted(dates)
+
+def test_merge_selection(diaries):
+    expected = sorted_entries(diaries)
+    ranges = parse_entry_ranges("10-40,60-")
+    merged = iter_merged_entries(diaries, {"entries": ranges})
+    assert positions(merged) == [pos for idx, pos in enumerate(expected) if in_ranges(idx, ranges)]
+    merged = list(iter_merged_entries(diaries, {"date_from": "2014-03-10", "date_to": "2014-03-20"}))
+    assert merged and all("2014-03-10" <= entry["date"][:10] <= "2014-03-20" for entry in merged)
+    assert positions(merged) == [pos for pos in expected if pos in set(positions(merged))]
@@ -0,0 +1,73 @@
+"""The memory-mapped scanner must give the entries of the line-based one and of the whole-file parse."""
+import contextlib
+
+import pytest
+
+import diary_markdown2json
+from conftest import synthetic_lines
+from diary_markdown2json import extract_date_lines
+from test_streaming import EDGE_LINES, reference_entries, undated
+
+# Image blocks the byte scanner finds on its own: an inline image after text, an
+# image indented, one closed with text after it, one whose closing parenthesis
+# is on a later line and one that is never closed, running to the end of the file
+IMAGE_LINES = [
+    "Thursday, March 6, 2014",
+    "Before ![](data:image/jpeg;base64,/9j/4AAQSkZJRg==) after",
+    "   ![](data:image/png;base64,iVBORw0KGgo=)",
+    "![](data:image/png;base64,iVBORw0KGgo=) and a caption",
+    "![](data:image/gif;base64,R0lGOD",
+    "lhAQABAIAAAP",
+    "///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7) trailing text",
+    "Friday, March 7, 2014",
+    "An image without a payload: ![](data:image/svg+xml,<svg/>)",
+    "![](data:image/jpeg;base64,/9j/4AAQ",
+    "Saturday, March 8, 2014",
+    "lost in the unclosed image",
+]
+
+INPUTS = {
+    "synthetic": synthetic_lines(entries=30, seed=24, images_per_entry=0.8, inline_images=0.3),
+    "edge": EDGE_LINES,
+    "images": IMAGE_LINES,
+    "images_closed": IMAGE_LINES[:-3],
+}
+
+def write(path, lines, newline="\n", final_newline=True):
+    text = newline.join(lines) + (newline if final_newline else "")
+    with open(path, "wb") as f:
+        f.write(text.encode("utf-8"))
+    return str(path)
+
+def with_filename(entry, filename):
+    """entry as if read from filename."""
+    return dict(
+        entry, filename=filename,
+        text=[dict(item, filename=filename) for item in entry["text"]],
+        images=[dict(img, filename=filename) for img in entry["images"]],
+    )
+
+def line_based(path, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(diary_markdown2json, "map_markdown", lambda filepath, stack: None)
+        return extract_date_lines(path, ner_batch_size=4)
+
+@pytest.mark.parametrize("name", INPUTS)
+@pytest.mark.parametrize("final_newline", [True, False])
+def test_mmap_matches_line_based(tmp_path, spacy_model, monkeypatch, name, final_newline):
+    path = write(tmp_path / "diary.md", INPUTS[name], final_newline=final_newline)
+    entries = extract_date_lines(path, ner_batch_size=4)
+    assert entries
+    assert entries == line_based(path, monkeypatch)
+    assert undated(entries) == reference_entries(path, spacy_model)
+
+@pytest.mark.parametrize("name", INPUTS)
+def test_crlf_matches_lf(tmp_path, spacy_model, name):
+    lf = write(tmp_path / "lf.md", INPUTS[name])
+    crlf = write(tmp_path / "crlf.md", INPUTS[name], newline="\r\n")
+    with contextlib.ExitStack() as stack:
+        assert diary_markdown2json.map_markdown(lf, stack) is not None
+        assert diary_markdown2json.map_markdown(crlf, stack) is None
+    entries = extract_date_lines(crlf, ner_batch_size=4)
+    assert entries == [with_filename(entry, crlf) for entry in extract_date_lines(lf, ner_batch_size=4)]
+    assert undated(entries) == reference_entries(crlf, spacy_model)
@@ -0,0 +1,40 @@
+"""resolve_ner_verdicts must give the per-line verdicts while holding back a bounded number of lines."""
+import pytest
+
+from conftest import synthetic_lines
+from detect_dates import DateLineClassifier, is_date_line
+from diary_markdown2json import resolve_ner_verdicts, scan_markdown_lines
+
+# Prose without sentence punctuation and calendar words, which only spaCy can decide
+UNDECIDED = "Week 12 Monday March 4"
+
+def scanned_lines(lines, nlp, consumed):
+    for item in scan_markdown_lines(lines, DateLineClassifier(nlp)):
+        consumed.append(item[0])
+        yield item
+
+@pytest.mark.parametrize("batch_size, max_held", [(1, 100), (8, 100), (256, 50), (256, 10000)])
+def test_batched_verdicts_match_is_date_line(nlp, batch_size, max_held):
+    lines = synthetic_lines(entries=60, seed=9, images_per_entry=0.5)
+    consumed = []
+    resolved = []
+    for item in resolve_ner_verdicts(scanned_lines(lines, nlp, consumed), DateLineClassifier(nlp), batch_size, max_held=max_held):
+        # Lines are released in order, at most max_held behind the first pass
+        assert item[0] == len(resolved)
+        assert len(consumed) - len(resolved) <= max_held
+        resolved.append(item)
+    # The same verdicts as deciding each line on its own
+    classifier = DateLineClassifier(nlp)
+    expected = [classifier.classify_ner(line.strip()) if verdict is None else verdict for _, line, verdict, _ in scan_markdown_lines(lines, classifier)]
+    assert [verdict for _, _, verdict, _ in resolved] == expected
+    assert any(is_date_line(line, nlp) for line in lines if line.startswith("Week "))
+
+def test_sparse_candidates_are_released(nlp):
+    # One NER candidate, then a long run of lines the fast tiers decide
+    lines = [UNDECIDED] + [f"Line {idx} of the report." for idx in range(500)]
+    consumed = []
+    released = 0
+    for _ in resolve_ner_verdicts(scanned_lines(lines, nlp, consumed), DateLineClassifier(nlp), max_held=64):
+        released += 1
+        assert len(consumed) - released <= 64
+    assert released == len(lines)
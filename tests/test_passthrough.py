@@ -0,0 +1,47 @@
+"""--image_passthrough must embed the original bytes of exactly the JPEGs its policy allows."""
+import io
+import random
+
+import pytest
+
+from conftest import write_markdown
+from diary_json2pdf import create_pdfs_from_json
+from synthetic_diary import image_lines, synthetic_image
+
+def jpeg(mode, seed):
+    """A small JPEG in the given color mode, well under the column width."""
+    from PIL import Image
+    img = Image.open(io.BytesIO(synthetic_image(random.Random(seed), (60, 40), "PNG"))).convert(mode)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+@pytest.fixture(scope="module")
+def sources(tmp_path_factory, spacy_model):
+    """A diary with a CMYK, an RGB and a grayscale JPEG and a PNG, and the bytes of each."""
+    from diary_markdown2json import convert_markdown_file
+    images = {mode: jpeg(mode, n) for n, mode in enumerate(["CMYK", "RGB", "L"])}
+    images["PNG"] = synthetic_image(random.Random(9), (60, 40), "PNG")
+    lines = []
+    for day, (name, data) in enumerate(images.items(), start=3):
+        lines.append(f"Monday, March {day}, 2014")
+        lines.append(f"A {name} image.")
+        lines.extend(image_lines(data, "PNG" if name == "PNG" else "JPEG", multiline=True))
+    directory = tmp_path_factory.mktemp("passthrough")
+    markdown = write_markdown(directory / "diary.md", lines)
+    return convert_markdown_file(markdown, str(directory / "diary.json")), images
+
+@pytest.mark.parametrize("policy, embedded", [
+    ("off", set()),
+    ("cmyk", {"CMYK"}),
+    ("any", {"CMYK", "RGB", "L"}),
+])
+def test_passthrough_policies(sources, tmp_path, policy, embedded):
+    json_path, images = sources
+    output_pdf = str(tmp_path / f"{policy}.pdf")
+    create_pdfs_from_json(json_path, [{"output_pdf": output_pdf, "page_size": "A6"}], image_workers=0, image_passthrough=policy)
+    with open(output_pdf, "rb") as f:
+        pdf = f.read()
+    assert {name for name, data in images.items() if data in pdf} == embedded
+    # Every image is in the PDF either way, four JPEG streams in all
+    assert pdf.count(b"/DCTDecode") == len(images)
@@ -0,0 +1,45 @@
+"""A PDF merged from shards must be the PDF a serial render writes."""
+import logging
+import os
+import re
+
+import pytest
+
+from diary_json2pdf import create_pdfs_from_json
+from entry_index import parse_entry_ranges
+
+# Only the creation date and the document ID differ between two renders
+VOLATILE_RE = re.compile(rb"/CreationDate \(D:[^)]*\)|/ID \[<[0-9A-F]+><[0-9A-F]+>\]")
+
+def read_pdf(path):
+    with open(path, "rb") as f:
+        return VOLATILE_RE.sub(b"", f.read())
+
+def read_metadata(pdf_path):
+    with open(os.path.splitext(pdf_path)[0] + ".metadata.txt", "r", encoding="utf-8") as f:
+        return f.read()
+
+def render(json_path, output_pdf, **options):
+    variants = [{"output_pdf": str(output_pdf), "page_size": "A6", "text_font_size": 10}, {"output_pdf": str(output_pdf).replace(".pdf", "_A5.pdf")}]
+    return create_pdfs_from_json(json_path, variants, image_workers=0, **options)
+
+@pytest.mark.parametrize("selection", [None, {"entries": parse_entry_ranges("5-50")}])
+def test_sharded_render_matches_serial(diary_json, tmp_path, caplog, selection):
+    serial = render(diary_json, tmp_path / "serial.pdf", selection=selection)
+    with caplog.at_level(logging.INFO):
+        sharded = render(diary_json, tmp_path / "sharded.pdf", shards=3, selection=selection)
+    assert len(re.findall(r"Created \S+ from 3 shards", caplog.text)) == 2
+    for serial_pdf, sharded_pdf in zip(serial, sharded):
+        assert read_pdf(sharded_pdf) == read_pdf(serial_pdf)
+        assert read_metadata(sharded_pdf) == read_metadata(serial_pdf)
+
+def test_sharded_render_of_diary_store(tmp_path, spacy_model):
+    from conftest import synthetic_lines, write_markdown
+    from diary_markdown2json import convert_markdown_file
+    markdown = write_markdown(tmp_path / "diary.md", synthetic_lines(entries=40, seed=6))
+    store = convert_markdown_file(markdown, diary_store="")
+    serial = render(store, tmp_path / "serial.pdf")
+    sharded = render(store, tmp_path / "sharded.pdf", shards=2)
+    for serial_pdf, sharded_pdf in zip(serial, sharded):
+        assert read_pdf(sharded_pdf) == read_pdf(serial_pdf)
+        assert read_metadata(sharded_pdf) == read_metadata(serial_pdf)
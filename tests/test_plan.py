@@ -0,0 +1,48 @@
+"""The --plan_only planner must predict the page count a render ends with."""
+import random
+
+import pytest
+
+from conftest import synthetic_lines, write_markdown
+from diary_json2pdf import create_pdfs_from_json, plan_pdfs_from_json
+from synthetic_diary import image_lines, paragraph, synthetic_image
+
+VARIANTS = [
+    {"page_size": "A6", "text_font_size": 9},
+    {"page_size": "A5", "text_font_size": 12, "line_spacing": 1.5},
+    {"page_size": "POCKET", "text_font_size": 10, "text_font": "nyt-cheltenham-normal", "date_font_size": 9.5},
+    {"page_size": "A7", "text_font_size": 8, "margin_inch": 0.2},
+]
+
+def long_entries(seed=12):
+    """Entries of long paragraphs, headings and tall or wide images, which break pages mid-entry."""
+    rng = random.Random(seed)
+    lines = []
+    for day in range(1, 9):
+        lines.append(f"Monday, June {day}, 2015")
+        lines.append("## " + paragraph(rng)[:40])
+        lines.append(" ".join(paragraph(rng) for _ in range(12)))
+        size = rng.choice([(40, 400), (600, 60), (300, 300)])
+        lines.extend(image_lines(synthetic_image(rng, size, "PNG"), "PNG", multiline=day % 2 == 0))
+        lines.append(paragraph(rng))
+    return lines
+
+@pytest.fixture(scope="module")
+def plan_json(tmp_path_factory, spacy_model):
+    from diary_markdown2json import convert_markdown_file
+    directory = tmp_path_factory.mktemp("plan")
+    markdown = write_markdown(directory / "diary.md", synthetic_lines(entries=25, seed=13, images_per_entry=1) + long_entries())
+    return convert_markdown_file(markdown, str(directory / "diary.json"))
+
+def rendered_pages(output_pdf):
+    with open(output_pdf[:-len(".pdf")] + ".metadata.txt", "r", encoding="utf-8") as f:
+        return int(f.readline().split(":")[1])
+
+@pytest.mark.parametrize("text_layout", [True, False])
+def test_planned_pages_match_render(plan_json, tmp_path, text_layout):
+    plan = plan_pdfs_from_json(plan_json, VARIANTS, text_layout=text_layout)
+    variants = [dict(variant, output_pdf=str(tmp_path / f"variant{idx}.pdf")) for idx, variant in enumerate(VARIANTS)]
+    outputs = create_pdfs_from_json(plan_json, variants, image_workers=0, text_layout=text_layout)
+    for item, output_pdf in zip(plan["variants"], outputs):
+        assert item["pages"] == rendered_pages(output_pdf), item["settings"]
+    assert len({item["pages"] for item in plan["variants"]}) == len(VARIANTS)
@@ -0,0 +1,104 @@
+"""The streaming converter must give the entries of the original two-pass, whole-file parse."""
+import pytest
+
+from conftest import synthetic_lines, write_markdown
+from detect_dates import is_date_line
+from diary_markdown2json import extract_date_lines
+
+IMAGE_MARKER = "![](data:image/"
+
+def reference_entries(filepath, nlp):
+    """
+    The whole-file parse diary_markdown2json.py did before streaming: all lines read,
+    every dateline found first, then each entry built from the lines up to the next.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    date_indices = []
+    inside_image_block = False
+    for i, line in enumerate(lines):
+        if not inside_image_block and line.strip().startswith(IMAGE_MARKER):
+            inside_image_block = ")" not in line
+        elif inside_image_block:
+            inside_image_block = ")" not in line
+        elif is_date_line(line, nlp):
+            date_indices.append(i)
+    entries = []
+    for n, date_idx in enumerate(date_indices):
+        next_date_idx = date_indices[n + 1] if n + 1 < len(date_indices) else len(lines)
+        text = []
+        images = []
+        j = date_idx + 1
+        while j < next_date_idx:
+            content = lines[j].rstrip("\n")
+            if content.strip() == "":
+                j += 1
+                continue
+            if IMAGE_MARKER in content:
+                image_part = content[content.find(IMAGE_MARKER):]
+                text_part = content[:content.find(IMAGE_MARKER)].strip()
+                if text_part:
+                    text.append({"text": text_part, "line": j + 1, "filename": filepath})
+                try:
+                    image_type = image_part.split(IMAGE_MARKER)[1].split(";")[0]
+                except Exception:
+                    image_type = "unknown"
+                image_start = image_end = j
+                image_data = image_part
+                if ")" not in image_part:
+                    for k in range(j + 1, next_date_idx):
+                        next_line = lines[k].rstrip("\n")
+                        image_data += "\n" + next_line
+                        if ")" in next_line:
+                            image_end = k
+                            break
+                    j = image_end
+                images.append({
+                    "type": image_type,
+                    "image_data": image_data,
+                    "line_start": image_start + 1,
+                    "line_end": image_end + 1,
+                    "size_bytes": int(len(image_data) * 3 / 4) if image_part.find("base64,") != -1 else 0,
+                    "filename": filepath,
+                })
+                j += 1
+                continue
+            text.append({"text": content.strip(), "line": j + 1, "filename": filepath})
+            j += 1
+        entries.append({"dateline": lines[date_idx].strip(), "dateline_line": date_idx + 1, "filename": filepath, "text": text, "images": images})
+    return entries
+
+def undated(entries):
+    """Entries without the ISO date added since (see entry_index.DateNormalizer)."""
+    return [{key: value for key, value in entry.items() if key != "date"} for entry in entries]
+
+# Edge cases of the line handling: text before the first dateline, an inline
+# image, a multi-line image that runs into the next dateline, a dateline as the
+# last line and no newline at the end of the file
+EDGE_LINES = [
+    "Exported notes",
+    "Monday, March 3, 2014",
+    "Text and then ![](data:image/png;base64,iVBORw0KGgo=) inline",
+    "![](data:image/jpeg;base64,/9j/4AAQ",
+    "SkZJRgABAQ",
+    "Tuesday, March 4, 2014",
+    "After an unclosed image.",
+    "![](data:image/gif;base64,R0lGOD",
+    "",
+    "Wednesday, March 5, 2014",
+]
+
+@pytest.mark.parametrize("lines, final_newline", [
+    (synthetic_lines(entries=30, seed=10, images_per_entry=0.6, inline_images=0.3), True),
+    (EDGE_LINES, True),
+    (EDGE_LINES, False),
+    (EDGE_LINES[:-1] + ["- last line without a newline"], False),
+])
+def test_streaming_matches_whole_file_parse(tmp_path, spacy_model, lines, final_newline):
+    path = write_markdown(tmp_path / "diary.md", lines)
+    if not final_newline:
+        with open(path, "r+", encoding="utf-8") as f:
+            f.truncate(len(f.read().encode("utf-8")) - 1)
+    entries = extract_date_lines(path, ner_batch_size=4)
+    assert undated(entries) == reference_entries(path, spacy_model)
+    assert entries
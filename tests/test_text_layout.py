@@ -0,0 +1,88 @@
+"""TextLayout must break and draw paragraphs exactly as multi_cell does."""
+import random
+
+import pytest
+from fpdf.enums import MethodReturnValue
+
+from diary_json2pdf import create_pdfs_from_json
+from font_registry import FontRegistry
+from PDFRounded import PDFRounded as FPDF
+from synthetic_diary import paragraph, sentence
+from test_pdf_shards import VOLATILE_RE, read_metadata, read_pdf
+from text_layout import TextLayout
+
+FONTS = ["WarblerText", "nyt-cheltenham-normal", "Inter", "3270NerdFont-Regular"]
+
+@pytest.fixture(scope="module")
+def fonts():
+    return FontRegistry()
+
+def paragraphs(seed, count=150):
+    """Prose, plus words too long for a line, single words and text multi_cell has to handle itself."""
+    rng = random.Random(seed)
+    texts = [paragraph(rng) for _ in range(count)]
+    texts += [sentence(rng, 1, 1), "x", "y" * 300, "https://example.com/" + "a/b-c_d" * 40 + " and more", "A " + "w" * 120 + " word"]
+    texts += ["Two  spaces", " leading", "trailing ", "tab\there", "line\nbreak", "soft­hyphen", "no break", "{nb} pages"]
+    return texts
+
+@pytest.mark.parametrize("font", FONTS)
+@pytest.mark.parametrize("size, width", [(9, 105), (12, 128), (18, 40.5)])
+def test_lines_match_multi_cell(fonts, font, size, width):
+    pdf = FPDF(unit="mm", format="A4")
+    fonts.add_to(pdf, font)
+    pdf.add_page()
+    pdf.alias_nb_pages()
+    pdf.set_font(font, size=size)
+    layout = TextLayout()
+    for text in paragraphs(seed=size):
+        expected = pdf.multi_cell(width, 5, text, dry_run=True, output=MethodReturnValue.LINES)
+        laid_out = layout.lines(pdf, width, text)
+        if laid_out is not None:
+            assert [line for line, *_ in laid_out[1]] == expected, text
+    assert layout.laid_out > 100 and layout.fallbacks >= 8
+
+def write_paragraphs(layout, font, texts, cell_width=95):
+    fonts = FontRegistry()
+    pdf = FPDF(unit="mm", format="A5")
+    fonts.add_to(pdf, font)
+    pdf.add_page()
+    pdf.set_font(font, size=11)
+    for text in texts:
+        if layout is None or not layout.write(pdf, cell_width, 5.2, text):
+            pdf.multi_cell(cell_width, 5.2, text)
+    return VOLATILE_RE.sub(b"", bytes(pdf.output()))
+
+@pytest.mark.parametrize("font", FONTS)
+def test_write_matches_multi_cell(font):
+    texts = paragraphs(seed=7)
+    layout = TextLayout()
+    assert write_paragraphs(layout, font, texts) == write_paragraphs(None, font, texts)
+    assert layout.laid_out > 100
+
+def test_cached_widths_give_the_same_lines(fonts, tmp_path):
+    from font_registry import FontMetricsCache
+    texts = paragraphs(seed=8)
+    path = str(tmp_path / "fonts.sqlite")
+    results = []
+    for run in range(2):
+        cache = FontMetricsCache(path)
+        layout = TextLayout(cache)
+        pdf = FPDF(unit="mm", format="A5")
+        fonts.add_to(pdf, "WarblerText")
+        pdf.add_page()
+        pdf.set_font("WarblerText", size=11)
+        results.append([layout.lines(pdf, 95, text) for text in texts])
+        layout.save()
+        cache.close()
+    assert [r and r[1] for r in results[0]] == [r and r[1] for r in results[1]]
+    # Every cached word came from the first run
+    assert layout.measured < layout.words // 10
+
+def test_render_matches_multi_cell(diary_json, tmp_path):
+    variants = [{"output_pdf": str(tmp_path / "layout.pdf")}, {"output_pdf": str(tmp_path / "layout_A6.pdf"), "page_size": "A6", "text_font": "Inter", "text_font_size": 9}]
+    laid_out = create_pdfs_from_json(diary_json, variants, image_workers=0)
+    variants = [dict(variant, output_pdf=variant["output_pdf"].replace("layout", "multi_cell")) for variant in variants]
+    multi_cell = create_pdfs_from_json(diary_json, variants, image_workers=0, text_layout=False)
+    for laid_out_pdf, multi_cell_pdf in zip(laid_out, multi_cell):
+        assert read_pdf(laid_out_pdf) == read_pdf(multi_cell_pdf)
+        assert read_metadata(laid_out_pdf) == read_metadata(multi_cell_pdf)
@@ -0,0 +1,207 @@
+"""
+Body text layout for diary_json2pdf.py: paragraphs are broken into lines a word
+at a time, with the width of each word in font units looked up in a per-font
+cache, and the lines are drawn through fpdf's own line renderer. The breaks and
+the justification are those of multi_cell(w, h, text) for the fonts the diaries
+are set in; paragraphs whose wrapping is not reproduced here (newlines, tabs
+and other special spaces, soft hyphens, runs of spaces, core or symbol fonts,
+text shaping, ...) go through multi_cell as before. Widths in font units do not
+depend on the size, so every text_font_size shares one cache per font file,
+which FontMetricsCache keeps between runs. The drawing goes through fpdf's
+private line renderer and the breaking copies its arithmetic, so callers only
+create a TextLayout with the fpdf series it was checked against (see
+font_registry.fpdf_internals_supported); with any other every paragraph goes
+through multi_cell.
+"""
+import re
+
+from fpdf.enums import Align, XPos, YPos
+from fpdf.line_break import BREAKING_SPACE_SYMBOLS_STR, FORM_FEED, NBSP, NEWLINE, SOFT_HYPHEN, TextLine
+from fpdf.util import FloatTolerance, Padding
+
+# Paragraphs with these go through multi_cell: any break, space or hyphen other
+# than single spaces between words
+SPECIAL_TEXT_RE = re.compile(
+    "[" + re.escape(BREAKING_SPACE_SYMBOLS_STR.replace(" ", "") + NEWLINE + "\r" + FORM_FEED + NBSP + SOFT_HYPHEN) + "]|  |^ | $"
+)
+# Longer words (URLs, runs of symbols) are measured every time instead of being cached
+MAX_CACHED_WORD = 64
+NO_PADDING = Padding(0, 0, 0, 0)
+
+class LineBreaker:
+    """
+    multi_cell's wrapping of single-spaced text for one font, size and column
+    width. Line widths are computed as fpdf computes them (font units times the
+    size in points, / 1000, / k) so that every comparison with the column width
+    comes out the same; a word fits when its last character does.
+    """
+
+    def __init__(self, font, font_size_pt, k, w, c_margin, widths, new_widths):
+        self.cw = font.cw
+        self.font_size_pt = font_size_pt
+        self.k = k
+        self.max_width = w - c_margin - c_margin
+        self.widths = widths
+        self.new_widths = new_widths
+        self.space = font.cw[ord(" ")]
+        self.words = 0
+        self.measured = 0
+
+    def width(self, units):
+        return units * self.font_size_pt * 0.001 / self.k
+
+    def fits(self, line_units, char_units):
+        return not FloatTolerance.greater_than(self.width(line_units) + self.width(char_units), self.max_width)
+
+    def break_lines(self, text):
+        """
+        (text, units, number of spaces, justified) of each line of text, or None when
+        multi_cell would not draw it line by line (it raises, or the text has no width).
+        """
+        cw = self.cw
+        widths = self.widths
+        space = self.space
+        lines = []
+        words = []
+        units = 0
+        split = text.split(" ")
+        self.words += len(split)
+        for word in split:
+            word_units = widths.get(word)
+            if word_units is None:
+                word_units = sum(cw[ord(c)] for c in word)
+                self.measured += 1
+                if len(word) <= MAX_CACHED_WORD:
+                    widths[word] = self.new_widths[word] = word_units
+            last = cw[ord(word[-1])]
+            if words:
+                if self.fits(units, space) and self.fits(units + space + word_units - last, last):
+                    words.append(word)
+                    units += space + word_units
+                    continue
+                # Either the space does not fit (and is dropped) or the word breaks at it
+                lines.append((" ".join(words), units, len(words) - 1, True))
+                words = []
+            # No space to break at: the word is cut before its first character that does not fit
+            while not self.fits(word_units - last, last):
+                cut = cut_units = 0
+                for c in word:
+                    if not self.fits(cut_units, cw[ord(c)]):
+                        break
+                    cut += 1
+                    cut_units += cw[ord(c)]
+                if cut == 0:
+                    return None
+                lines.append((word[:cut], cut_units, 0, False))
+                word = word[cut:]
+                word_units -= cut_units
+            words = [word]
+            units = word_units
+        if not units:
+            return None
+        lines.append((" ".join(words), units, len(words) - 1, False))
+        return lines
+
+class TextLayout:
+    """
+    Lays out body text for every document of a run. Word widths are kept per font
+    file, loaded from cache (a FontMetricsCache, or None) on first use; save()
+    writes the words measured since back to it.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._widths = {}
+        self._new_widths = {}
+        self._breakers = {}
+        self.laid_out = 0
+        self.fallbacks = 0
+
+    def _breaker(self, pdf, w):
+        font = pdf.current_font
+        key = (font.ttffile, pdf.font_size_pt, pdf.k, w, pdf.c_margin)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            path = str(font.ttffile)
+            if path not in self._widths:
+                self._widths[path] = self.cache.get_word_widths(path) if self.cache is not None else {}
+                self._new_widths[path] = {}
+            breaker = LineBreaker(font, pdf.font_size_pt, pdf.k, w, pdf.c_margin, self._widths[path], self._new_widths[path])
+            self._breakers[key] = breaker
+        return breaker
+
+    def lines(self, pdf, w, text):
+        """
+        The lines multi_cell(w, h, text) would draw in pdf's current font, as
+        (breaker, lines) (see LineBreaker.break_lines), or None when the paragraph
+        has to go through multi_cell.
+        """
+        font = pdf.current_font
+        if (
+            not text or not pdf.is_ttf_font or font.is_symbol or pdf.text_shaping or pdf._fallback_font_ids
+            or pdf.char_spacing or pdf.font_stretching != 100 or SPECIAL_TEXT_RE.search(text)
+            or (pdf.str_alias_nb_pages and pdf.str_alias_nb_pages in text)
+        ):
+            self.fallbacks += 1
+            return None
+        breaker = self._breaker(pdf, w)
+        lines = breaker.break_lines(text)
+        if lines is None:
+            self.fallbacks += 1
+            return None
+        self.laid_out += 1
+        return breaker, lines
+
+    def count_lines(self, pdf, w, text):
+        """Number of lines multi_cell(w, h, text) would draw, or None when unknown."""
+        laid_out = self.lines(pdf, w, text)
+        return len(laid_out[1]) if laid_out else None
+
+    def write(self, pdf, w, h, text):
+        """
+        Draws text as pdf.multi_cell(w, h, text) would, breaking pages the same way;
+        returns False, having drawn nothing, when the paragraph needs multi_cell.
+        """
+        laid_out = self.lines(pdf, w, text)
+        if laid_out is None:
+            return False
+        breaker, lines = laid_out
+        last = len(lines) - 1
+        for i, (line, units, spaces, justified) in enumerate(lines):
+            pdf._perform_page_break_if_need_be(h)
+            text_line = TextLine(
+                pdf._preload_font_styles(line, False),
+                text_width=breaker.width(units),
+                number_of_spaces=spaces,
+                align=Align.J if justified else Align.L,
+                height=pdf.font_size,
+                max_width=w,
+            )
+            pdf._render_styled_text_line(
+                text_line, h=h, new_x=XPos.RIGHT if i == last else XPos.LEFT, new_y=YPos.NEXT,
+                border=0, fill=False, link=None, padding=NO_PADDING, prevent_font_change=False,
+            )
+        return True
+
+    @property
+    def words(self):
+        return sum(breaker.words for breaker in self._breakers.values())
+
+    @property
+    def measured(self):
+        return sum(breaker.measured for breaker in self._breakers.values())
+
+    def save(self):
+        """Writes the widths measured since the last save to the cache."""
+        if self.cache is None:
+            return
+        for path, new_widths in self._new_widths.items():
+            if new_widths:
+                self.cache.put_word_widths(path, new_widths)
+                new_widths.clear()
+
+    def report(self):
+        return (
+            f"Text layout: {self.laid_out} paragraphs broken from cached word widths, {self.fallbacks} through multi_cell; "
+            f"{self.words} words, {self.measured} measured"
+        )